@@ -19,28 +19,11 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import os
-import sys
 
-def _get_package_name(default='', version='1.5.0'):
-    from pkg_resources import WorkingSet
-    ws = WorkingSet()
-    _path, _ = os.path.split(os.path.dirname( \
-                                    sys.modules['pybootd'].__file__))
-    _path = os.path.normpath(_path)
-    if 'nt' not in os.name:
-        for dist in ws:
-            if os.path.samefile(os.path.normpath(dist.location), _path):
-                return dist.project_name, dist.version
-    else: #tweak for windows
-        _path = os.path.abspath(_path).lower()
-        for dist in ws:
-            if 'pybootd' in dist.location:
-                if _path == os.path.abspath(dist.location).lower():
-                    return dist.project_name, dist.version
-    return default, version
-
-
-PRODUCT_NAME, __version__ = _get_package_name('pybootd')
+# kept in line with setup.py: looking the installed distribution up with
+# pkg_resources takes longer than starting the whole daemon
+PRODUCT_NAME = 'pybootd'
+__version__ = '1.5.0'
 
 
 def pybootd_path(path):
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Local admin endpoint, for live introspection of a running server
+
+The endpoint speaks HTTP, on a Unix socket or on a local TCP address,
+given with the --admin option, and answers in JSON:
+
+    GET    /transfers             TFTP transfers in progress
+    DELETE /transfers/<id>        abort a transfer
+    GET    /clients[?mac=<mac>]   BOOTP client states and leases
+    GET    /caches                occupancy of the caches
+    DELETE /caches/<name>[?key=]  evict an entry of a cache, or all of them
+    GET    /metrics               statistics, in text exposition format
+    POST   /profile               start or stop a profiling session
+
+e.g. curl --unix-socket /run/pybootd-admin.sock http://admin/transfers
+
+Answers are built from snapshots of the server state, taken without
+holding the serving threads. The endpoint has no authentication: it
+belongs to a Unix socket, or to the loopback interface.
+"""
+
+import errno
+import json
+import os
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from pybootd import PRODUCT_NAME, __version__ as VERSION
+from stats import REGISTRY
+
+__all__ = ['AdminServer', 'AdminError']
+
+
+class AdminError(Exception):
+    """Admin endpoint error"""
+    pass
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    """Answer the admin requests, in JSON"""
+
+    server_version = '%s/%s' % (PRODUCT_NAME, VERSION)
+
+    def log_message(self, format, *args):
+        self.server.service.log.debug('admin: %s' % (format % args))
+
+    def do_GET(self):
+        self.dispatch('get')
+
+    def do_DELETE(self):
+        self.dispatch('delete')
+
+    def do_POST(self):
+        self.dispatch('post')
+
+    def dispatch(self, method):
+        url = urlparse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = dict(urlparse.parse_qsl(url.query))
+        handler = parts and getattr(self.server.service,
+                                    '%s_%s' % (method, parts[0]), None)
+        if not handler:
+            self.reply(404, {'error': 'Unknown request'})
+            return
+        try:
+            code, result = handler(parts[1:], query)
+        except (ValueError, KeyError), e:
+            code, result = 400, {'error': str(e)}
+        except Exception, e:
+            self.server.service.log.exception('Admin request failed')
+            code, result = 500, {'error': str(e)}
+        self.reply(code, result)
+
+    def reply(self, code, result):
+        if isinstance(result, basestring):
+            body, ctype = result, 'text/plain; version=0.0.4'
+        else:
+            body, ctype = json.dumps(result), 'application/json'
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address and self.client_address[0] or 'local'
+
+
+class _TcpAdminServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service, address):
+        self.service = service
+        HTTPServer.__init__(self, address, AdminHandler)
+
+
+class _UnixAdminServer(ThreadingMixIn, UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, service, path):
+        self.service = service
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        UnixStreamServer.__init__(self, path, AdminHandler)
+
+
+class AdminServer(object):
+    """Admin endpoint over the servers of a process
+
+       Servers not running in the process (e.g. the BOOTP server, in the
+       TFTP process) are reported as such.
+    """
+
+    def __init__(self, logger, address, profiler=None):
+        self.log = logger
+        self.address = address
+        self.profiler = profiler
+        self.bootpd = None
+        self.tftpd = None
+        self.server = None
+
+    def add_bootp(self, server):
+        self.bootpd = server
+
+    def add_tftp(self, server):
+        self.tftpd = server
+
+    def start(self):
+        address = self.address
+        if '/' in address:
+            self.server = _UnixAdminServer(self, address)
+        else:
+            host, sep, port = address.rpartition(':')
+            if not sep or not port.isdigit():
+                raise AdminError('Invalid admin address: %s' % address)
+            self.server = _TcpAdminServer(self, (host or '127.0.0.1',
+                                                 int(port)))
+        self.log.info('Admin endpoint on %s' % address)
+        worker = threading.Thread(target=self.server.serve_forever,
+                                  name='Admin')
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        """Stop serving requests; the address may be taken by another
+           process already"""
+        if self.server:
+            self.server.shutdown()
+            self.server.socket.close()
+            self.server = None
+
+    # Requests: (method)_(first path component), returning (code, result)
+
+    def get_transfers(self, args, query):
+        if not self.tftpd:
+            return 404, {'error': 'No TFTP server in this process'}
+        return 200, {'transfers': self.tftpd.transfers(),
+                     'queued': self.tftpd.pending.qsize(),
+                     'workers': self.tftpd.workers}
+
+    def delete_transfers(self, args, query):
+        if not self.tftpd:
+            return 404, {'error': 'No TFTP server in this process'}
+        if len(args) != 1:
+            raise ValueError('Expecting /transfers/<id>')
+        if not self.tftpd.cancel(int(args[0])):
+            return 404, {'error': 'No transfer %s' % args[0]}
+        return 200, {'cancelled': int(args[0])}
+
+    def get_clients(self, args, query):
+        if not self.bootpd:
+            return 404, {'error': 'No BOOTP server in this process'}
+        mac = query.get('mac', '').replace('-', ':')
+        clients = self.bootpd.describe_clients(mac or None)
+        if mac and not clients:
+            return 404, {'error': 'Unknown client %s' % mac}
+        return 200, {'clients': clients}
+
+    def get_caches(self, args, query):
+        caches = {}
+        if self.tftpd:
+            cache = self.tftpd.cache
+            files = cache.entries()
+            caches['prefetch'] = {
+                'bytes': sum([size for _, size, _ in files]),
+                'files': [{'resource': resource, 'size': size,
+                           'age': int(age)} for resource, size, age in files]}
+            files = self.tftpd.chunks.entries()
+            caches['chunks'] = {
+                'bytes': sum([size for _, _, _, size in files]),
+                'limit': self.tftpd.chunks.limit,
+                'chunk_size': self.tftpd.chunks.chunk_size,
+                'files': [{'url': url, 'size': size, 'chunks': chunks,
+                           'bytes': size_} for url, size, chunks, size_ in
+                          files]}
+            index = self.tftpd.index
+            caches['index'] = {'files': index and len(index.files) or 0,
+                               'root': index and index.root}
+        if self.bootpd:
+            replies = self.bootpd.replies
+            caches['replies'] = {'entries': replies is not None and
+                                            len(replies) or 0}
+        return 200, caches
+
+    def delete_caches(self, args, query):
+        if len(args) != 1:
+            raise ValueError('Expecting /caches/<name>')
+        name, key = args[0], query.get('key')
+        if name == 'prefetch' and self.tftpd:
+            count = self.tftpd.cache.evict(key)
+        elif name == 'chunks' and self.tftpd:
+            count = self.tftpd.chunks.evict(key)
+        elif name == 'replies' and self.bootpd and \
+             self.bootpd.replies is not None:
+            count = len(self.bootpd.replies)
+            self.bootpd.replies.clear()
+        else:
+            return 404, {'error': 'No cache %s in this process' % name}
+        self.log.info('Admin: evicted %d entries of the %s cache' % \
+                      (count, name))
+        return 200, {'evicted': count}
+
+    def get_metrics(self, args, query):
+        return 200, REGISTRY.render()
+
+    def post_profile(self, args, query):
+        if not self.profiler:
+            return 404, {'error': 'No profiler'}
+        return 200, {'active': self.profiler.toggle()}
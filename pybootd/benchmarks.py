@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Benchmarks for the server internals
+
+   python -m pybootd.benchmarks [-l] [name ...]
+   python -m pybootd.benchmarks -m [-s baseline.json] [-c baseline.json]
+                                [name ...]
+"""
+
+from optparse import OptionParser
+from inventory import CsvInventory, SqliteInventory
+from ippool import AddressPool
+from networks import Network, NetworkIndex
+from util import iptoint, inttoip
+import gc
+import itertools
+import marshal
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+_timer = time.time
+
+
+def percentile(values, ratio):
+    """Return the value at a given ratio of a sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, int(len(values)*ratio))]
+
+
+def latency_stats(samples):
+    """Summarize a list of durations, in seconds, as nanoseconds"""
+    samples = sorted(samples)
+    count = len(samples)
+    return {'count': count,
+            'mean_ns': count and sum(samples)*1e9/count or 0.0,
+            'p50_ns': percentile(samples, 0.50)*1e9,
+            'p99_ns': percentile(samples, 0.99)*1e9,
+            'max_ns': count and samples[-1]*1e9 or 0.0}
+
+
+def bench_pool_fill(prefix='10.0.0.0', bits=16):
+    """Allocate every address of a subnet, one at a time"""
+    first = iptoint(prefix)+1
+    pool = AddressPool(first, first+(1<<(32-bits))-3)
+    samples = []
+    allocate = pool.allocate
+    append = samples.append
+    while True:
+        start = _timer()
+        ip = allocate()
+        append(_timer()-start)
+        if ip is None:
+            break
+    return latency_stats(samples)
+
+
+def bench_pool_churn(prefix='10.0.0.0', bits=16, clients=40000,
+                     rounds=100000, seed=0):
+    """Release and reallocate random leases in a partially used subnet"""
+    rng = random.Random(seed)
+    first = iptoint(prefix)+1
+    pool = AddressPool(first, first+(1<<(32-bits))-3)
+    leases = [pool.allocate() for _ in xrange(clients)]
+    samples = []
+    append = samples.append
+    for _ in xrange(rounds):
+        pos = rng.randrange(clients)
+        start = _timer()
+        pool.release(leases[pos])
+        leases[pos] = pool.allocate()
+        append(_timer()-start)
+    return latency_stats(samples)
+
+
+def bench_network_lookup(subnets=4096, lookups=100000, seed=0):
+    """Select the subnet of random relays among thousands of subnets"""
+    rng = random.Random(seed)
+    index = NetworkIndex()
+    base = iptoint('10.0.0.0')
+    # a mix of /24, /26 and /27 subnets, below a /8 catch-all
+    for pos in xrange(subnets):
+        prefixlen = (24, 26, 27)[pos % 3]
+        net = base + (pos << 8)
+        index.add(Network('%s/%d' % (inttoip(net), prefixlen), {}))
+    index.add(Network('10.0.0.0/8', {}))
+    relays = [base + rng.randrange(subnets << 8) for _ in xrange(lookups)]
+    lookup = index.lookup
+    start = _timer()
+    for relay in relays:
+        lookup(relay)
+    total = _timer()-start
+    return {'count': lookups, 'mean_ns': total*1e9/lookups}
+
+
+def _rss():
+    """Return the resident memory of the process, in bytes"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+
+def _in_child(func, *args):
+    """Run a function in a forked process, so that memory measurements
+       are not skewed by previous allocations, and return its result"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        try:
+            os.write(wfd, marshal.dumps(func(*args)))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return marshal.loads(''.join(data))
+
+
+def _synthetic_hosts(hosts):
+    boot_files = ['pxelinux.0', 'undionly.kpxe', 'ipxe.efi', 'bootx64.efi']
+    for pos in xrange(hosts):
+        mac = '02:00:%02X:%02X:%02X:%02X' % ((pos >> 24) & 0xff,
+               (pos >> 16) & 0xff, (pos >> 8) & 0xff, pos & 0xff)
+        # as parsed from a file, strings are not shared between hosts
+        yield (mac, 'node%06d.rack%03d.example.com' % (pos, pos % 500),
+               ''.join(boot_files[pos % len(boot_files)]))
+
+
+def _write_csv(path, hosts):
+    with open(path, 'w') as out:
+        out.write('mac,hostname,boot_file\n')
+        for entry in _synthetic_hosts(hosts):
+            out.write('%s,%s,%s\n' % entry)
+
+
+def _measure_dict(hosts):
+    gc.collect()
+    before = _rss()
+    leases = dict([(mac, {'hostname': hostname, 'boot_file': boot_file})
+                   for mac, hostname, boot_file in _synthetic_hosts(hosts)])
+    gc.collect()
+    return _rss()-before
+
+
+def _measure_csv(path):
+    gc.collect()
+    before = _rss()
+    start = _timer()
+    inventory = CsvInventory(path).load()
+    duration = _timer()-start
+    gc.collect()
+    return (_rss()-before, duration)
+
+
+def bench_inventory_memory(hosts=100000):
+    """Resident memory of static leases: YAML-like dicts vs CSV inventory"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'hosts.csv')
+        _write_csv(path, hosts)
+        dict_bytes = _in_child(_measure_dict, hosts)
+        table_bytes, load_time = _in_child(_measure_csv, path)
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'count': hosts,
+            'dict_bytes_per_host': float(dict_bytes)/hosts,
+            'table_bytes_per_host': float(table_bytes)/hosts,
+            'csv_load_ms': load_time*1e3}
+
+
+def bench_inventory_lookup(hosts=100000, lookups=100000, seed=0):
+    """Look up random MAC addresses, half of them unknown, per backend"""
+    import sqlite3
+    rng = random.Random(seed)
+    entries = list(_synthetic_hosts(hosts))
+    macs = [rng.random() < 0.5 and rng.choice(entries)[0] or
+            '04:00:00:%02X:%02X:%02X' % (rng.randrange(256),
+                                         rng.randrange(256),
+                                         rng.randrange(256))
+            for _ in xrange(lookups)]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'hosts.csv')
+        _write_csv(path, hosts)
+        dbpath = os.path.join(tmpdir, 'hosts.db')
+        conn = sqlite3.connect(dbpath)
+        conn.execute('CREATE TABLE leases (mac TEXT PRIMARY KEY, '
+                     'hostname TEXT, boot_file TEXT)')
+        conn.executemany('INSERT INTO leases VALUES (?, ?, ?)', entries)
+        conn.commit()
+        conn.close()
+        result = {'count': lookups}
+        for name, inventory in (('table', CsvInventory(path).load()),
+                                ('sqlite', SqliteInventory(dbpath))):
+            get = inventory.get
+            start = _timer()
+            for mac in macs:
+                get(mac)
+            result['%s_mean_ns' % name] = (_timer()-start)*1e9/lookups
+    finally:
+        shutil.rmtree(tmpdir)
+    return result
+
+
+def _startup_config(path, port, hosts):
+    with open(path, 'w') as out:
+        out.write('logger:\n    type: stderr\n    level: error\n'
+                  'bootp:\n    bind_interface: lo\n    port: %d\n'
+                  '    allow_simple_dhcp: true\n    rate_limit: 0\n'
+                  'networks:\n    127.0.0.0/8:\n'
+                  '        range: [127.0.1.1, 127.0.1.254]\n'
+                  'bootp_leases:\n' % port)
+        for mac, hostname, boot_file in _synthetic_hosts(hosts):
+            out.write('    %s:\n        hostname: %s\n'
+                      '        boot_file: %s\n' % (mac, hostname, boot_file))
+
+
+def _first_offer(config, port, timeout=60.0):
+    """Start a daemon, and return the time it took to send an OFFER"""
+    from dhcpcodec import decode_packet, BOOTP_MAX_SIZE, DHCP_DISCOVER, \
+         DHCP_MSG, DHCP_OFFER
+    from loadgen import Client
+    # an unknown client, served from the dynamic pool
+    client = Client('\x04\x00\x00\x00\x00\x01', True, 0x5eed)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', 0))
+    sock.settimeout(0.01)
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.devnull, 'w') as devnull:
+        start = _timer()
+        daemon = subprocess.Popen([sys.executable, '-c',
+                                   'from pybootd.daemons import main; main()',
+                                   '-p', '-c', config], cwd=topdir,
+                                  stdout=devnull, stderr=devnull)
+        try:
+            while _timer()-start < timeout:
+                sock.sendto(client.build(DHCP_DISCOVER), ('127.0.0.1', port))
+                try:
+                    packet = decode_packet(sock.recv(BOOTP_MAX_SIZE))
+                except socket.timeout:
+                    continue
+                if packet.xid == client.xid and \
+                   packet.options.get_byte(DHCP_MSG) == DHCP_OFFER:
+                    return _timer()-start
+            raise RuntimeError('No OFFER received')
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            sock.close()
+
+
+def bench_startup(hosts=20000):
+    """Time to first OFFER of a restarted daemon, without and with the
+       compiled configuration"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        config = os.path.join(tmpdir, 'pybootd.yaml')
+        _startup_config(config, port, hosts)
+        cold = _first_offer(config, port)
+        warm = _first_offer(config, port)
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'count': hosts, 'cold_ms': cold*1e3, 'compiled_ms': warm*1e3}
+
+
+# Microbenchmarks: the CPU-bound functions run for each packet
+
+class _NullSocket(object):
+    """Socket stand-in, which discards what is sent"""
+
+    def getsockname(self):
+        return ('127.0.0.1', 67)
+
+    def sendto(self, data, addr):
+        return len(data)
+
+
+class _TftpServerStub(object):
+    """The few TftpServer attributes a TftpConnection relies on"""
+
+    blocksize = 512
+    timeout = 2.0
+    root = '/srv/tftp'
+    retry = 5
+    index = None
+    filters = None
+
+    def record(self, sock, peer, data, incoming, address=None):
+        pass
+
+
+def _quiet_logger():
+    import logging
+    logger = logging.getLogger('pybootd.benchmarks')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.CRITICAL+1)
+    return logger
+
+
+def _micro_config(tmpdir, hosts=0):
+    """Write a BOOTP configuration with static leases, and load it"""
+    from pybootdconfig import PyBootdConfig
+    path = os.path.join(tmpdir, 'micro-%d.yaml' % hosts)
+    with open(path, 'w') as out:
+        out.write('logger:\n    type: stderr\n    level: critical\n'
+                  'bootp:\n    bind_interface: lo\n'
+                  '    allow_simple_dhcp: true\n    rate_limit: 0\n'
+                  '    reply_cache_ttl: 0\n    default_boot_file: pxelinux.0\n'
+                  'tftp:\n    bind_interface: lo\n'
+                  'networks:\n    127.0.0.0/8:\n'
+                  '        range: [127.0.1.1, 127.0.255.254]\n')
+        if hosts:
+            out.write('bootp_leases:\n')
+        for mac, hostname, boot_file in _synthetic_hosts(hosts):
+            out.write('    %s:\n        hostname: %s\n'
+                      '        boot_file: %s\n' % (mac, hostname, boot_file))
+    return PyBootdConfig(path)
+
+
+def _micro_bootp(tmpdir):
+    from pxed import BootpServer
+    return BootpServer(_quiet_logger(), _micro_config(tmpdir))
+
+
+def _micro_client(pxe=True):
+    from loadgen import Client
+    return Client('\x04\x00\x00\x00\x00\x01', pxe, 0x5eed)
+
+
+def micro_tftp_parse(tmpdir):
+    """TftpConnection.parse of a read request with options"""
+    from tftpd import TftpConnection
+    conn = TftpConnection(_TftpServerStub(), logger=_quiet_logger())
+    conn.sock.close()
+    data = '\x00\x01pxelinux.cfg/default\x00octet\x00tsize\x000\x00' \
+           'blksize\x001468\x00'
+    return lambda: conn.parse(data)
+
+
+def micro_tftp_send_data(tmpdir):
+    """TftpConnection.send_data of a full block"""
+    from tftpd import TftpConnection
+    conn = TftpConnection(_TftpServerStub(), logger=_quiet_logger())
+    conn.sock.close()
+    conn.sock = _NullSocket()
+    conn.client_addr = ('127.0.0.1', 2000)
+    block = 'x' * conn.blocksize
+    return lambda: conn.send_data(block)
+
+
+def micro_hexline(tmpdir):
+    """hexline of a DHCP request"""
+    from dhcpcodec import DHCP_DISCOVER
+    from util import hexline
+    data = _micro_client().build(DHCP_DISCOVER)
+    return lambda: hexline(data)
+
+
+def micro_tftp_rrq_miss(tmpdir):
+    """TftpConnection.handle_rrq of a missing file, from the root index"""
+    from tftpd import TftpConnection
+    from tftproot import RootIndex
+    root = os.path.join(tmpdir, 'tftp')
+    os.makedirs(os.path.join(root, 'pxelinux.cfg'))
+    for name in ('pxelinux.0', 'ldlinux.c32', 'pxelinux.cfg/default'):
+        open(os.path.join(root, name), 'w').close()
+    server = _TftpServerStub()
+    server.root = root
+    server.index = RootIndex(_quiet_logger(), root, 3600)
+    server.index.files = server.index.scan(root)
+    conn = TftpConnection(server, logger=_quiet_logger())
+    conn.sock.close()
+    conn.sock = _NullSocket()
+    pkt = conn.parse('\x00\x01pxelinux.cfg/01-04-00-00-00-00-01\x00octet\x00'
+                     'tsize\x000\x00')
+    return lambda: conn.handle_rrq(pkt)
+
+
+def micro_bootp_parse(tmpdir):
+    """BootpServer.parse_options of a PXE DISCOVER"""
+    from dhcpcodec import DHCP_DISCOVER
+    server = _micro_bootp(tmpdir)
+    data = _micro_client().build(DHCP_DISCOVER)
+    return lambda: server.parse_options(data)
+
+
+def micro_bootp_pxe_options(tmpdir):
+    """BootpServer.build_pxe_options, in a new reply"""
+    from dhcpcodec import DHCP_DISCOVER
+    server = _micro_bootp(tmpdir)
+    packet = server.parse_options(_micro_client().build(DHCP_DISCOVER))
+    encoder = server.encoder
+    address = socket.inet_aton('127.0.1.1')
+    siaddr = socket.inet_aton('127.0.0.1')
+    def call():
+        encoder.begin(packet, address, siaddr, packet.giaddr)
+        server.build_pxe_options(packet.options, siaddr, encoder)
+    return call
+
+
+def micro_bootp_discover(tmpdir):
+    """BootpServer.handle of a PXE DISCOVER, from the dynamic pool"""
+    from dhcpcodec import DHCP_DISCOVER
+    server = _micro_bootp(tmpdir)
+    data = _micro_client().build(DHCP_DISCOVER)
+    sock = _NullSocket()
+    addr = ('0.0.0.0', 68)
+    return lambda: server.handle(sock, addr, data)
+
+
+def micro_bootp_request(tmpdir):
+    """BootpServer.handle of a PXE REQUEST, from the dynamic pool"""
+    from dhcpcodec import DHCP_DISCOVER, DHCP_REQUEST
+    server = _micro_bootp(tmpdir)
+    client = _micro_client()
+    sock = _NullSocket()
+    addr = ('0.0.0.0', 68)
+    server.handle(sock, addr, client.build(DHCP_DISCOVER))
+    client.offer = socket.inet_aton(server.ippool['04:00:00:00:00:01'])
+    data = client.build(DHCP_REQUEST)
+    return lambda: server.handle(sock, addr, data)
+
+
+def _micro_lease_lookup(tmpdir, hosts):
+    config = _micro_config(tmpdir, hosts)
+    # known and unknown clients, alternately
+    macs = []
+    for mac, hostname, boot_file in _synthetic_hosts(min(hosts, 1000)):
+        macs.append(mac)
+        macs.append(mac.replace('02:', '04:', 1))
+    lookups = itertools.cycle(macs)
+    get_lease = config.get_lease_for_mac
+    return lambda: get_lease(lookups.next())
+
+
+def micro_lease_lookup_100(tmpdir):
+    """PyBootdConfig.get_lease_for_mac, 100 static leases"""
+    return _micro_lease_lookup(tmpdir, 100)
+
+
+def micro_lease_lookup_10k(tmpdir):
+    """PyBootdConfig.get_lease_for_mac, 10000 static leases"""
+    return _micro_lease_lookup(tmpdir, 10000)
+
+
+def micro_lease_lookup_50k(tmpdir):
+    """PyBootdConfig.get_lease_for_mac, 50000 static leases"""
+    return _micro_lease_lookup(tmpdir, 50000)
+
+
+def micro_client_class_match(tmpdir):
+    """ClientClassIndex.match of a PXE DISCOVER, 5000 rules"""
+    from clientclasses import ClientClass, ClientClassIndex
+    from dhcpcodec import DHCP_DISCOVER, decode_packet
+    rules = [ClientClass({'name': 'rule%d' % pos,
+                          'arch': pos % 16,
+                          'vendor_class': 'PXEClient:Arch:%05d:' % pos,
+                          'user_class': 'class%d' % pos})
+             for pos in xrange(5000)]
+    # the request only matches the last rule
+    rules.append(ClientClass({'name': 'pxe', 'vendor_class': 'PXEClient'}))
+    index = ClientClassIndex(rules)
+    options = decode_packet(_micro_client().build(DHCP_DISCOVER)).options
+    return lambda: index.match(options)
+
+
+def measure(func, duration=0.2, repeat=5):
+    """Time a callable, returning its cost per call
+
+       Calls are timed in batches lasting about 'duration' seconds, the
+       fastest of 'repeat' batches is kept. The garbage collector is
+       disabled while timing.
+    """
+    calls = 1
+    while True:
+        start = _timer()
+        for _ in xrange(calls):
+            func()
+        elapsed = _timer()-start
+        if elapsed >= duration/10:
+            break
+        calls *= 10
+    calls = max(1, int(calls*duration/max(elapsed, 1e-9)))
+    best = None
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in xrange(repeat):
+            start = _timer()
+            for _ in xrange(calls):
+                func()
+            elapsed = _timer()-start
+            best = best is None and elapsed or min(best, elapsed)
+    finally:
+        if enabled:
+            gc.enable()
+    return {'ns': best*1e9/calls, 'calls': calls}
+
+
+MICROBENCHMARKS = [('tftp_parse', micro_tftp_parse),
+                   ('tftp_send_data', micro_tftp_send_data),
+                   ('tftp_rrq_miss', micro_tftp_rrq_miss),
+                   ('hexline', micro_hexline),
+                   ('bootp_parse', micro_bootp_parse),
+                   ('bootp_pxe_options', micro_bootp_pxe_options),
+                   ('bootp_discover', micro_bootp_discover),
+                   ('bootp_request', micro_bootp_request),
+                   ('client_class_match', micro_client_class_match),
+                   ('lease_lookup_100', micro_lease_lookup_100),
+                   ('lease_lookup_10k', micro_lease_lookup_10k),
+                   ('lease_lookup_50k', micro_lease_lookup_50k)]
+
+
+def run_micro(names=None, baseline=None, save=None, tolerance=0.2,
+              out=sys.stdout):
+    """Run the microbenchmarks, comparing them to a baseline if given
+
+       Returns the names of the benchmarks slower than the baseline by
+       more than 'tolerance'.
+    """
+    import json
+    reference = {}
+    if baseline:
+        with open(baseline) as fp:
+            reference = json.load(fp)
+    results = {}
+    regressions = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, func in MICROBENCHMARKS:
+            if names and name not in names:
+                continue
+            # the configuration loader reports to stdout
+            stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+            try:
+                call = func(tmpdir)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            stats = results[name] = measure(call)
+            line = '%-24s %10.0f ns' % (name, stats['ns'])
+            base = reference.get(name)
+            if base:
+                ratio = stats['ns']/base['ns']
+                line += '   %+6.1f%%' % ((ratio-1)*100)
+                if ratio > 1+tolerance:
+                    regressions.append(name)
+                    line += '  REGRESSION'
+            print >> out, line
+    finally:
+        shutil.rmtree(tmpdir)
+    if save:
+        with open(save, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    return regressions
+
+
+BENCHMARKS = [('pool_fill', bench_pool_fill),
+              ('pool_churn', bench_pool_churn),
+              ('network_lookup', bench_network_lookup),
+              ('inventory_memory', bench_inventory_memory),
+              ('inventory_lookup', bench_inventory_lookup),
+              ('startup', bench_startup)]
+
+
+def run(names=None, out=sys.stdout):
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        stats = func()
+        print >> out, '%-24s %s' % (name, ' '.join(['%s=%.0f' % \
+                      (k, stats[k]) for k in sorted(stats)]))
+
+
+def main():
+    usage = 'Usage: %prog [options] [benchmark ...]\n' \
+            '   Run pybootd benchmarks'
+    optparser = OptionParser(usage=usage)
+    optparser.add_option('-l', '--list', dest='list', action='store_true',
+                         help='list available benchmarks')
+    optparser.add_option('-m', '--micro', dest='micro', action='store_true',
+                         help='run the microbenchmarks of the per-packet '
+                              'functions')
+    optparser.add_option('-s', '--save', dest='save',
+                         help='save the microbenchmark results as a '
+                              'baseline file')
+    optparser.add_option('-c', '--compare', dest='compare',
+                         help='compare the microbenchmarks to a baseline '
+                              'file, exiting with status 1 on regression')
+    optparser.add_option('-t', '--tolerance', dest='tolerance', type='float',
+                         default=0.2,
+                         help='slowdown ratio tolerated by --compare '
+                              '(default: 0.2)')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    benchmarks = options.micro and MICROBENCHMARKS or BENCHMARKS
+    if options.list:
+        for name, func in benchmarks:
+            print '%-24s %s' % (name, func.__doc__)
+        return
+    if not options.micro:
+        run(args)
+        return
+    regressions = run_micro(args, options.compare, options.save,
+                            options.tolerance)
+    if regressions:
+        print >> sys.stderr, 'Regressions: %s' % ', '.join(regressions)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Chunked fetch of remote boot files, with HTTP range requests
+
+Files of a URL root are fetched in fixed-size chunks, which are kept in a
+sparse store: only the chunks read, or about to be read, are fetched.
+Reading a chunk queues the fetch of the next ones, so that a transfer
+seldom waits for the upstream server, and any position of a file may be
+read again without downloading the whole file.
+
+The store is configured in the 'remote' section:
+
+    remote:
+        chunk_size: 1M
+        read_ahead: 4
+        cache_size: 256M
+        shared: true
+
+A shared store serves every transfer from the same chunks. Otherwise each
+transfer has a store of its own, which only keeps its read-ahead window.
+Servers which do not support range requests are read as a stream.
+"""
+
+import Queue
+import re
+import threading
+import time
+import urllib2
+from stats import REGISTRY
+from util import to_int
+
+__all__ = ['ChunkStore', 'ChunkError']
+
+_CONTENT_RANGE = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+
+
+class ChunkError(IOError):
+    """Remote file chunk error"""
+    pass
+
+
+class RemoteFile(object):
+    """Read-only file object over the chunks of a remote file"""
+
+    def __init__(self, store, url, info):
+        self.store = store
+        self.url = url
+        self.size, self.validator = info[:2]
+        self._pos = 0
+        self._index = None # index of the last chunk read
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self._pos
+        size = min(size, self.size - self._pos)
+        parts = []
+        while size > 0:
+            index, offset = divmod(self._pos, self.store.chunk_size)
+            if index != self._index:
+                self._index = index
+                self.store.read_ahead(self.url, index+1)
+            chunk = self.store.get_chunk(self.url, index)
+            if self.store.get_info(self.url) != (self.size, self.validator):
+                raise ChunkError('%s changed during the transfer' % self.url)
+            part = chunk[offset:offset+size]
+            if not part:
+                raise ChunkError('Short chunk %d of %s' % (index, self.url))
+            parts.append(part)
+            self._pos += len(part)
+            size -= len(part)
+        return ''.join(parts)
+
+    def close(self):
+        self.store.close_file(self)
+
+
+class ChunkStore(object):
+    """Sparse store of remote file chunks
+
+       Chunks are fetched by a pool of worker threads, shared by the
+       private stores derived from this one. The least recently used
+       chunks are dropped beyond the size of the store.
+    """
+
+    def __init__(self, logger, config, parent=None):
+        self.log = logger
+        self.config = config
+        settings = config.snapshot()
+        self.chunk_size = to_int(settings.get_remote_chunk_size())
+        self.ahead = int(settings.get_remote_read_ahead())
+        self.timeout = float(settings.get_remote_timeout())
+        self.ttl = float(settings.get_remote_ttl())
+        self._lock = threading.Condition(threading.Lock())
+        self._chunks = {} # key (URL, index), value [content, time of use]
+        self._pending = set() # (URL, index) being fetched
+        self._files = {} # key URL, value (size, validator, check time)
+        self._size = 0
+        if parent:
+            # the window of a single transfer, the chunk in use included
+            self.limit = (self.ahead+2) * self.chunk_size
+            self._queue = parent._queue
+            self._workers = parent._workers
+            self.fetched = parent.fetched
+            self.hits = parent.hits
+            self.parent = parent
+            return
+        self.parent = None
+        self.limit = to_int(settings.get_remote_cache_size())
+        self._queue = Queue.Queue()
+        self._workers = []
+        for pos in xrange(int(settings.get_remote_workers())):
+            worker = threading.Thread(target=self._run,
+                                      name='ChunkFetcher-%d' % pos)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self.fetched = REGISTRY.counter('pybootd_remote_chunks_total',
+            'Remote file chunks fetched, by outcome', ('outcome',))
+        self.hits = REGISTRY.counter('pybootd_remote_chunk_reads_total',
+            'Remote file chunk reads, by source', ('source',))
+        REGISTRY.gauge('pybootd_remote_store_bytes',
+            'Bytes of remote file chunks kept in the shared store', (),
+            lambda: [((), self._size)])
+
+    def private(self):
+        """Return a store for a single transfer, using the same workers"""
+        return ChunkStore(self.log, self.config, self)
+
+    def open(self, url):
+        """Return a file object over a remote file
+
+           None is returned if the server does not support range requests.
+        """
+        with self._lock:
+            info = self._files.get(url)
+        if not info or time.time() - info[2] >= self.ttl:
+            # (re)validate the file with its first chunk
+            with self._lock:
+                entry = self._chunks.pop((url, 0), None)
+                if entry:
+                    self._size -= len(entry[0])
+            try:
+                self._load(url, 0)
+            except ChunkError:
+                with self._lock:
+                    if self._files.get(url, (None,))[0] is None:
+                        return None
+                raise
+            with self._lock:
+                info = self._files.get(url)
+        if info[0] is None:
+            return None
+        return RemoteFile(self, url, info)
+
+    def get_info(self, url):
+        """Return the size and validator of a remote file"""
+        with self._lock:
+            return self._files.get(url, (None, None))[:2]
+
+    def entries(self):
+        """Return the remote files of the store, as (URL, size, chunks,
+           bytes)"""
+        with self._lock:
+            files = dict([(url, [info[0], 0, 0]) for url, info in
+                          self._files.iteritems()])
+            for (url, index), (content, _) in self._chunks.iteritems():
+                entry = files.setdefault(url, [None, 0, 0])
+                entry[1] += 1
+                entry[2] += len(content)
+        return [(url,) + tuple(entry) for url, entry in sorted(files.items())]
+
+    def evict(self, url=None):
+        """Drop the chunks of a remote file, or of every file, returning
+           the count"""
+        with self._lock:
+            keys = [key for key in self._chunks if url is None or
+                    key[0] == url]
+            for key in keys:
+                self._size -= len(self._chunks.pop(key)[0])
+            for name in [name for name in self._files if url is None or
+                         name == url]:
+                del self._files[name]
+        return len(keys)
+
+    def close_file(self, remote):
+        if not self.parent:
+            return
+        with self._lock:
+            for key in [key for key in self._chunks if key[0] == remote.url]:
+                self._size -= len(self._chunks.pop(key)[0])
+
+    def get_chunk(self, url, index):
+        """Return a chunk, waiting for it or fetching it as needed"""
+        key = (url, index)
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while True:
+                entry = self._chunks.get(key)
+                if entry:
+                    entry[1] = time.time()
+                    self.hits.inc('store')
+                    return entry[0]
+                if key not in self._pending:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ChunkError('Timed out reading chunk %d of %s' % \
+                                     (index, url))
+                self._lock.wait(remaining)
+        self.hits.inc('fetch')
+        return self._load(url, index)
+
+    def read_ahead(self, url, first):
+        """Queue the fetch of the chunks following a read"""
+        with self._lock:
+            size = self._files.get(url, (None,))[0]
+            if not size:
+                return
+            if self.parent:
+                # a transfer moves forward, its past chunks make room
+                for key in [key for key in self._chunks if key[0] == url
+                            and key[1] < first-1]:
+                    self._size -= len(self._chunks.pop(key)[0])
+            last = min(first+self.ahead, (size-1)//self.chunk_size+1)
+            for index in xrange(first, last):
+                key = (url, index)
+                if key in self._chunks or key in self._pending:
+                    continue
+                self._pending.add(key)
+                self._queue.put((self, url, index))
+
+    def warm(self, url):
+        """Fetch the first chunks of a remote file, ahead of a transfer"""
+        if self.open(url):
+            self.read_ahead(url, 1)
+
+    def _run(self):
+        while True:
+            store, url, index = self._queue.get()
+            try:
+                store._load(url, index, True)
+            except Exception, e:
+                self.log.warn('Cannot fetch chunk %d of %s: %s' % \
+                              (index, url, e))
+
+    def _load(self, url, index, queued=False):
+        key = (url, index)
+        with self._lock:
+            if not queued:
+                self._pending.add(key)
+        try:
+            content = self._fetch(url, index)
+        except Exception, e:
+            with self._lock:
+                self._pending.discard(key)
+                self._lock.notify_all()
+            self.fetched.inc('error')
+            if isinstance(e, ChunkError):
+                raise
+            raise ChunkError('Cannot fetch chunk %d of %s: %s' % \
+                             (index, url, e))
+        with self._lock:
+            self._pending.discard(key)
+            self._chunks[key] = [content, time.time()]
+            self._size += len(content)
+            if self._size > self.limit:
+                self._evict(key)
+            self._lock.notify_all()
+        self.fetched.inc('fetched')
+        return content
+
+    def _evict(self, keep):
+        for used, key in sorted([(used, key) for key, (_, used) in
+                                 self._chunks.iteritems()]):
+            if self._size <= self.limit:
+                break
+            if key != keep:
+                self._size -= len(self._chunks.pop(key)[0])
+
+    def _fetch(self, url, index):
+        first = index * self.chunk_size
+        request = urllib2.Request(url)
+        request.add_header('Range', 'bytes=%d-%d' % \
+                           (first, first+self.chunk_size-1))
+        with self._lock:
+            info = self._files.get(url)
+        rp = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            headers = rp.info()
+            validator = headers.getheader('ETag') or \
+                        headers.getheader('Last-Modified')
+            if rp.getcode() != 206:
+                # no range support: the file is streamed instead
+                with self._lock:
+                    self._files[url] = (None, None, time.time())
+                raise ChunkError('No range support for %s' % url)
+            mo = _CONTENT_RANGE.match(headers.getheader('Content-Range', ''))
+            if not mo or int(mo.group(1)) != first or mo.group(3) == '*':
+                raise ChunkError('Invalid range for chunk %d of %s' % \
+                                 (index, url))
+            size = int(mo.group(3))
+            content = rp.read(self.chunk_size)
+        finally:
+            rp.close()
+        if len(content) != min(self.chunk_size, size-first):
+            raise ChunkError('Truncated chunk %d of %s' % (index, url))
+        with self._lock:
+            if info and (info[0], info[1]) != (size, validator):
+                # the file changed upstream, its chunks are stale
+                self.log.info('Remote file %s changed' % url)
+                for key in [key for key in self._chunks if key[0] == url]:
+                    self._size -= len(self._chunks.pop(key)[0])
+                info = None
+            self._files[url] = (size, validator, time.time())
+        return content
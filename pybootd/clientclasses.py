@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Client classes, selected from the options of the requests
+
+The 'client_classes' configuration section is an ordered list of rules,
+the first rule matching a request selects its class:
+
+    client_classes:
+        - name: ipxe-efi
+          ipxe: [http, efi]
+          boot_file: boot.ipxe
+        - name: uefi-x64
+          arch: [efi-x64, efi-bc]
+          boot_file: ipxe.efi
+        - name: bios
+          arch: bios
+          vendor_class: PXEClient
+          boot_file: undionly.kpxe
+          options:
+              66: tftp.example.com
+
+A rule matches on any of:
+
+  arch          system architectures (option 93), numbers or names
+  vendor_class  prefixes of the vendor class identifier (option 60)
+  user_class    user classes (option 77), as raw or RFC 3004 values
+  ipxe          iPXE features all present in option 175, or 'true' for
+                any iPXE client
+
+each listed value being an alternative. A class selects a boot file,
+and options added to the replies.
+
+Rules are compiled into one table per criterion, mapping each value to
+the set of rules it satisfies, as a bitmap of rule positions. A request
+is matched by intersecting the bitmaps of its values: the cost depends
+on the number of criteria, not on the number of rules.
+"""
+
+import socket
+import struct
+from dhcpcodec import DHCP_CLASS_ID, DHCP_USER_CLASS, DHCP_CLIENT_ARCH, \
+     DHCP_IPXE_ENCAP, CLIENT_ARCHITECTURES
+
+__all__ = ['ClientClassError', 'ClientClass', 'ClientClassIndex']
+
+# feature indicators of option 175, as sent by iPXE
+IPXE_FEATURES = {'priority': 0x01, 'keep-san': 0x08, 'skip-san-boot': 0x09,
+                 'syslogs': 0x55, 'iscsi': 0x11, 'aoe': 0x12, 'http': 0x13,
+                 'https': 0x14, 'tftp': 0x15, 'ftp': 0x16, 'dns': 0x17,
+                 'bzimage': 0x18, 'multiboot': 0x19, 'slam': 0x1a,
+                 'srp': 0x1b, 'nbi': 0x20, 'pxe': 0x21, 'elf': 0x22,
+                 'comboot': 0x23, 'efi': 0x24, 'fcoe': 0x25, 'vlan': 0x26,
+                 'menu': 0x27, 'sdi': 0x28, 'nfs': 0x29}
+
+# options of every reply, which a class may not replace
+RESERVED_OPTIONS = (1, 3, 6, 12, 43, 51, 53, 54, 60, 97)
+
+_IPV4 = struct.Struct('!I')
+
+
+class ClientClassError(Exception):
+    """Invalid client class definition"""
+    pass
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _code(value, names):
+    """Convert a name, or a number, into a number"""
+    if isinstance(value, basestring) and value.lower() in names:
+        return names[value.lower()]
+    return int(value, 0) if isinstance(value, basestring) else int(value)
+
+
+def _pack_option(tag, value):
+    """Pack an option value: integers as 32 bits, lists of addresses as
+       addresses, strings as they are"""
+    if isinstance(value, bool):
+        raise ClientClassError('Invalid value for option %d' % tag)
+    if isinstance(value, (int, long)):
+        return _IPV4.pack(value)
+    if isinstance(value, (list, tuple)):
+        try:
+            return ''.join([socket.inet_aton(ip) for ip in value])
+        except (socket.error, TypeError):
+            raise ClientClassError('Invalid addresses for option %d' % tag)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value)
+
+
+class ClientClass(object):
+    """A client class rule, with pre-packed option values"""
+
+    __slots__ = ('name', 'arch', 'vendor_class', 'user_class', 'ipxe',
+                 'boot_file', 'options')
+
+    def __init__(self, ruledata):
+        if not isinstance(ruledata, dict) or not ruledata.get('name'):
+            raise ClientClassError('Rules should be mappings with a name')
+        self.name = str(ruledata['name'])
+        try:
+            self.arch = [_code(arch, CLIENT_ARCHITECTURES) for arch in
+                         _as_list(ruledata.get('arch'))]
+        except (ValueError, TypeError):
+            raise ClientClassError('%s: invalid architecture' % self.name)
+        self.vendor_class = [str(prefix) for prefix in
+                             _as_list(ruledata.get('vendor_class'))]
+        self.user_class = [str(value) for value in
+                           _as_list(ruledata.get('user_class'))]
+        ipxe = ruledata.get('ipxe')
+        if ipxe is True:
+            self.ipxe = []
+        elif ipxe is None or ipxe is False:
+            self.ipxe = None
+        else:
+            try:
+                self.ipxe = [_code(feature, IPXE_FEATURES) for feature in
+                             _as_list(ipxe)]
+            except (ValueError, TypeError):
+                raise ClientClassError('%s: invalid iPXE feature' % \
+                                       self.name)
+        self.boot_file = ruledata.get('boot_file')
+        self.options = []
+        options = ruledata.get('options') or {}
+        if not isinstance(options, dict):
+            raise ClientClassError('%s: options should be a mapping' % \
+                                   self.name)
+        for tag, value in sorted(options.items()):
+            try:
+                tag = int(tag)
+            except ValueError:
+                raise ClientClassError('%s: invalid option %s' % \
+                                       (self.name, tag))
+            if not 0 < tag < 255 or tag in RESERVED_OPTIONS:
+                raise ClientClassError('%s: option %d may not be set' % \
+                                       (self.name, tag))
+            packed = _pack_option(tag, value)
+            if len(packed) > 255:
+                raise ClientClassError('%s: option %d is too long' % \
+                                       (self.name, tag))
+            self.options.append((tag, packed))
+
+    def __repr__(self):
+        return self.name
+
+
+class _Criterion(object):
+    """Map the values of a criterion to the rules they satisfy
+
+       Rules without a condition on the criterion are satisfied by any
+       value, or by none.
+    """
+
+    __slots__ = ('table', 'any')
+
+    def __init__(self):
+        self.table = {}
+        self.any = 0
+
+    def add(self, bit, values):
+        if not values:
+            self.any |= bit
+            return
+        for value in values:
+            self.table[value] = self.table.get(value, 0) | bit
+
+    def match(self, values):
+        bits = self.any
+        table = self.table
+        for value in values:
+            bits |= table.get(value, 0)
+        return bits
+
+
+class ClientClassIndex(object):
+    """Compiled client class rules
+
+       Rule n is represented by bit n of the bitmaps, so that the lowest
+       bit of a match is the first rule in the configuration order.
+    """
+
+    def __init__(self, rules=None):
+        self.classes = []
+        self._all = 0
+        self._arch = _Criterion()
+        self._vendor = _Criterion()
+        self._vendor_lengths = []
+        self._user = _Criterion()
+        self._ipxe_any = 0 # rules without an iPXE condition
+        self._ipxe_rules = 0 # rules with one
+        self._ipxe_needs = {} # key feature, value rules requiring it
+        for rule in rules or []:
+            self.add(rule)
+
+    def add(self, rule):
+        bit = 1 << len(self.classes)
+        self.classes.append(rule)
+        self._all |= bit
+        self._arch.add(bit, rule.arch)
+        self._vendor.add(bit, rule.vendor_class)
+        self._vendor_lengths = sorted(set(self._vendor_lengths +
+                                          [len(prefix) for prefix in
+                                           rule.vendor_class]))
+        self._user.add(bit, rule.user_class)
+        if rule.ipxe is None:
+            self._ipxe_any |= bit
+        else:
+            self._ipxe_rules |= bit
+            for feature in rule.ipxe:
+                self._ipxe_needs[feature] = \
+                    self._ipxe_needs.get(feature, 0) | bit
+
+    def __len__(self):
+        return len(self.classes)
+
+    def match(self, options):
+        """Return the class of a request, from its options, or None"""
+        bits = self._all
+        arch = options.get(DHCP_CLIENT_ARCH, '')
+        bits &= self._arch.match(struct.unpack('!%dH' % (len(arch)//2),
+                                               arch[:len(arch) & ~1]))
+        if bits:
+            vendor = options.get(DHCP_CLASS_ID, '')
+            bits &= self._vendor.match([vendor[:length] for length in
+                                        self._vendor_lengths
+                                        if length <= len(vendor)])
+        if bits:
+            bits &= self._user.match(self._user_classes(
+                                        options.get(DHCP_USER_CLASS)))
+        if bits and self._ipxe_rules:
+            encap = options.get(DHCP_IPXE_ENCAP)
+            if encap is None:
+                bits &= self._ipxe_any
+            else:
+                present = self._encapsulated(encap)
+                missing = 0
+                for feature, rules in self._ipxe_needs.iteritems():
+                    if feature not in present:
+                        missing |= rules
+                bits &= ~missing
+        if not bits:
+            return None
+        return self.classes[(bits & -bits).bit_length()-1]
+
+    def _user_classes(self, value):
+        if not value:
+            return []
+        values = [value]
+        # RFC 3004 user classes are length-prefixed, iPXE sends its name
+        pos, items = 0, []
+        while pos < len(value):
+            length = ord(value[pos])
+            if not length or pos+1+length > len(value):
+                return values
+            items.append(value[pos+1:pos+1+length])
+            pos += 1+length
+        return values + items
+
+    def _encapsulated(self, value):
+        tags = set()
+        pos = 0
+        while pos+1 < len(value):
+            tag = ord(value[pos])
+            if tag in (0, 255):
+                pos += 1
+                continue
+            tags.add(tag)
+            pos += 2+ord(value[pos+1])
+        return tags
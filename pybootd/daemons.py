@@ -19,22 +19,39 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+from admin import AdminServer, AdminError
+from handoff import Handoff, HandoffError, HANDOFF_DRAIN_TIMEOUT
+from httpd import HttpBootServer
 from optparse import OptionParser
+from pcap import PcapWriter
 from pxed import BootpServer
 from pybootd import pybootd_path, PRODUCT_NAME, __version__ as VERSION
+from profiler import Profiler
 from pybootdconfig import PyBootdConfig
+from shared import BootpExporter, BootpProxy, shared_socketpair
+from stats import REGISTRY
 from tftpd import TftpServer
 from util import logger_factory, EasyConfigParser
+import errno
 import os
+import signal
 import sys
 import threading
+import time
+
+# processes exiting sooner after being started are not restarted
+SUPERVISOR_MIN_UPTIME = 5.0
+SUPERVISOR_RESTART_DELAY = 1.0
+# exit status of the processes which handed their sockets over
+SUPERVISOR_HANDED_OVER = 75
 
 
 class BootpDaemon(threading.Thread):
-    def __init__(self, logger, config):
+    def __init__(self, logger, config, recorder=None, handoff=None):
         threading.Thread.__init__(self, name="BootpDeamon")
         self.daemon = True
-        self._server = BootpServer(logger=logger, config=config)
+        self._server = BootpServer(logger=logger, config=config,
+                                   recorder=recorder, handoff=handoff)
 
     def get_netconfig(self):
         return self._server.get_netconfig()
@@ -42,21 +59,254 @@ class BootpDaemon(threading.Thread):
     def get_filename(self, ip):
         return self._server.get_filename(ip)
 
-    def run(self):
+    def get_lease(self, ip):
+        return self._server.get_lease(ip)
+
+    def add_prefetch_listener(self, listener):
+        self._server.add_prefetch_listener(listener)
+
+    def bind(self):
         self._server.bind()
+
+    def run(self):
         self._server.forever()
 
+    def stop(self):
+        self._server.stop()
+        if self.is_alive():
+            self.join()
+
 
 class TftpDaemon(threading.Thread):
-    def __init__(self, logger, config, bootpd=None):
+    def __init__(self, logger, config, bootpd=None, recorder=None,
+                 handoff=None):
         threading.Thread.__init__(self, name="TftpDeamon")
         self.daemon = True
-        self._server = TftpServer(logger=logger, config=config, bootpd=bootpd)
+        self._server = TftpServer(logger=logger, config=config, bootpd=bootpd,
+                                  recorder=recorder, handoff=handoff)
+
+    def bind(self):
+        self._server.bind()
 
     def run(self):
+        self._server.forever()
+
+    def stop(self):
+        self._server.stop()
+        if self.is_alive():
+            self.join()
+
+
+class HttpBootDaemon(threading.Thread):
+    def __init__(self, logger, config, bootpd=None, handoff=None):
+        threading.Thread.__init__(self, name="HttpBootDeamon")
+        self.daemon = True
+        self._server = HttpBootServer(logger=logger, config=config,
+                                      bootpd=bootpd, handoff=handoff)
+
+    def bind(self):
         self._server.bind()
+
+    def run(self):
         self._server.forever()
 
+    def stop(self):
+        self._server.stop()
+        if self.is_alive():
+            self.join()
+
+
+def dump_stats(logger, path=None):
+    """Write the daemon statistics to a file, or to the log"""
+    stats = REGISTRY.render()
+    if not path:
+        logger.info('Statistics:\n%s' % stats)
+        return
+    try:
+        # replace the file at once, it may be read at any time
+        with open(path + '.tmp', 'w') as out:
+            out.write(stats)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError), e:
+        logger.error('Cannot write statistics: %s' % e)
+
+
+def process_path(path, name):
+    """Name the file of a process after a shared file name"""
+    if not path or not name:
+        return path
+    base, ext = os.path.splitext(path)
+    return '%s-%s%s' % (base, name, ext)
+
+
+def serve(logger, config, options, bootp=True, tftp=True, peer=None,
+          name=None):
+    """Run the servers, until the process is terminated
+
+       In process mode, each process runs one of the servers: peer is the
+       socket to the BOOTP state, exported from the BOOTP process and
+       queried from the TFTP one, and name tells the process files apart.
+
+       Returns True once the servers are handed over to a new process,
+       and their transfers are complete.
+    """
+    stats = process_path(options.stats, name)
+    # SIGHUP reloads the configuration, without interrupting the services
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: config.reload_async(logger))
+    # exit through the main thread, so that the capture file is closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: dump_stats(logger, stats))
+    # SIGUSR2 starts a profiling session, or ends the current one
+    profiler = Profiler(logger, config)
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
+    if options.watch:
+        config.watch(logger, options.watch)
+    recorder = None
+    handoff = None
+    daemons = []
+    admin = None
+    if options.handoff:
+        # take the sockets of a running server over, if any
+        handoff = Handoff(logger, process_path(options.handoff, name),
+                          options.drain)
+        try:
+            handoff.receive()
+        except HandoffError, e:
+            raise AssertionError(str(e))
+    try:
+        if options.record:
+            record = process_path(options.record, name)
+            recorder = PcapWriter(record)
+            logger.info('Recording traffic to %s' % record)
+        # servers are bound before they start, so that the sockets
+        # inherited from a previous process are all taken
+        bt = None
+        if bootp:
+            bt = BootpDaemon(logger, config, recorder, handoff)
+            daemons.append(bt)
+            if peer:
+                BootpExporter(peer, bt, logger).start()
+        elif peer:
+            bt = BootpProxy(peer, logger)
+        if tftp:
+            daemons.append(TftpDaemon(logger, config, bt, recorder,
+                                      handoff))
+            if not options.pxe and config.enable_httpboot:
+                daemons.append(HttpBootDaemon(logger, config, bt, handoff))
+        for daemon in daemons:
+            daemon.bind()
+        for daemon in daemons:
+            daemon.start()
+        if options.admin:
+            admin = AdminServer(logger, process_path(options.admin, name),
+                                profiler)
+            for daemon in daemons:
+                if isinstance(daemon, BootpDaemon):
+                    admin.add_bootp(daemon._server)
+                elif isinstance(daemon, TftpDaemon):
+                    admin.add_tftp(daemon._server)
+            try:
+                admin.start()
+            except (AdminError, EnvironmentError), e:
+                raise AssertionError('Cannot start the admin endpoint: %s' % \
+                                     e)
+        if handoff:
+            handoff.release()
+            handoff.listen()
+        while not (handoff and handoff.finished.isSet()):
+            time.sleep(1)
+        return True
+    finally:
+        # the server threads end before the interpreter shuts down
+        for daemon in daemons:
+            daemon.stop()
+        if admin:
+            admin.stop()
+        config.unwatch()
+        profiler.stop()
+        if recorder:
+            recorder.close()
+
+
+def supervise(logger, services):
+    """Run each service in a process of its own, restarting it on failure
+
+       services maps a service name to the callable running it. Signals
+       are forwarded to the service processes. Processes which handed
+       their sockets over to a new process are not restarted.
+    """
+    children = {} # key pid, value (service name, start time)
+    stopping = []
+
+    def spawn(name):
+        pid = os.fork()
+        if not pid:
+            status = 0
+            try:
+                if services[name]():
+                    status = SUPERVISOR_HANDED_OVER
+            except SystemExit, e:
+                status = e.code or 0
+            except KeyboardInterrupt:
+                pass
+            except Exception, e:
+                logger.exception('%s process failed: %s' % (name, e))
+                status = 1
+            os._exit(status)
+        logger.info('Started %s process %d' % (name, pid))
+        children[pid] = (name, time.time())
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        forward(signal.SIGTERM, frame)
+
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+    signal.signal(signal.SIGTERM, stop)
+    for name in sorted(services):
+        spawn(name)
+    while children:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            # the service processes got the interrupt as well
+            stopping.append(signal.SIGINT)
+            continue
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        name, started = children.pop(pid)
+        if stopping:
+            continue
+        if os.WIFEXITED(status) and \
+           os.WEXITSTATUS(status) == SUPERVISOR_HANDED_OVER:
+            logger.info('%s process %d handed over to a new process' % \
+                        (name, pid))
+            continue
+        if os.WIFSIGNALED(status):
+            logger.error('%s process %d killed by signal %d' % \
+                         (name, pid, os.WTERMSIG(status)))
+        else:
+            logger.error('%s process %d exited with status %d' % \
+                         (name, pid, os.WEXITSTATUS(status)))
+        if time.time() - started < SUPERVISOR_MIN_UPTIME:
+            logger.error('%s process failed at startup, stopping' % name)
+            stop(signal.SIGTERM, None)
+            continue
+        time.sleep(SUPERVISOR_RESTART_DELAY)
+        spawn(name)
+
 
 def main():
     usage = 'Usage: %prog [options]\n' \
@@ -69,6 +319,31 @@ def main():
                          help='enable BOOTP/DHCP/PXE server only')
     optparser.add_option('-t', '--tftp', dest='tftp', action='store_true',
                          help='enable TFTP server only')
+    optparser.add_option('-w', '--watch', dest='watch', type='float',
+                         help='reload the configuration file when modified, '
+                              'checking every WATCH seconds')
+    optparser.add_option('-s', '--stats', dest='stats',
+                         help='statistics file, written on SIGUSR1 '
+                              '(default: log them)')
+    optparser.add_option('-r', '--record', dest='record',
+                         help='record the BOOTP and TFTP traffic to a pcap '
+                              'file')
+    optparser.add_option('-P', '--processes', dest='processes',
+                         action='store_true',
+                         help='run the BOOTP and TFTP servers in separate '
+                              'processes, each with its own statistics and '
+                              'capture file (e.g. stats-bootp.prom)')
+    optparser.add_option('-A', '--admin', dest='admin',
+                         help='admin endpoint, JSON over HTTP, on a Unix '
+                              'socket path or a local host:port address')
+    optparser.add_option('-H', '--handoff', dest='handoff',
+                         help='Unix socket to take the listening sockets '
+                              'over from a running server, then to hand '
+                              'them over to the next one')
+    optparser.add_option('-D', '--drain', dest='drain', type='float',
+                         default=HANDOFF_DRAIN_TIMEOUT,
+                         help='seconds granted to the transfers in progress '
+                              'once handed over (default: %default)')
     (options, args) = optparser.parse_args(sys.argv[1:])
 
     if not options.config:
@@ -77,6 +352,10 @@ def main():
     if options.pxe and options.tftp:
         raise AssertionError('Cannot exclude both servers')
 
+    if options.processes and options.admin and '/' not in options.admin:
+        raise AssertionError('The admin endpoint of separate processes '
+                             'should be a Unix socket')
+
     #cfgparser = EasyConfigParser()
     config = PyBootdConfig(options.config)
     #with open(pybootd_path(options.config), 'rt') as config:
@@ -87,17 +366,24 @@ def main():
                             level=config.get_logger_level())
     logger.info('-'.join((PRODUCT_NAME, VERSION)))
     try:
-        if not options.tftp or not config.enable_tftp:
-            bt = BootpDaemon(logger, config)
-            bt.start()
+        bootp = not options.tftp or not config.enable_tftp
+        tftp = not options.pxe or not config.enable_bootp
+        if not options.processes:
+            serve(logger, config, options, bootp, tftp)
         else:
-            bt = None
-        if not options.pxe or not config.enable_bootp:
-            ft = TftpDaemon(logger, config, bt)
-            ft.start()
-        while True:
-            import time
-            time.sleep(5)
+            # the BOOTP state is shared through a pair of local sockets
+            peers = shared_socketpair()
+            services = {}
+            if bootp:
+                services['bootp'] = lambda: serve(logger, config, options,
+                                                  True, False, peers[0],
+                                                  'bootp')
+            if tftp:
+                services['tftp'] = lambda: serve(logger, config, options,
+                                                 False, True,
+                                                 bootp and peers[1] or None,
+                                                 'tftp')
+            supervise(logger, services)
     except AssertionError, e:
         print >> sys.stderr, "Error: %s" % str(e)
         sys.exit(1)
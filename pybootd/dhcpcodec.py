@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010-2011 Emmanuel Blot <emmanuel.blot@free.fr>
+# Copyright (c) 2010-2011 Neotion
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""BOOTP/DHCP packet codec
+
+Requests are decoded straight from a memoryview over the received
+datagram: the fixed header fields are unpacked once, and the option area
+is scanned in a single pass which only records where each option lives.
+Option values are sliced out when they are actually accessed.
+
+Replies are encoded into a preallocated bytearray, which is reused from
+one reply to the next.
+"""
+
+import struct
+
+__all__ = ['BootpCodecError', 'BootpPacket', 'BootpOptions', 'BootpEncoder',
+           'decode_packet']
+
+BOOTREQUEST = 1
+BOOTREPLY = 2
+
+BOOTP_FLAGS_NONE = 0
+BOOTP_FLAGS_BROADCAST = 1<<15
+
+COOKIE = '\x63\x82\x53\x63'
+
+# op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr,
+# chaddr
+BOOTP_HEADER = struct.Struct('!BBBBIHH4s4s4s4s16s')
+BOOTP_GIADDR_OFFSET = 24
+BOOTP_SNAME_OFFSET = BOOTP_HEADER.size
+BOOTP_SNAME_SIZE = 64
+BOOTP_FILE_OFFSET = BOOTP_SNAME_OFFSET + BOOTP_SNAME_SIZE
+BOOTP_FILE_SIZE = 128
+BOOTP_COOKIE_OFFSET = BOOTP_FILE_OFFSET + BOOTP_FILE_SIZE
+BOOTP_OPTIONS_OFFSET = BOOTP_COOKIE_OFFSET + len(COOKIE)
+# Legacy BOOTP clients and some relays discard shorter replies
+BOOTP_MIN_SIZE = 300
+# Largest datagram a DHCP client is required to accept (RFC 2131)
+BOOTP_MAX_SIZE = 576
+
+DHCP_OPTIONS = {  0: 'Byte padding',
+                  1: 'Subnet mask',
+                  2: 'Time offset',
+                  3: 'Routers',
+                  4: 'Time servers',
+                  5: 'Name servers',
+                  6: 'Domain name servers',
+                  7: 'Log servers',
+                  8: 'Cookie servers',
+                  9: 'Line printer servers',
+                 10: 'Impress servers',
+                 11: 'Resource location servers',
+                 12: 'Host Name', # + PXE extensions
+                 13: 'Boot file size',
+                 14: 'Dump file',
+                 15: 'Domain name',
+                 16: 'Swap server',
+                 17: 'Root path',
+                 18: 'Extensions path',
+                 # --- IP layer / host ---
+                 19: 'IP forwarding',
+                 20: 'Source routing',
+                 21: 'Policy filter',
+                 22: 'Maximum datagram reassembly size',
+                 23: 'Default IP TTL',
+                 24: 'Path MTU aging timeout',
+                 25: 'Path MTU plateau table',
+                 # --- IP Layer / interface ---
+                 26: 'Interface MTU',
+                 27: 'All subnets local',
+                 28: 'Broadcast address',
+                 29: 'Perform mask discovery',
+                 30: 'Mask supplier',
+                 31: 'Perform router discovery',
+                 32: 'Router solicitation address',
+                 33: 'Static route',
+                 # --- Link layer ---
+                 34: 'Trailer encapsulation',
+                 35: 'ARP cache timeout',
+                 36: 'Ethernet encaspulation',
+                 # --- TCP ---
+                 37: 'TCP default TTL',
+                 38: 'TCP keepalive interval',
+                 39: 'TCP keepalive garbage',
+                 # --- Application & Services ---
+                 40: 'Network Information Service domain',
+                 41: 'Network Information servers',
+                 42: 'Network Time Protocol servers',
+                 43: 'Vendor specific',
+                 44: 'NetBIOS over TCP/IP name server',
+                 45: 'NetBIOS over TCP/IP datagram server',
+                 46: 'NetBIOS over TCP/IP node type',
+                 47: 'NetBIOS over TCP/IP scope',
+                 48: 'X Window system font server',
+                 49: 'X Window system display manager',
+                 50: 'Requested IP address',
+                 51: 'IP address lease time',
+                 52: 'Option overload',
+                 53: 'DHCP message',
+                 54: 'Server ID',
+                 55: 'Param request list',
+                 56: 'Error message',
+                 57: 'Message length',
+                 58: 'Renewal time',
+                 59: 'Rebinding time',
+                 60: 'Class ID',
+                 61: 'GUID',
+                 64: 'Network Information Service+ domain',
+                 65: 'Network Information Service+ servers',
+                 66: 'TFTP server name',
+                 67: 'Bootfile name',
+                 68: 'Mobile IP home agent',
+                 69: 'Simple Mail Transport Protocol servers',
+                 70: 'Post Office Protocol servers',
+                 71: 'Network News Transport Protocol servers',
+                 72: 'World Wide Web servers',
+                 73: 'Finger servers',
+                 74: 'Internet Relay Chat server',
+                 77: 'User Class',
+                 93: 'System architecture',
+                 94: 'Network type',
+                 97: 'UUID',
+                 175: 'iPXE encap opts',
+                 255: 'End of DHCP options' }
+
+DHCP_DISCOVER = 1
+DHCP_OFFER = 2
+DHCP_REQUEST = 3
+DHCP_DECLINE = 4
+DHCP_ACK = 5
+DHCP_NAK = 6
+DHCP_RELEASE = 7
+DHCP_INFORM = 8
+DHCP_RENEWING = 100
+
+DHCP_MESSAGES = {DHCP_DISCOVER: 'DISCOVER', DHCP_OFFER: 'OFFER',
+                 DHCP_REQUEST: 'REQUEST', DHCP_DECLINE: 'DECLINE',
+                 DHCP_ACK: 'ACK', DHCP_NAK: 'NAK', DHCP_RELEASE: 'RELEASE',
+                 DHCP_INFORM: 'INFORM'}
+
+DHCP_PAD = 0
+DHCP_IP_MASK = 1
+DHCP_IP_GATEWAY = 3
+DHCP_IP_DNS = 6
+DHCP_HOSTNAME = 12
+DHCP_LEASE_TIME = 51
+DHCP_OVERLOAD = 52
+DHCP_MSG = 53
+DHCP_SERVER = 54
+DHCP_CLASS_ID = 60
+DHCP_VENDOR = 43
+DHCP_USER_CLASS = 77
+DHCP_CLIENT_ARCH = 93
+DHCP_UUID = 97
+DHCP_IPXE_ENCAP = 175
+DHCP_END = 255
+
+PXE_DISCOVERY_CONTROL = 6
+DISCOVERY_MCAST_ADDR = 7
+PXE_BOOT_SERVERS = 8
+PXE_BOOT_MENU = 9
+PXE_MENU_PROMPT = 10
+
+# client system architectures (option 93), by name
+CLIENT_ARCHITECTURES = {'bios': 0x00, 'efi-ia32': 0x06, 'efi-bc': 0x07,
+                        'efi-x64': 0x09, 'efi-arm32': 0x0a,
+                        'efi-arm64': 0x0b, 'efi-ia32-http': 0x0f,
+                        'efi-x64-http': 0x10, 'efi-bc-http': 0x11,
+                        'efi-arm32-http': 0x12, 'efi-arm64-http': 0x13,
+                        'bios-http': 0x14}
+# architectures of the clients booting from an HTTP URL
+HTTP_BOOT_ARCHITECTURES = frozenset([arch for name, arch in
+                                     CLIENT_ARCHITECTURES.iteritems()
+                                     if name.endswith('-http')])
+
+# option overload (52) flags
+_OVERLOAD_FILE = 1
+_OVERLOAD_SNAME = 2
+
+_BYTE_OPTION = struct.Struct('!BBB')
+_IP_OPTION = struct.Struct('!BB4s')
+_INT_OPTION = struct.Struct('!BBI')
+_OPTION_HEADER = struct.Struct('!BB')
+_SNAME_FILE = struct.Struct('!%ds%ds4s' % (BOOTP_SNAME_SIZE, BOOTP_FILE_SIZE))
+_PADDING = memoryview(bytearray(BOOTP_MIN_SIZE))
+
+
+class BootpCodecError(Exception):
+    """Malformed BOOTP/DHCP packet"""
+    pass
+
+
+def _scan_options(buf, pos, end, offsets):
+    """Record the location of each option found in buf[pos:end]
+
+       Only the (offset, length) pair of each option is stored, values are
+       left in place. Returns the option overload flags, if any.
+    """
+    while pos < end:
+        tag = ord(buf[pos])
+        if tag == DHCP_PAD:
+            pos += 1
+            continue
+        if tag == DHCP_END:
+            break
+        if pos+1 >= end:
+            raise BootpCodecError('Truncated option %d' % tag)
+        length = ord(buf[pos+1])
+        pos += 2
+        if pos+length > end:
+            raise BootpCodecError('Option %d overflows packet (%d bytes)' % \
+                                  (tag, length))
+        # first instance wins, as most clients never split options
+        if tag not in offsets:
+            offsets[tag] = (pos, length)
+        pos += length
+    overload = offsets.get(DHCP_OVERLOAD)
+    if overload and overload[1]:
+        return ord(buf[overload[0]])
+    return 0
+
+
+class BootpOptions(object):
+    """Lazy, read-only mapping of DHCP options
+
+       Values are extracted from the underlying packet buffer on access.
+    """
+
+    __slots__ = ('_buf', '_offsets')
+
+    def __init__(self, buf, offsets):
+        self._buf = buf
+        self._offsets = offsets
+
+    def __contains__(self, tag):
+        return tag in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __getitem__(self, tag):
+        start, length = self._offsets[tag]
+        return self._buf[start:start+length].tobytes()
+
+    def get(self, tag, default=None):
+        try:
+            return self[tag]
+        except KeyError:
+            return default
+
+    def get_byte(self, tag, default=None):
+        """Return the first byte of an option as an integer"""
+        location = self._offsets.get(tag)
+        if not location or not location[1]:
+            return default
+        return ord(self._buf[location[0]])
+
+    def length(self, tag):
+        """Return the length of an option, without extracting it"""
+        return self._offsets[tag][1]
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def iteritems(self):
+        for tag in self._offsets:
+            yield tag, self[tag]
+
+
+class BootpPacket(object):
+    """Decoded BOOTP/DHCP packet
+
+       Fixed header fields are available as attributes, the server name
+       and boot file fields and the DHCP options are decoded lazily.
+    """
+
+    __slots__ = ('op', 'htype', 'hlen', 'hops', 'xid', 'secs', 'flags',
+                 'ciaddr', 'yiaddr', 'siaddr', 'giaddr', 'chaddr',
+                 'options', '_buf')
+
+    def __init__(self, data):
+        buf = memoryview(data)
+        size = len(buf)
+        if size < BOOTP_OPTIONS_OFFSET:
+            raise BootpCodecError('Packet too small (%d bytes)' % size)
+        (self.op, self.htype, self.hlen, self.hops, self.xid, self.secs,
+         self.flags, self.ciaddr, self.yiaddr, self.siaddr, self.giaddr,
+         self.chaddr) = BOOTP_HEADER.unpack_from(buf)
+        self._buf = buf
+        offsets = {}
+        if buf[BOOTP_COOKIE_OFFSET:BOOTP_OPTIONS_OFFSET].tobytes() == COOKIE:
+            overload = _scan_options(buf, BOOTP_OPTIONS_OFFSET, size, offsets)
+            if overload & _OVERLOAD_FILE:
+                _scan_options(buf, BOOTP_FILE_OFFSET,
+                              BOOTP_FILE_OFFSET+BOOTP_FILE_SIZE, offsets)
+            if overload & _OVERLOAD_SNAME:
+                _scan_options(buf, BOOTP_SNAME_OFFSET,
+                              BOOTP_SNAME_OFFSET+BOOTP_SNAME_SIZE, offsets)
+        self.options = BootpOptions(buf, offsets)
+
+    @property
+    def mac(self):
+        """Hardware address, as raw bytes"""
+        return self.chaddr[:min(self.hlen, 16) or 6]
+
+    @property
+    def sname(self):
+        return self._cstring(BOOTP_SNAME_OFFSET, BOOTP_SNAME_SIZE)
+
+    @property
+    def file(self):
+        return self._cstring(BOOTP_FILE_OFFSET, BOOTP_FILE_SIZE)
+
+    def _cstring(self, offset, size):
+        value = self._buf[offset:offset+size].tobytes()
+        end = value.find('\x00')
+        return end < 0 and value or value[:end]
+
+
+def decode_packet(data):
+    """Decode a received datagram into a BootpPacket"""
+    return BootpPacket(data)
+
+
+class BootpEncoder(object):
+    """Encode BOOTP/DHCP replies into a reusable preallocated buffer
+
+       An encoder is not thread safe: each serving thread should own one.
+    """
+
+    def __init__(self, size=BOOTP_MAX_SIZE):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._size = size
+        self._pos = 0
+        self._mark = None
+
+    def begin(self, request, yiaddr, siaddr, giaddr, flags=BOOTP_FLAGS_NONE,
+              ciaddr=None, sname='', bootfile=''):
+        """Start a new reply to a request, writing the fixed header"""
+        buf = self._buf
+        BOOTP_HEADER.pack_into(buf, 0, BOOTREPLY, request.htype,
+                               request.hlen, request.hops, request.xid, 0,
+                               flags,
+                               ciaddr is None and request.ciaddr or ciaddr,
+                               yiaddr, siaddr, giaddr, request.chaddr)
+        # fields are null-padded, which also clears any previous reply
+        _SNAME_FILE.pack_into(buf, BOOTP_SNAME_OFFSET, sname, bootfile,
+                              COOKIE)
+        self._pos = BOOTP_OPTIONS_OFFSET
+        self._mark = None
+
+    def _reserve(self, length):
+        pos = self._pos
+        # always keep room for the end option
+        if pos+length >= self._size:
+            raise BootpCodecError('Reply exceeds %d bytes' % self._size)
+        self._pos = pos+length
+        return pos
+
+    def add_option(self, tag, value):
+        """Append an option with a raw string value"""
+        length = len(value)
+        if length > 255:
+            raise BootpCodecError('Option %d is too long (%d bytes)' % \
+                                  (tag, length))
+        pos = self._reserve(2+length)
+        _OPTION_HEADER.pack_into(self._buf, pos, tag, length)
+        self._buf[pos+2:pos+2+length] = value
+
+    def add_byte(self, tag, value):
+        _BYTE_OPTION.pack_into(self._buf, self._reserve(3), tag, 1, value)
+
+    def add_ip(self, tag, value):
+        """Append an option with a packed IPv4 address value"""
+        _IP_OPTION.pack_into(self._buf, self._reserve(6), tag, 4, value)
+
+    def add_ips(self, tag, values):
+        """Append an option with a list of packed IPv4 addresses"""
+        self.add_option(tag, ''.join(values))
+
+    def add_int(self, tag, value):
+        _INT_OPTION.pack_into(self._buf, self._reserve(6), tag, 4, value)
+
+    def begin_option(self, tag):
+        """Open an option whose value is built from encapsulated options
+
+           Options appended until end_option() is called are written
+           inside the value of this option.
+        """
+        if self._mark is not None:
+            raise BootpCodecError('Nested encapsulated options')
+        self._mark = self._reserve(2)
+        self._buf[self._mark] = tag
+
+    def end_option(self):
+        mark = self._mark
+        length = self._pos-mark-2
+        if length > 255:
+            raise BootpCodecError('Option %d is too long (%d bytes)' % \
+                                  (self._buf[mark], length))
+        self._buf[mark+1] = length
+        self._mark = None
+
+    def rollback(self, pos):
+        """Discard every option written after position pos"""
+        self._pos = pos
+        self._mark = None
+
+    def tell(self):
+        return self._pos
+
+    def end(self):
+        """Terminate the option list, returning a view on the reply
+
+           The view is only valid until the next call to begin().
+        """
+        buf = self._buf
+        pos = self._pos
+        buf[pos] = DHCP_END
+        pos += 1
+        if pos < BOOTP_MIN_SIZE:
+            self._view[pos:BOOTP_MIN_SIZE] = _PADDING[pos:BOOTP_MIN_SIZE]
+            pos = BOOTP_MIN_SIZE
+        self._pos = pos
+        return self._view[:pos]
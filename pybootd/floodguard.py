@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Protection against retransmissions and request floods
+
+PXE ROMs retransmit their requests with the same transaction identifier
+(xid): the reply cache answers them with the bytes of the first reply,
+without processing the request again.
+
+Rate limiting relies on token buckets, one per client MAC address and an
+optional global one, refilled at a steady rate up to a burst size.
+"""
+
+from collections import OrderedDict
+
+__all__ = ['ReplyCache', 'RateLimiter']
+
+REPLY_CACHE_MAX_ENTRIES = 16384
+RATE_LIMIT_MAX_CLIENTS = 65536
+
+
+class ReplyCache(object):
+    """Recently sent replies, keyed by (chaddr, xid, message type, ...)
+
+       Entries share the same time to live: kept in insertion order, they
+       expire from the oldest one on, which is also the one evicted when
+       the cache is full.
+    """
+
+    def __init__(self, ttl, max_entries=REPLY_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key request key, value (expiry, data, address)
+        self._entries = OrderedDict()
+        self._clients = {} # key chaddr, value request keys
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        """Return the cached (data, address) reply to a request, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            self._remove(key)
+            return None
+        return entry[1:]
+
+    def put(self, key, data, address, now):
+        if key in self._entries:
+            # renewed entries move to the end
+            self._remove(key)
+        self._purge(now)
+        self._entries[key] = (now+self.ttl, data, address)
+        self._clients.setdefault(key[0], set()).add(key)
+
+    def discard(self, chaddr):
+        """Forget every reply sent to a client"""
+        for key in self._clients.pop(chaddr, ()):
+            del self._entries[key]
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self._clients = {}
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._clients[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._clients[key[0]]
+
+    def _purge(self, now):
+        """Drop the expired entries, and the oldest ones beyond the size"""
+        entries = self._entries
+        while entries:
+            key = next(iter(entries))
+            if entries[key][0] >= now and len(entries) < self.max_entries:
+                break
+            self._remove(key)
+
+
+class RateLimiter(object):
+    """Per-client and global token buckets
+
+       A null rate disables the matching limit. Buckets are kept in the
+       order of their last update: when the table is full, the buckets of
+       the clients idle for the longest time, the closest to full again,
+       are evicted first.
+    """
+
+    def __init__(self, rate, burst, global_rate=0, global_burst=0,
+                 max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.rate = float(rate or 0)
+        self.burst = float(burst or max(self.rate, 1))
+        self.global_rate = float(global_rate or 0)
+        self.global_burst = float(global_burst or max(self.global_rate, 1))
+        self.max_clients = max_clients
+        self._buckets = OrderedDict() # key client, value [tokens, last update]
+        self._global = [self.global_burst, 0.0]
+
+    def __nonzero__(self):
+        return bool(self.rate or self.global_rate)
+
+    def allow(self, client, now):
+        """Tell whether a request may be served, consuming a token"""
+        bucket = None
+        if self.rate:
+            buckets = self._buckets
+            bucket = buckets.pop(client, None)
+            if bucket is None:
+                while len(buckets) >= self.max_clients:
+                    buckets.popitem(False)
+                bucket = [self.burst, now]
+            buckets[client] = bucket
+            tokens = min(self.burst, bucket[0] + (now-bucket[1])*self.rate)
+            bucket[:] = [tokens, now]
+            if tokens < 1.0:
+                return False
+        if self.global_rate:
+            gbucket = self._global
+            tokens = min(self.global_burst,
+                         gbucket[0] + (now-gbucket[1])*self.global_rate)
+            gbucket[:] = [tokens, now]
+            if tokens < 1.0:
+                return False
+            gbucket[0] -= 1.0
+        if bucket:
+            bucket[0] -= 1.0
+        return True
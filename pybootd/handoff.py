@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Handoff of the listening sockets to a new server process
+
+A server started with a handoff path first connects to the Unix socket
+of that path. If a server already listens there, it passes its listening
+sockets over, as file descriptors (SCM_RIGHTS), along with the state of
+its BOOTP clients. It then stops reading requests, lets the transfers in
+progress complete, and exits. The new server reads from the very same
+sockets, so that no request is lost in between, and listens to the path
+in turn, ready for the next upgrade:
+
+    pybootd -c pybootd.yaml --handoff /run/pybootd.sock
+
+Should the new server fail before it acknowledges the sockets, the old
+one resumes serving.
+"""
+
+import _multiprocessing
+import errno
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+__all__ = ['Handoff', 'HandoffError']
+
+HANDOFF_TIMEOUT = 10.0
+HANDOFF_DRAIN_TIMEOUT = 300.0
+
+_LENGTH = struct.Struct('!I')
+
+
+class HandoffError(Exception):
+    """Socket handoff error"""
+    pass
+
+
+def _recv_exactly(sock, size):
+    parts = []
+    while size:
+        data = sock.recv(size)
+        if not data:
+            raise HandoffError('Connection closed')
+        parts.append(data)
+        size -= len(data)
+    return ''.join(parts)
+
+
+class Handoff(object):
+    """Sockets and state passed from a server process to its successor
+
+       Servers take the sockets inherited from the previous process, if
+       any, and register the sockets they listen to, for the next one.
+       Registered servers are paused during a handoff, with pause(), and
+       drained afterwards, until their active() count drops to zero, then
+       stopped with stop().
+    """
+
+    def __init__(self, logger, path, drain_timeout=HANDOFF_DRAIN_TIMEOUT):
+        self.log = logger
+        self.path = path
+        self.drain_timeout = drain_timeout
+        self.state = {} # key server name, value state from the old process
+        self.finished = threading.Event()
+        self._inherited = {} # key (kind, address), value socket
+        self._sockets = [] # (kind, address, socket) to hand over
+        self._servers = [] # (name, server)
+        self._listener = None
+
+    # New process side
+
+    def receive(self):
+        """Take the sockets over from a running server, if any"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(HANDOFF_TIMEOUT)
+        try:
+            try:
+                sock.connect(self.path)
+            except socket.error, e:
+                if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                    return False
+                raise
+            length = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))[0]
+            header = json.loads(_recv_exactly(sock, length))
+            # descriptors travel with a single byte, read without timeout
+            sock.settimeout(None)
+            for kind, host, port, socktype in header['sockets']:
+                fd = _multiprocessing.recvfd(sock.fileno())
+                try:
+                    self._inherited[(kind, (str(host), port))] = \
+                        socket.fromfd(fd, socket.AF_INET, socktype)
+                finally:
+                    os.close(fd)
+            self.state = header.get('state') or {}
+            sock.sendall('ok')
+        except (socket.error, OSError, ValueError, KeyError, TypeError,
+                HandoffError), e:
+            for inherited in self._inherited.values():
+                inherited.close()
+            self._inherited = {}
+            raise HandoffError('Cannot take over from %s: %s' % \
+                               (self.path, e))
+        finally:
+            sock.close()
+        self.log.info('Took %d sockets over from the running server' % \
+                      len(self._inherited))
+        return True
+
+    def take(self, kind, address):
+        """Return the inherited socket of an address, or None"""
+        return self._inherited.pop((kind, address), None)
+
+    def release(self):
+        """Close the inherited sockets no server took"""
+        for (kind, address), sock in self._inherited.items():
+            self.log.info('Closing %s socket %s:%d, no longer used' % \
+                          ((kind,) + address))
+            sock.close()
+        self._inherited = {}
+
+    # Old process side
+
+    def register(self, kind, address, sock):
+        """Record a listening socket, to hand it over"""
+        self._sockets.append((kind, address, sock))
+
+    def add_server(self, name, server):
+        self._servers.append((name, server))
+
+    def listen(self):
+        """Wait for a new process to hand the sockets over to"""
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen(1)
+        worker = threading.Thread(target=self._serve, name='Handoff')
+        worker.daemon = True
+        worker.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                if self._hand_over(conn):
+                    break
+            finally:
+                conn.close()
+        self._listener.close()
+        self._drain()
+        # the server threads end before the process does
+        for name, server in self._servers:
+            if hasattr(server, 'stop'):
+                server.stop()
+        self.finished.set()
+
+    def _pause(self, paused):
+        for name, server in self._servers:
+            server.pause(paused)
+
+    def _hand_over(self, conn):
+        self.log.info('Handing the sockets over to a new process')
+        conn.settimeout(HANDOFF_TIMEOUT)
+        self._pause(True)
+        try:
+            state = dict([(name, server.export_state()) for name, server in
+                          self._servers if hasattr(server, 'export_state')])
+            header = json.dumps({'sockets': [[kind, address[0], address[1],
+                                              sock.type] for
+                                             kind, address, sock in
+                                             self._sockets],
+                                 'state': state})
+            conn.sendall(_LENGTH.pack(len(header)) + header)
+            for kind, address, sock in self._sockets:
+                _multiprocessing.sendfd(conn.fileno(), sock.fileno())
+            if _recv_exactly(conn, 2) != 'ok':
+                raise HandoffError('Unexpected reply')
+        except (socket.error, OSError, HandoffError), e:
+            self.log.error('Handoff failed, resuming: %s' % e)
+            self._pause(False)
+            return False
+        return True
+
+    def _drain(self):
+        deadline = time.time() + self.drain_timeout
+        logged = None
+        while True:
+            active = sum([server.active() for name, server in self._servers
+                          if hasattr(server, 'active')])
+            if not active:
+                break
+            if time.time() >= deadline:
+                self.log.warn('Abandoning %d transfers in progress' % active)
+                break
+            if active != logged:
+                self.log.info('Waiting for %d transfers in progress' % \
+                              active)
+                logged = active
+            time.sleep(0.5)
+        self.log.info('Handoff complete')
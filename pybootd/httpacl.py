@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Remote ('http') access control
+
+Decisions are fetched from an inventory service, configured in the
+'http' section:
+
+    http:
+        url: http://inventory.example.com/pxe?mac={mac}&uuid={uuid}
+        timeout: 1.0
+        ttl: 300
+        negative_ttl: 60
+
+A 200 reply allows the client, 403 and 404 replies deny it. Any other
+outcome is an error, which denies the client for 'error_ttl' seconds.
+
+Lookups never run in the BOOTP serving thread: a cache miss queues the
+MAC address for a small set of worker threads, each owning a persistent
+(keep-alive) connection to the service, and the request is dropped. The
+client retransmission is then answered from the cache. Misses for a MAC
+address whose lookup is already pending are coalesced. Beyond
+'max_entries' decisions, the oldest ones are evicted first.
+"""
+
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from collections import OrderedDict
+from Queue import Queue, Full
+
+__all__ = ['HttpAccessControl', 'HttpAclError']
+
+HTTP_ACL_TIMEOUT = 1.0
+HTTP_ACL_TTL = 300
+HTTP_ACL_NEGATIVE_TTL = 60
+HTTP_ACL_ERROR_TTL = 5
+HTTP_ACL_WORKERS = 4
+HTTP_ACL_MAX_PENDING = 4096
+HTTP_ACL_MAX_ENTRIES = 100000
+
+
+class HttpAclError(Exception):
+    """Remote access control error"""
+    pass
+
+
+class HttpAccessControl(object):
+    """Cached, asynchronous access control backed by an HTTP service"""
+
+    def __init__(self, logger, settings):
+        self.log = logger
+        try:
+            self.url = settings['url']
+        except (KeyError, TypeError):
+            raise HttpAclError("Missing 'url' in http section")
+        parts = urlparse.urlsplit(self.url)
+        if parts.scheme not in ('http', 'https'):
+            raise HttpAclError('Unsupported URL: %s' % self.url)
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        query = parts.query
+        if '{mac}' not in self.url:
+            query = '&'.join([q for q in (query, 'mac={mac}') if q])
+        self._path = urlparse.urlunsplit(('', '', parts.path or '/',
+                                          query, ''))
+        self.timeout = float(settings.get('timeout', HTTP_ACL_TIMEOUT))
+        self.ttl = float(settings.get('ttl', HTTP_ACL_TTL))
+        self.negative_ttl = float(settings.get('negative_ttl',
+                                               HTTP_ACL_NEGATIVE_TTL))
+        self.error_ttl = float(settings.get('error_ttl', HTTP_ACL_ERROR_TTL))
+        self.max_entries = int(settings.get('max_entries',
+                                            HTTP_ACL_MAX_ENTRIES))
+        # key MAC address string, value (allowed, expiry), oldest first
+        self._cache = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._queue = Queue(int(settings.get('max_pending',
+                                             HTTP_ACL_MAX_PENDING)))
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'lookups': 0,
+                      'errors': 0, 'overflows': 0}
+        self._workers = []
+        for pos in xrange(int(settings.get('workers', HTTP_ACL_WORKERS))):
+            worker = threading.Thread(target=self._worker,
+                                      name='HttpAcl-%d' % pos)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def check(self, mac_str, uuid_str=None):
+        """Return the cached decision for a client
+
+           Returns None when no decision is available yet, in which case a
+           lookup is scheduled, unless one is already in progress.
+        """
+        entry = self._cache.get(mac_str)
+        if entry and entry[1] > time.time():
+            self.stats['hits'] += 1
+            return entry[0]
+        with self._lock:
+            if mac_str in self._pending:
+                self.stats['coalesced'] += 1
+                return None
+            self._pending.add(mac_str)
+        self.stats['misses'] += 1
+        try:
+            self._queue.put_nowait((mac_str, uuid_str))
+        except Full:
+            self.stats['overflows'] += 1
+            with self._lock:
+                self._pending.discard(mac_str)
+        return None
+
+    def invalidate(self, mac_str=None):
+        """Drop the cached decision of a client, or of every client"""
+        with self._lock:
+            if mac_str is None:
+                self._cache = OrderedDict()
+            else:
+                self._cache.pop(mac_str, None)
+
+    def close(self):
+        """Stop the worker threads, once pending lookups are over"""
+        for worker in self._workers:
+            self._queue.put(None)
+        self._workers = []
+
+    def _connect(self):
+        if self._scheme == 'https':
+            return httplib.HTTPSConnection(self._netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self._netloc, timeout=self.timeout)
+
+    def _query(self, conn, mac_str, uuid_str):
+        path = self._path.format(mac=urllib.quote(mac_str),
+                                 uuid=urllib.quote(uuid_str or ''))
+        conn.request('GET', path, headers={'Connection': 'keep-alive'})
+        response = conn.getresponse()
+        # the body has to be consumed to reuse the connection
+        response.read()
+        if response.status == httplib.OK:
+            return True
+        if response.status in (httplib.FORBIDDEN, httplib.NOT_FOUND):
+            return False
+        raise HttpAclError('Unexpected reply %d' % response.status)
+
+    def _worker(self):
+        conn = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            mac_str, uuid_str = item
+            try:
+                self.stats['lookups'] += 1
+                while True:
+                    fresh = not conn
+                    if fresh:
+                        conn = self._connect()
+                    try:
+                        allowed = self._query(conn, mac_str, uuid_str)
+                        break
+                    except (httplib.HTTPException, socket.error):
+                        # the service may have closed an idle connection
+                        conn.close()
+                        conn = None
+                        if fresh:
+                            raise
+                ttl = allowed and self.ttl or self.negative_ttl
+                self.log.info('Access %s for %s' % \
+                              (allowed and 'granted' or 'denied', mac_str))
+            except Exception, e:
+                self.stats['errors'] += 1
+                self.log.error('Access lookup failed for %s: %s' % \
+                               (mac_str, e))
+                if conn:
+                    conn.close()
+                    conn = None
+                allowed = False
+                ttl = self.error_ttl
+            with self._lock:
+                self._store(mac_str, (allowed, time.time()+ttl))
+                self._pending.discard(mac_str)
+        if conn:
+            conn.close()
+
+    def _store(self, mac_str, entry):
+        """Cache a decision, evicting the oldest ones beyond the limit;
+           called with the lock held"""
+        cache = self._cache
+        # a renewed decision moves to the end
+        cache.pop(mac_str, None)
+        while len(cache) >= self.max_entries:
+            cache.popitem(False)
+        cache[mac_str] = entry
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""HTTP boot server
+
+Serves the TFTP root to iPXE and UEFI HTTP Boot clients, configured in
+the 'httpboot' section:
+
+    httpboot:
+        bind_interface: eth0
+        port: 8080
+
+Requested names go through the file filters of the TFTP server, so
+that a client gets the same per-client files over both protocols.
+Persistent (keep-alive) connections and single range requests are
+supported. Files are sent with the sendfile system call when the
+'pysendfile' module is installed, and copied otherwise.
+"""
+
+import errno
+import os
+import posixpath
+import re
+import select
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from pybootd import PRODUCT_NAME, __version__ as VERSION
+from stats import REGISTRY
+from tftpd import FileFilters, TftpError
+from util import get_iface_configs
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+__all__ = ['HttpBootServer', 'HttpBootError']
+
+HTTP_BOOT_KEEPALIVE = 30.0
+HTTP_BOOT_CHUNK = 1 << 20
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class HttpBootError(Exception):
+    """HTTP boot server error"""
+    pass
+
+
+class HttpBootHandler(BaseHTTPRequestHandler):
+    """Serve files of the boot root, with range and keep-alive support"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = '%s/%s' % (PRODUCT_NAME, VERSION)
+    timeout = HTTP_BOOT_KEEPALIVE # idle time of persistent connections
+
+    def log_message(self, format, *args):
+        self.server.service.log.info('%s %s' % (self.client_address[0],
+                                                format % args))
+
+    def log_request(self, code='-', size='-'):
+        self.server.service.requests.inc(str(code))
+        BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def serve(self, body):
+        service = self.server.service
+        root = service.get_root()
+        path = service.map_path(urlparse.urlsplit(self.path).path,
+                                self.client_address[0])
+        if path and service.is_url(root):
+            # the boot files are not local, let the client fetch them
+            self.send_response(302)
+            self.send_header('Location', '%s/%s' % (root.rstrip('/'),
+                                                    urllib.quote(path)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        filename = path and service.resolve(root, path)
+        try:
+            if not filename or not os.path.isfile(filename):
+                raise IOError(errno.ENOENT, 'Not found')
+            fobj = open(filename, 'rb')
+        except IOError, e:
+            code = e.errno == errno.EACCES and 403 or 404
+            self.send_error(code)
+            return
+        try:
+            stat = os.fstat(fobj.fileno())
+            size = stat.st_size
+            first, last = 0, size-1
+            code = 200
+            rng = self.headers.get('Range')
+            mo = rng and _RANGE.match(rng.strip())
+            if mo and (mo.group(1) or mo.group(2)):
+                if mo.group(1):
+                    first = int(mo.group(1))
+                    if mo.group(2):
+                        last = min(int(mo.group(2)), size-1)
+                else:
+                    # suffix range: the last bytes of the file
+                    first = max(0, size-int(mo.group(2)))
+                if first > last:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                code = 206
+            length = last-first+1
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified',
+                             self.date_time_string(stat.st_mtime))
+            if code == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % \
+                                 (first, last, size))
+            self.end_headers()
+            if body and length:
+                self.copy(fobj, first, length)
+                service.sent.add(length)
+        finally:
+            fobj.close()
+
+    def copy(self, fobj, offset, length):
+        self.wfile.flush()
+        if sendfile is None:
+            fobj.seek(offset)
+            while length > 0:
+                chunk = fobj.read(min(length, HTTP_BOOT_CHUNK))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                length -= len(chunk)
+            return
+        sock = self.connection
+        while length > 0:
+            try:
+                sent = sendfile(sock.fileno(), fobj.fileno(), offset,
+                                min(length, HTTP_BOOT_CHUNK))
+            except OSError, e:
+                # the socket has a timeout, hence is non-blocking
+                if e.errno != errno.EAGAIN:
+                    raise
+                r, w, x = select.select([], [sock], [], self.timeout)
+                if not w:
+                    raise socket.timeout('Send timed out')
+                continue
+            if not sent:
+                break
+            offset += sent
+            length -= sent
+
+
+class _HttpServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service, address, sock=None):
+        self.service = service
+        self.active = 0 # connections being served
+        self._lock = threading.Lock()
+        HTTPServer.__init__(self, address, HttpBootHandler, not sock)
+        if sock:
+            # listening socket of a previous process
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self.active += 1
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class HttpBootServer(object):
+    """HTTP boot server, listening on one or more addresses"""
+
+    def __init__(self, logger, config, bootpd=None, handoff=None):
+        self.log = logger
+        self.config = config
+        self.bootpd = bootpd
+        self.handoff = handoff # sockets of the previous process, if any
+        self.paused = False
+        self._stopped = threading.Event()
+        self.servers = []
+        self.requests = REGISTRY.counter('pybootd_http_requests_total',
+            'HTTP boot requests, by status code', ('code',))
+        self.sent = REGISTRY.counter('pybootd_http_sent_bytes_total',
+            'Bytes of boot files sent over HTTP')
+        self.filters = FileFilters(logger, config.get_filters(), bootpd)
+        self.config.add_reload_listener(self.reload)
+
+    def reload(self, config, diff):
+        if 'filters' not in diff['sections']:
+            return
+        try:
+            self.filters = FileFilters(self.log, config.get_filters(),
+                                       self.bootpd)
+        except TftpError, e:
+            self.log.error('Cannot apply the new filters: %s' % e)
+
+    def get_root(self):
+        return self.config.get_httpboot_root()
+
+    def is_url(self, path):
+        return bool(urlparse.urlsplit(path).scheme)
+
+    def map_path(self, path, client_ip):
+        """Map a request path to the name of the file to serve, relative
+           to the root, or None"""
+        path = posixpath.normpath(urllib.unquote(path)).lstrip('/')
+        if not path or path == '.' or path.startswith('..'):
+            return None
+        if self.filters:
+            path = self.filters.apply(path, client_ip)
+        return path
+
+    def resolve(self, root, path):
+        """Map a file name to a file below the root, or None"""
+        path = posixpath.normpath(path).lstrip('/')
+        if not path or path == '.' or path.startswith('..'):
+            return None
+        root = os.path.realpath(root)
+        filename = os.path.realpath(os.path.join(root, path))
+        # symbolic links may not escape the root either
+        if not filename.startswith(root.rstrip(os.sep) + os.sep):
+            return None
+        return filename
+
+    def bind(self):
+        netconfigs = get_iface_configs(
+                        self.config.get_httpboot_bind_interfaces())
+        if not netconfigs:
+            raise HttpBootError('HTTP boot address not defined')
+        port = int(self.config.get_httpboot_port())
+        for netconfig in netconfigs:
+            address = (netconfig['address'], port)
+            self.log.info('Listening to %s:%s' % address)
+            server = _HttpServer(self, address, self.handoff and
+                                 self.handoff.take('http', address))
+            self.servers.append(server)
+            if self.handoff:
+                self.handoff.register('http', address, server.socket)
+        if self.handoff:
+            self.handoff.add_server('http', self)
+
+    def pause(self, paused=True):
+        """Stop accepting connections, or resume"""
+        self.paused = paused
+
+    def active(self):
+        """Return the number of connections being served"""
+        return sum([server.active for server in self.servers])
+
+    def stop(self):
+        """Stop accepting connections"""
+        self._stopped.set()
+
+    def forever(self):
+        servers = dict([(server.fileno(), server) for server in self.servers])
+        while not self._stopped.isSet():
+            if self.paused:
+                # the sockets are handed over to another process
+                time.sleep(0.1)
+                continue
+            try:
+                r, w, e = select.select(servers.keys(), [], [], 1.0)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            if self.paused:
+                continue
+            for fileno in r:
+                # accept, then serve the connection in its own thread
+                servers[fileno]._handle_request_noblock()
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Static lease inventories
+
+The inventory maps client MAC addresses to their static lease: host name,
+boot file and any extra attribute. It comes from the 'bootp_leases'
+section of the configuration file by default, or from an external file
+declared in the 'inventory' section:
+
+    inventory:
+        type: csv              # csv, jsonl or sqlite
+        path: /var/lib/pybootd/hosts.csv
+
+CSV files hold one host per row, with a header line naming the columns,
+JSON-lines files one JSON object per line. Both need a 'mac' field. SQLite
+databases need a table ('leases' by default, see 'table') with a 'mac'
+column holding canonical XX:XX:XX:XX:XX:XX addresses.
+
+File inventories are only loaded on first use. In memory, MAC addresses
+are kept as integers in a sorted array, next to compact records whose
+boot file and domain strings are interned, as they are shared by many
+hosts.
+"""
+
+import csv
+import json
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from util import normalize_mac, CANONICAL_MAC
+
+__all__ = ['InventoryError', 'LeaseRecord', 'Inventory', 'open_inventory']
+
+INVENTORY_TYPES = ('yaml', 'csv', 'jsonl', 'sqlite')
+
+# MAC addresses need 48 bits
+_MAC_TYPECODE = array('L').itemsize >= 6 and 'L' or 'd'
+
+
+class InventoryError(Exception):
+    """Invalid inventory"""
+    pass
+
+
+def mac_to_int(mac):
+    """Convert a MAC address into an integer"""
+    if not CANONICAL_MAC.match(mac):
+        mac = normalize_mac(mac)
+    return int(mac.replace(':', ''), 16)
+
+
+def _intern(value):
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeError:
+            return value
+    return value and intern(value)
+
+
+class LeaseRecord(object):
+    """Static lease of a host
+
+       Records can be read like the dictionaries of the 'bootp_leases'
+       configuration section.
+    """
+
+    __slots__ = ('hostname', 'boot_file', 'domain', 'extra')
+
+    FIELDS = ('hostname', 'boot_file', 'domain')
+
+    def __init__(self, hostname=None, boot_file=None, extra=None):
+        if isinstance(hostname, unicode):
+            hostname = hostname.encode('utf-8')
+        self.hostname = hostname
+        self.boot_file = _intern(boot_file)
+        self.domain = hostname and \
+            _intern('.'.join(hostname.strip().split('.')[1:])) or None
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data or {})
+        data.pop('mac', None)
+        data.pop('domain', None)
+        hostname = data.pop('hostname', None)
+        boot_file = data.pop('boot_file', None)
+        for key, value in data.items():
+            if value is None or value == '':
+                del data[key]
+        return cls(hostname, boot_file, data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+        else:
+            value = self.extra and self.extra.get(key)
+        return default if value is None else value
+
+    def __eq__(self, other):
+        return isinstance(other, LeaseRecord) and \
+            (self.hostname, self.boot_file, self.extra) == \
+            (other.hostname, other.boot_file, other.extra)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LeaseRecord(%r, %r, %r)' % \
+            (self.hostname, self.boot_file, self.extra)
+
+
+class Inventory(object):
+    """Base class of the inventory backends"""
+
+    name = None
+
+    def get(self, mac):
+        """Return the lease of a MAC address, or None"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def keys(self):
+        """Return the MAC addresses of the inventory, as integers"""
+        raise NotImplementedError
+
+    def stamp(self):
+        """Return a value which changes whenever the inventory does"""
+        return None
+
+    def close(self):
+        pass
+
+    def diff(self, other):
+        """Return the added, removed and changed MAC addresses"""
+        old, new = set(self.keys()), set(other.keys())
+        changed = [mac for mac in old & new if self.get_int(mac) != \
+                   other.get_int(mac)]
+        return ([_int_to_mac(mac) for mac in sorted(new - old)],
+                [_int_to_mac(mac) for mac in sorted(old - new)],
+                [_int_to_mac(mac) for mac in sorted(changed)])
+
+
+def _int_to_mac(value):
+    digits = '%012X' % value
+    return ':'.join([digits[pos:pos+2] for pos in xrange(0, 12, 2)])
+
+
+class TableInventory(Inventory):
+    """In-memory inventory, with leases sorted by MAC address
+
+       Subclasses provide the rows, as (mac, dict) pairs, from _rows().
+    """
+
+    def __init__(self):
+        self._macs = None
+        self._records = None
+        self._lock = threading.Lock()
+
+    def _rows(self):
+        raise NotImplementedError
+
+    def _ensure_loaded(self):
+        if self._macs is None:
+            with self._lock:
+                if self._macs is None:
+                    self._build()
+        return self._macs
+
+    def _build(self):
+        entries = []
+        for mac, data in self._rows():
+            try:
+                entries.append((mac_to_int(str(mac)),
+                                LeaseRecord.from_dict(data)))
+            except (ValueError, TypeError), e:
+                raise InventoryError('%s: %s' % (self.name, e))
+        entries.sort(key=lambda entry: entry[0])
+        macs = array(_MAC_TYPECODE, [mac for mac, _ in entries])
+        for pos in xrange(1, len(macs)):
+            if macs[pos] == macs[pos-1]:
+                raise InventoryError('%s: duplicate MAC address %s' % \
+                                     (self.name, _int_to_mac(macs[pos])))
+        self._records = [record for _, record in entries]
+        self._macs = macs
+
+    def load(self):
+        """Load the inventory now, rather than on first use"""
+        self._ensure_loaded()
+        return self
+
+    def export(self):
+        """Return the loaded table, as plain marshallable values"""
+        macs = self._ensure_loaded()
+        return (macs.typecode, macs.tostring(),
+                [(record.hostname, record.boot_file, record.extra)
+                 for record in self._records])
+
+    def restore(self, state):
+        """Load a table returned by export(), skipping validation"""
+        typecode, data, records = state
+        if typecode != _MAC_TYPECODE:
+            raise InventoryError('%s: incompatible table' % self.name)
+        macs = array(typecode)
+        macs.fromstring(data)
+        with self._lock:
+            self._records = [LeaseRecord(*record) for record in records]
+            self._macs = macs
+        return self
+
+    def get_int(self, key):
+        macs = self._ensure_loaded()
+        pos = bisect_left(macs, key)
+        if pos < len(macs) and macs[pos] == key:
+            return self._records[pos]
+        return None
+
+    def get(self, mac):
+        try:
+            return self.get_int(mac_to_int(mac))
+        except ValueError:
+            return None
+
+    def __len__(self):
+        return len(self._ensure_loaded())
+
+    def keys(self):
+        return [int(mac) for mac in self._ensure_loaded()]
+
+
+class YamlInventory(TableInventory):
+    """Leases of the 'bootp_leases' configuration section"""
+
+    name = 'bootp_leases'
+
+    def __init__(self, leases):
+        TableInventory.__init__(self)
+        self._leases = leases or {}
+
+    def _rows(self):
+        return self._leases.iteritems()
+
+
+class FileInventory(TableInventory):
+    """Leases loaded from an external file"""
+
+    def __init__(self, path):
+        TableInventory.__init__(self)
+        self.path = path
+        self.name = path
+        self._stamp = self.stamp()
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError, e:
+            raise InventoryError('Cannot access inventory: %s' % e)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+class CsvInventory(FileInventory):
+
+    def _rows(self):
+        with open(self.path, 'rb') as csvfile:
+            for row in csv.DictReader(csvfile, skipinitialspace=True):
+                if 'mac' not in row:
+                    raise InventoryError("%s: no 'mac' column" % self.path)
+                yield row['mac'], row
+
+
+class JsonLinesInventory(FileInventory):
+
+    def _rows(self):
+        with open(self.path, 'rb') as jsonfile:
+            for lineno, line in enumerate(jsonfile, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                    yield row['mac'], row
+                except (ValueError, KeyError, TypeError), e:
+                    raise InventoryError('%s:%d: %s' % (self.path, lineno, e))
+
+
+class SqliteInventory(FileInventory):
+    """Leases looked up one at a time in a SQLite database
+
+       Nothing is kept in memory, each thread uses its own connection.
+    """
+
+    def __init__(self, path, table='leases'):
+        FileInventory.__init__(self, path)
+        if not table.replace('_', '').isalnum():
+            raise InventoryError('Invalid table name: %s' % table)
+        self.table = table
+        self._local = threading.local()
+
+    def _cursor(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn.cursor()
+
+    def get(self, mac):
+        try:
+            mac = normalize_mac(mac)
+        except ValueError:
+            return None
+        cursor = self._cursor()
+        cursor.execute('SELECT * FROM %s WHERE mac = ?' % self.table, (mac,))
+        row = cursor.fetchone()
+        return row and LeaseRecord.from_dict(dict(zip(row.keys(), row)))
+
+    def get_int(self, key):
+        return self.get(_int_to_mac(key))
+
+    def __len__(self):
+        cursor = self._cursor()
+        cursor.execute('SELECT COUNT(*) FROM %s' % self.table)
+        return cursor.fetchone()[0]
+
+    def keys(self):
+        cursor = self._cursor()
+        cursor.execute('SELECT mac FROM %s' % self.table)
+        return [mac_to_int(str(row[0])) for row in cursor]
+
+    def diff(self, other):
+        # a full scan of both databases is too costly to be worth it
+        return ([], [], [])
+
+
+_BACKENDS = {'csv': CsvInventory,
+             'jsonl': JsonLinesInventory,
+             'sqlite': SqliteInventory}
+
+
+def open_inventory(settings, leases=None, previous=None):
+    """Create the inventory described by the 'inventory' section
+
+       An unmodified inventory of a previous configuration is reused, so
+       that a configuration reload does not load the same file again.
+    """
+    settings = settings or {}
+    kind = str(settings.get('type', 'yaml')).lower()
+    if kind not in INVENTORY_TYPES:
+        raise InventoryError('Unknown inventory type: %s' % kind)
+    if kind == 'yaml':
+        return YamlInventory(leases)
+    path = settings.get('path')
+    if not path:
+        raise InventoryError("Missing 'path' for %s inventory" % kind)
+    if type(previous) is _BACKENDS[kind] and previous.path == path and \
+       previous.stamp() == previous._stamp:
+        return previous
+    if kind == 'sqlite':
+        return SqliteInventory(path, settings.get('table', 'leases'))
+    return _BACKENDS[kind](path)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Dynamic IPv4 address pools
+
+Each pool tracks its addresses in a bitmap, one bit per address, so a /16
+range costs 8 KB. A hint on the first byte which may still hold a free
+bit bounds the search for a free address, which then runs at C speed,
+and releasing an address is O(1).
+"""
+
+import re
+
+__all__ = ['PoolError', 'AddressPool']
+
+# locate the first byte with at least one free bit, at C speed
+_NOT_FULL = re.compile('[^\xff]')
+
+# index of the lowest clear bit for each byte value (0xff has none)
+_FIRST_FREE = [0] * 256
+for _byte in xrange(256):
+    for _bit in xrange(8):
+        if not _byte & (1<<_bit):
+            _FIRST_FREE[_byte] = _bit
+            break
+del _byte, _bit
+
+
+class PoolError(Exception):
+    """Address pool error"""
+    pass
+
+
+class AddressPool(object):
+    """Bitmap-backed allocator for a contiguous range of IPv4 addresses
+
+       Addresses are handled as integers, see util.iptoint/inttoip.
+    """
+
+    __slots__ = ('first', 'last', 'size', '_bitmap', '_hint', '_free')
+
+    def __init__(self, first, last, exclude=None):
+        if last < first:
+            raise PoolError('Invalid pool range')
+        self.first = first
+        self.last = last
+        self.size = last-first+1
+        self._bitmap = bytearray((self.size+7)>>3)
+        self._free = self.size
+        # bits past the end of the range are never available
+        tail = self.size & 7
+        if tail:
+            self._bitmap[-1] = 0xff & ~((1<<tail)-1)
+        self._hint = 0
+        for addr in exclude or []:
+            if addr in self:
+                self.reserve(addr)
+
+    def __contains__(self, addr):
+        return self.first <= addr <= self.last
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def free(self):
+        return self._free
+
+    @property
+    def used(self):
+        return self.size-self._free
+
+    def allocate(self):
+        """Allocate the lowest free address, or return None if exhausted"""
+        bitmap = self._bitmap
+        pos = self._hint
+        if bitmap[pos] == 0xff:
+            mo = _NOT_FULL.search(bitmap, pos)
+            if not mo:
+                self._hint = len(bitmap)-1
+                return None
+            pos = mo.start()
+        self._hint = pos
+        byte = bitmap[pos]
+        bit = _FIRST_FREE[byte]
+        bitmap[pos] = byte | (1<<bit)
+        self._free -= 1
+        return self.first + (pos<<3) + bit
+
+    def reserve(self, addr):
+        """Allocate a specific address, return False if already in use"""
+        if addr not in self:
+            raise PoolError('Address out of pool range')
+        offset = addr-self.first
+        pos = offset>>3
+        mask = 1<<(offset&7)
+        if self._bitmap[pos] & mask:
+            return False
+        self._bitmap[pos] |= mask
+        self._free -= 1
+        return True
+
+    def release(self, addr):
+        """Return an address to the pool"""
+        if addr not in self:
+            raise PoolError('Address out of pool range')
+        offset = addr-self.first
+        pos = offset>>3
+        mask = 1<<(offset&7)
+        if not self._bitmap[pos] & mask:
+            return
+        self._bitmap[pos] &= ~mask
+        self._free += 1
+        if pos < self._hint:
+            self._hint = pos
+
+    def is_allocated(self, addr):
+        offset = addr-self.first
+        return bool(self._bitmap[offset>>3] & (1<<(offset&7)))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""DHCP/PXE load generator
+
+Simulates many distinct clients, each one performing a DISCOVER/REQUEST
+exchange against a running BOOTP server, either as a PXE ROM (UUID and
+PXEClient class identifier) or as a plain DHCP client. Results are
+written as JSON, so that runs can be compared from one release to the
+next:
+
+   python -m pybootd.loadgen -s 127.0.0.1 -p 6767 -n 5000 -o result.json
+
+Plain DHCP clients are only answered if the server is configured with
+'allow_simple_dhcp'. Unknown clients need a dynamic pool to be served.
+"""
+
+from optparse import OptionParser
+from benchmarks import percentile
+from dhcpcodec import BootpCodecError, decode_packet, BOOTP_HEADER, \
+     BOOTP_FLAGS_BROADCAST, BOOTP_MAX_SIZE, BOOTREPLY, BOOTREQUEST, COOKIE, \
+     DHCP_ACK, DHCP_CLASS_ID, DHCP_DISCOVER, DHCP_MSG, DHCP_NAK, \
+     DHCP_OFFER, DHCP_REQUEST, DHCP_SERVER, DHCP_UUID, DHCP_END
+from pybootd import __version__ as VERSION
+import json
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+DHCP_REQUESTED_IP = 50
+PXE_CLASS_ID = 'PXEClient:Arch:00000:UNDI:002001'
+
+# client stages
+(ST_DISCOVER, ST_REQUEST, ST_DONE) = range(3)
+
+_ZERO_ADDRESS = '\x00\x00\x00\x00'
+_SNAME_FILE_COOKIE = '\x00' * (64+128) + COOKIE
+
+
+class Client(object):
+    """A simulated DHCP or PXE client"""
+
+    __slots__ = ('mac', 'uuid', 'pxe', 'xid', 'stage', 'sent', 'started',
+                 'retries', 'offer', 'server')
+
+    def __init__(self, mac, pxe, xid):
+        self.mac = mac
+        self.uuid = pxe and ('\x00' + struct.pack('!6s10s', mac, mac[::-1]))
+        self.pxe = pxe
+        self.xid = xid
+        self.stage = ST_DISCOVER
+        self.sent = 0.0
+        self.started = 0.0
+        self.retries = 0
+        self.offer = None
+        self.server = None
+
+    def build(self, msgtype, giaddr=_ZERO_ADDRESS):
+        """Encode the next request of this client"""
+        flags = giaddr == _ZERO_ADDRESS and BOOTP_FLAGS_BROADCAST or 0
+        pkt = [BOOTP_HEADER.pack(BOOTREQUEST, 1, 6, giaddr != _ZERO_ADDRESS,
+                                 self.xid, 0, flags, _ZERO_ADDRESS,
+                                 _ZERO_ADDRESS, _ZERO_ADDRESS, giaddr,
+                                 self.mac), _SNAME_FILE_COOKIE,
+               struct.pack('!BBB', DHCP_MSG, 1, msgtype)]
+        if self.pxe:
+            pkt.append(struct.pack('!BB', DHCP_UUID, len(self.uuid)))
+            pkt.append(self.uuid)
+            pkt.append(struct.pack('!BB', DHCP_CLASS_ID, len(PXE_CLASS_ID)))
+            pkt.append(PXE_CLASS_ID)
+        if msgtype == DHCP_REQUEST:
+            pkt.append(struct.pack('!BB4s', DHCP_REQUESTED_IP, 4, self.offer))
+            if self.server:
+                pkt.append(struct.pack('!BB4s', DHCP_SERVER, 4, self.server))
+        pkt.append(chr(DHCP_END))
+        return ''.join(pkt)
+
+
+class LoadGenerator(object):
+    """Drive simulated clients against a BOOTP server"""
+
+    def __init__(self, server, port, clients=1000, concurrency=100,
+                 dhcp_ratio=0.0, timeout=2.0, retries=2, giaddr=None,
+                 seed=0):
+        self.server = (server, port)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.giaddr = giaddr and socket.inet_aton(giaddr) or _ZERO_ADDRESS
+        rng = random.Random(seed)
+        self.clients = []
+        xids = rng.sample(xrange(1, 1<<31), clients)
+        for pos in xrange(clients):
+            mac = struct.pack('!HI', 0x0200, pos)
+            pxe = rng.random() >= dhcp_ratio
+            self.clients.append(Client(mac, pxe, xids[pos]))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1<<22)
+        if giaddr:
+            # replies to relay agents are sent to the BOOTP server port
+            self.sock.bind((giaddr, 67))
+        else:
+            self.sock.bind(('', 0))
+        self.counters = {'discovers': 0, 'requests': 0, 'offers': 0,
+                         'acks': 0, 'naks': 0, 'retransmits': 0,
+                         'drops': 0, 'unexpected': 0, 'invalid': 0}
+        self.latencies = {'offer': [], 'ack': [], 'exchange': []}
+
+    def send(self, client, now):
+        if client.stage == ST_DISCOVER:
+            msgtype = DHCP_DISCOVER
+            self.counters['discovers'] += 1
+        else:
+            msgtype = DHCP_REQUEST
+            self.counters['requests'] += 1
+        self.sock.sendto(client.build(msgtype, self.giaddr), self.server)
+        client.sent = now
+
+    def receive(self, pending, now):
+        try:
+            data, addr = self.sock.recvfrom(BOOTP_MAX_SIZE)
+        except socket.error:
+            return None
+        try:
+            packet = decode_packet(data)
+        except BootpCodecError:
+            self.counters['invalid'] += 1
+            return None
+        client = pending.get(packet.xid)
+        if packet.op != BOOTREPLY or not client or \
+           packet.chaddr[:6] != client.mac:
+            self.counters['unexpected'] += 1
+            return None
+        msgtype = packet.options.get_byte(DHCP_MSG)
+        latency = now-client.sent
+        if client.stage == ST_DISCOVER and msgtype == DHCP_OFFER:
+            self.counters['offers'] += 1
+            self.latencies['offer'].append(latency)
+            client.offer = packet.yiaddr
+            client.server = packet.options.get(DHCP_SERVER)
+            client.stage = ST_REQUEST
+            client.retries = 0
+            self.send(client, now)
+            return None
+        if client.stage == ST_REQUEST and msgtype in (DHCP_ACK, DHCP_NAK):
+            if msgtype == DHCP_ACK:
+                self.counters['acks'] += 1
+                self.latencies['ack'].append(latency)
+                self.latencies['exchange'].append(now-client.started)
+            else:
+                self.counters['naks'] += 1
+            client.stage = ST_DONE
+            return client
+        self.counters['unexpected'] += 1
+        return None
+
+    def run(self):
+        waiting = list(reversed(self.clients))
+        pending = {}
+        timer = time.time
+        start = timer()
+        while waiting or pending:
+            now = timer()
+            while waiting and len(pending) < self.concurrency:
+                client = waiting.pop()
+                client.started = now
+                pending[client.xid] = client
+                self.send(client, now)
+            r, w, e = select.select([self.sock], [], [], 0.05)
+            now = timer()
+            if r:
+                # drain every queued reply before checking for timeouts
+                while True:
+                    client = self.receive(pending, now)
+                    if client:
+                        del pending[client.xid]
+                    r, w, e = select.select([self.sock], [], [], 0)
+                    if not r:
+                        break
+            deadline = now-self.timeout
+            for client in [c for c in pending.itervalues()
+                           if c.sent < deadline]:
+                if client.retries < self.retries:
+                    client.retries += 1
+                    self.counters['retransmits'] += 1
+                    self.send(client, now)
+                else:
+                    self.counters['drops'] += 1
+                    del pending[client.xid]
+        return self.report(timer()-start)
+
+    def report(self, duration):
+        result = {'version': VERSION,
+                  'server': '%s:%d' % self.server,
+                  'clients': len(self.clients),
+                  'pxe_clients': len([c for c in self.clients if c.pxe]),
+                  'concurrency': self.concurrency,
+                  'duration_s': duration}
+        result.update(self.counters)
+        result['offers_per_s'] = self.counters['offers']/duration
+        result['acks_per_s'] = self.counters['acks']/duration
+        for name, samples in self.latencies.iteritems():
+            samples.sort()
+            count = len(samples)
+            result['%s_latency_ms' % name] = {
+                'count': count,
+                'mean': count and sum(samples)*1e3/count or 0.0,
+                'p50': percentile(samples, 0.50)*1e3,
+                'p90': percentile(samples, 0.90)*1e3,
+                'p99': percentile(samples, 0.99)*1e3,
+                'max': count and samples[-1]*1e3 or 0.0}
+        return result
+
+
+def main():
+    usage = 'Usage: %prog [options]\n' \
+            '   DHCP/PXE load generator for a BOOTP server'
+    optparser = OptionParser(usage=usage)
+    optparser.add_option('-s', '--server', dest='server',
+                         default='127.0.0.1',
+                         help='address of the BOOTP server')
+    optparser.add_option('-p', '--port', dest='port', type='int',
+                         default=67,
+                         help='port of the BOOTP server')
+    optparser.add_option('-n', '--clients', dest='clients', type='int',
+                         default=1000,
+                         help='number of simulated clients')
+    optparser.add_option('-w', '--concurrency', dest='concurrency',
+                         type='int', default=100,
+                         help='maximum number of clients in progress')
+    optparser.add_option('-d', '--dhcp-ratio', dest='dhcp_ratio',
+                         type='float', default=0.0,
+                         help='ratio of plain DHCP (non PXE) clients')
+    optparser.add_option('-t', '--timeout', dest='timeout', type='float',
+                         default=2.0,
+                         help='retransmission timeout, in seconds')
+    optparser.add_option('-r', '--retries', dest='retries', type='int',
+                         default=2,
+                         help='retransmissions before a client is dropped')
+    optparser.add_option('-g', '--giaddr', dest='giaddr',
+                         help='act as a relay agent with this local address')
+    optparser.add_option('-o', '--output', dest='output', default='-',
+                         help='JSON result file (default: stdout)')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+
+    generator = LoadGenerator(options.server, options.port,
+                              clients=options.clients,
+                              concurrency=options.concurrency,
+                              dhcp_ratio=options.dhcp_ratio,
+                              timeout=options.timeout,
+                              retries=options.retries,
+                              giaddr=options.giaddr)
+    result = generator.run()
+    if options.output == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(options.output, 'w') as out:
+            json.dump(result, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
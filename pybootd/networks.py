@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Served subnets and their longest-prefix match index
+
+Each entry of the 'networks' configuration section describes a subnet,
+keyed by its network address (or by its address/prefix, in which case
+the netmask may be omitted):
+
+    networks:
+        10.40.13.160:
+            netmask: 255.255.255.224
+            routers: [10.40.13.161]
+            dns: [10.40.1.80, 10.40.1.81]
+            lease_time: 3600
+            boot_file: pxelinux.0
+            range: [10.40.13.170, 10.40.13.190]
+
+All option values are packed once, when the configuration is loaded.
+"""
+
+import socket
+import struct
+from ippool import AddressPool, PoolError
+from util import iptoint, inttoip
+
+__all__ = ['NetworkError', 'Network', 'NetworkIndex']
+
+_IPV4 = struct.Struct('!I')
+
+
+class NetworkError(Exception):
+    """Invalid network definition"""
+    pass
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [x.strip() for x in str(value).split(',') if x.strip()]
+
+
+def _prefix_length(mask):
+    length = 32-(((~mask) & 0xffffffff).bit_length())
+    if mask != ((0xffffffff << (32-length)) & 0xffffffff):
+        raise NetworkError('Non contiguous netmask %s' % inttoip(mask))
+    return length
+
+
+class Network(object):
+    """A served subnet, with pre-packed option values"""
+
+    __slots__ = ('name', 'net', 'mask', 'prefixlen', 'broadcast',
+                 'packed_mask', 'routers', 'dns', 'server_id', 'lease_time',
+                 'boot_file', 'pool')
+
+    def __init__(self, name, netdata, dns_resolver=None):
+        netdata = netdata or {}
+        try:
+            address, _, prefixlen = str(name).partition('/')
+            if prefixlen and 'netmask' not in netdata:
+                self.mask = (0xffffffff << (32-int(prefixlen))) & 0xffffffff
+            else:
+                self.mask = iptoint(netdata['netmask'])
+            self.net = iptoint(address) & self.mask
+            self.prefixlen = _prefix_length(self.mask)
+            self.routers = ''.join([socket.inet_aton(ip) for ip in \
+                _as_list(netdata.get('routers', netdata.get('gateway')))])
+            dns = _as_list(netdata.get('dns'))
+            if dns_resolver and [ip for ip in dns if ip.lower() == 'auto']:
+                dns = [ip.lower() == 'auto' and dns_resolver() or ip \
+                       for ip in dns]
+            self.dns = ''.join([socket.inet_aton(ip) for ip in dns if ip])
+            server_id = netdata.get('server_id')
+            self.server_id = server_id and socket.inet_aton(server_id)
+        except KeyError, e:
+            raise NetworkError('Missing %s' % e)
+        except (socket.error, ValueError, TypeError), e:
+            raise NetworkError(str(e))
+        self.name = name
+        self.broadcast = self.net | (~self.mask & 0xffffffff)
+        self.packed_mask = _IPV4.pack(self.mask)
+        lease_time = netdata.get('lease_time')
+        self.lease_time = lease_time and int(lease_time)
+        self.boot_file = netdata.get('boot_file')
+        self.pool = None
+        if 'range' in netdata:
+            self.pool = self._build_pool(netdata)
+
+    def _build_pool(self, netdata):
+        try:
+            first, last = [iptoint(ip) for ip in netdata['range']]
+            exclude = [iptoint(ip) for ip in _as_list(netdata.get('exclude'))]
+            exclude.extend(struct.unpack('!%dI' % (len(self.routers)//4),
+                                         self.routers))
+            if first not in self or last not in self:
+                raise NetworkError('Range is out of the subnet')
+            return AddressPool(first, last, exclude)
+        except (ValueError, TypeError, socket.error, PoolError), e:
+            raise NetworkError('Invalid range: %s' % e)
+
+    def __contains__(self, addr):
+        return (addr & self.mask) == self.net
+
+    def __repr__(self):
+        return '%s/%d' % (inttoip(self.net), self.prefixlen)
+
+
+class NetworkIndex(object):
+    """Longest-prefix match index of the served subnets
+
+       Networks are hashed by their address in one table per prefix
+       length. A lookup probes the tables from the longest prefix to the
+       shortest, so its cost depends on the number of distinct prefix
+       lengths in use (at most 33), not on the number of subnets.
+    """
+
+    def __init__(self, networks=None):
+        self._tables = []
+        self._count = 0
+        for network in networks or []:
+            self.add(network)
+
+    def add(self, network):
+        for prefixlen, mask, table in self._tables:
+            if prefixlen == network.prefixlen:
+                break
+        else:
+            table = {}
+            self._tables.append((network.prefixlen, network.mask, table))
+            self._tables.sort(reverse=True)
+        if network.net in table:
+            raise NetworkError('Duplicate network %r' % network)
+        table[network.net] = network
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for _, _, table in self._tables:
+            for network in table.itervalues():
+                yield network
+
+    def lookup(self, addr):
+        """Return the most specific network containing an address"""
+        for _, mask, table in self._tables:
+            network = table.get(addr & mask)
+            if network:
+                return network
+        return None
+
+    def lookup_packed(self, packed):
+        """Return the most specific network containing a packed address"""
+        return self.lookup(_IPV4.unpack(packed)[0])
+
+    @classmethod
+    def from_config(cls, networks, dns_resolver=None):
+        """Build an index out of the 'networks' configuration section"""
+        index = cls()
+        for name, netdata in networks.iteritems():
+            try:
+                index.add(Network(name, netdata, dns_resolver))
+            except NetworkError, e:
+                raise NetworkError('Network %s: %s' % (name, e))
+        return index
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""UDP datagram captures, in pcap format
+
+The servers record the datagrams they receive and send as raw IPv4
+packets (link type 101), with synthesized IP and UDP headers, so that
+captures can be read by tcpdump or wireshark.
+
+Captures taken with tcpdump, on Ethernet or Linux 'any' interfaces, can
+be read back as well.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+__all__ = ['PcapError', 'PcapWriter', 'PcapReader']
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+PCAP_SNAPLEN = 65535
+PCAP_FLUSH_INTERVAL = 1.0
+
+_GLOBAL_HEADER = struct.Struct('=IHHiIII')
+_RECORD_HEADER = struct.Struct('=IIII')
+_IP_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_UDP_HEADER = struct.Struct('!HHHH')
+_ETHERTYPE_IP = 0x0800
+_ETHERTYPE_VLAN = 0x8100
+_IPPROTO_UDP = 17
+
+
+class PcapError(Exception):
+    """Invalid capture file"""
+    pass
+
+
+def _ip_checksum(header):
+    total = sum(struct.unpack('!10H', header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class PcapWriter(object):
+    """Thread-safe writer of UDP datagrams"""
+
+    def __init__(self, path, snaplen=PCAP_SNAPLEN):
+        self.path = path
+        self.snaplen = snaplen
+        self._lock = threading.Lock()
+        self._ident = 0
+        self._flushed = time.time()
+        self._out = open(path, 'wb')
+        self._out.write(_GLOBAL_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen,
+                                            LINKTYPE_RAW))
+        self._out.flush()
+
+    def write(self, src, dst, data, timestamp=None):
+        """Record a datagram, src and dst being (address, port) pairs"""
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        length = 28 + len(data)
+        with self._lock:
+            if not self._out:
+                return
+            self._ident = (self._ident + 1) & 0xffff
+            header = _IP_HEADER.pack(0x45, 0, length, self._ident, 0, 64,
+                                     _IPPROTO_UDP, 0,
+                                     socket.inet_aton(src[0]),
+                                     socket.inet_aton(dst[0]))
+            header = header[:10] + struct.pack('!H', _ip_checksum(header)) + \
+                     header[12:]
+            packet = ''.join((header, _UDP_HEADER.pack(src[1], dst[1],
+                                                       length-20, 0), data))
+            captured = min(length, self.snaplen)
+            seconds = int(timestamp)
+            self._out.write(_RECORD_HEADER.pack(seconds,
+                int((timestamp-seconds)*1e6), captured, length))
+            self._out.write(packet[:captured])
+            if timestamp - self._flushed > PCAP_FLUSH_INTERVAL:
+                self._out.flush()
+                self._flushed = timestamp
+
+    def close(self):
+        with self._lock:
+            if self._out:
+                self._out.close()
+                self._out = None
+
+
+class PcapReader(object):
+    """Iterate over the UDP datagrams of a capture
+
+       Yields (timestamp, (src address, port), (dst address, port), data)
+       tuples. Other packets, and IP fragments, are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as capture:
+            self._data = capture.read()
+        if len(self._data) < _GLOBAL_HEADER.size:
+            raise PcapError('Not a capture file: %s' % path)
+        for order in ('<', '>'):
+            magic = struct.unpack(order + 'I', self._data[:4])[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                break
+        else:
+            raise PcapError('Not a capture file: %s' % path)
+        self._order = order
+        self._scale = magic == PCAP_MAGIC_NS and 1e-9 or 1e-6
+        self.linktype = struct.unpack(order + 'I', self._data[20:24])[0]
+        if self.linktype not in (LINKTYPE_RAW, LINKTYPE_ETHERNET,
+                                 LINKTYPE_LINUX_SLL):
+            raise PcapError('Unsupported link type: %d' % self.linktype)
+
+    def _ip_offset(self, packet):
+        if self.linktype == LINKTYPE_RAW:
+            return 0
+        if self.linktype == LINKTYPE_LINUX_SLL:
+            offset = 16
+        else:
+            offset = 14
+        ethertype = struct.unpack('!H', packet[offset-2:offset])[0]
+        while ethertype == _ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = struct.unpack('!H', packet[offset-2:offset])[0]
+        return ethertype == _ETHERTYPE_IP and offset or None
+
+    def __iter__(self):
+        record = struct.Struct(self._order + 'IIII')
+        data = self._data
+        pos = _GLOBAL_HEADER.size
+        while pos + record.size <= len(data):
+            seconds, fraction, captured, length = \
+                record.unpack_from(data, pos)
+            pos += record.size
+            packet = data[pos:pos+captured]
+            pos += captured
+            offset = self._ip_offset(packet)
+            if offset is None or len(packet) < offset+28:
+                continue
+            (verlen, _, iplen, _, frag, _, proto, _, src, dst) = \
+                _IP_HEADER.unpack_from(packet, offset)
+            if verlen >> 4 != 4 or proto != _IPPROTO_UDP or frag & 0x3fff:
+                continue
+            offset += (verlen & 0xf)*4
+            sport, dport, udplen, _ = _UDP_HEADER.unpack_from(packet, offset)
+            payload = packet[offset+8:offset+udplen]
+            yield (seconds + fraction*self._scale,
+                   (socket.inet_ntoa(src), sport),
+                   (socket.inet_ntoa(dst), dport), payload)
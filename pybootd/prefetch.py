@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Prefetch of the boot files, ahead of the TFTP requests
+
+The BOOTP server knows the boot file of a client when it sends its offer,
+a second or so before the client requests the file over TFTP. The file,
+and the files known to follow it, are fetched in the meantime:
+
+  - local files are read through, which leaves them in the page cache,
+  - files of a URL root are downloaded, and kept in memory for the TFTP
+    server to send. The first chunks of larger files are fetched into the
+    chunk store instead.
+
+Follow-on files are configured per boot file in the 'prefetch' section,
+and per host with the 'prefetch' key of its lease:
+
+    prefetch:
+        chain:
+            pxelinux.0: [ldlinux.c32, pxelinux.cfg/default]
+"""
+
+import Queue
+import threading
+import time
+import urllib2
+import urlparse
+from stats import REGISTRY
+from util import to_int, to_list
+
+__all__ = ['BootFileCache']
+
+PREFETCH_CHUNK = 1 << 20
+
+
+class BootFileCache(object):
+    """Boot file prefetcher, with an in-memory cache of remote files
+
+       Files are named relative to the TFTP root, as in the requests of
+       the clients. Files fetched in the last 'ttl' seconds are not
+       fetched again, and remote files older than that are not served
+       from memory anymore.
+    """
+
+    def __init__(self, logger, config, chunks=None):
+        self.log = logger
+        self.config = config
+        self.chunks = chunks # store of the remote file chunks, if any
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._fetched = {} # key resource, value time of the last prefetch
+        self._files = {} # key resource, value (content, fetch time, use time)
+        self._size = 0
+        self._workers = []
+        self.events = REGISTRY.counter('pybootd_prefetch_files_total',
+            'Boot files prefetched, by source and outcome',
+            ('source', 'outcome'))
+        self.hits = REGISTRY.counter('pybootd_prefetch_cache_hits_total',
+            'TFTP transfers sent from prefetched memory')
+        REGISTRY.gauge('pybootd_prefetch_cache_bytes',
+            'Bytes of remote boot files kept in memory', (),
+            lambda: [((), self._size)])
+
+    def prefetch(self, names):
+        """Queue boot files, and the files which follow them, for fetch"""
+        config = self.config.snapshot()
+        if not config.get_prefetch_enabled():
+            return
+        chain = config.get_prefetch_chain()
+        root = config.get_tftp_root()
+        ttl = float(config.get_prefetch_ttl())
+        now = time.time()
+        queued = []
+        for name in names:
+            name = str(name or '').strip('\x00').lstrip('/')
+            if not name:
+                continue
+            for name in [name] + to_list(chain.get(name)):
+                resource = self.get_resource(root, str(name).lstrip('/'))
+                if resource in queued:
+                    continue
+                with self._lock:
+                    if now - self._fetched.get(resource, 0) < ttl:
+                        continue
+                    self._fetched[resource] = now
+                queued.append(resource)
+        if not queued:
+            return
+        self._start(int(config.get_prefetch_workers()))
+        for resource in queued:
+            self._queue.put(resource)
+
+    def get(self, resource):
+        """Return the prefetched content of a remote file, if any"""
+        ttl = float(self.config.get_prefetch_ttl())
+        now = time.time()
+        with self._lock:
+            entry = self._files.get(resource)
+            if entry is None or now - entry[1] >= ttl:
+                return None
+            self._files[resource] = (entry[0], entry[1], now)
+        self.hits.inc()
+        return entry[0]
+
+    def entries(self):
+        """Return the files kept in memory, as (resource, size, age)"""
+        now = time.time()
+        with self._lock:
+            files = self._files.items()
+        return [(resource, len(content), now-fetched) for
+                resource, (content, fetched, _) in sorted(files)]
+
+    def evict(self, resource=None):
+        """Drop a file from memory, or every file, returning the count"""
+        with self._lock:
+            names = resource is None and self._files.keys() or \
+                    [name for name in (resource,) if name in self._files]
+            for name in names:
+                self._size -= len(self._files.pop(name)[0])
+                # prefetched again on the next offer
+                self._fetched.pop(name, None)
+        return len(names)
+
+    def get_resource(self, root, name):
+        if not root:
+            return name
+        return '%s/%s' % (root, name)
+
+    def is_url(self, path):
+        return bool(urlparse.urlsplit(path).scheme)
+
+    def _start(self, count):
+        with self._lock:
+            while len(self._workers) < count:
+                worker = threading.Thread(target=self._run,
+                                          name='Prefetch-%d' % \
+                                               len(self._workers))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            resource = self._queue.get()
+            url = self.is_url(resource)
+            source = url and 'url' or 'file'
+            try:
+                if url:
+                    outcome = self._download(resource)
+                else:
+                    outcome = self._read(resource)
+            except Exception, e:
+                self.log.warn('Cannot prefetch %s: %s' % (resource, e))
+                outcome = 'error'
+                # try again on the next offer
+                with self._lock:
+                    self._fetched.pop(resource, None)
+            self.events.inc(source, outcome)
+
+    def _read(self, resource):
+        start = time.time()
+        size = 0
+        with open(resource, 'rb') as fobj:
+            while True:
+                chunk = fobj.read(PREFETCH_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+        self.log.debug('Prefetched %s, %d bytes in %.3f s' % \
+                       (resource, size, time.time()-start))
+        return 'read'
+
+    def _download(self, resource):
+        config = self.config.snapshot()
+        limit = to_int(config.get_prefetch_cache_size())
+        start = time.time()
+        rp = urllib2.urlopen(resource)
+        try:
+            length = rp.info().getheader('Content-Length')
+            content = None
+            if not length or int(length) <= limit:
+                content = rp.read(limit+1)
+        finally:
+            rp.close()
+        if content is None or len(content) > limit:
+            if self.chunks and config.get_remote_enabled() and \
+               config.get_remote_shared():
+                self.chunks.warm(resource)
+                return 'chunked'
+            return 'too_large'
+        with self._lock:
+            previous = self._files.get(resource)
+            if previous:
+                self._size -= len(previous[0])
+            now = time.time()
+            self._files[resource] = (content, now, now)
+            self._size += len(content)
+            # least recently used files make room for the new one
+            if self._size > limit:
+                for used, name in sorted([(used, name) for name, (_, _, used)
+                                          in self._files.iteritems()]):
+                    if self._size <= limit:
+                        break
+                    if name == resource:
+                        continue
+                    self._size -= len(self._files.pop(name)[0])
+        self.log.debug('Prefetched %s, %d bytes in %.3f s' % \
+                       (resource, len(content), time.time()-start))
+        return 'downloaded'
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""On-demand profiling of a running daemon
+
+A profiling session samples the stacks of every thread at a fixed
+interval, for a given duration, then writes two files to the profiling
+directory:
+
+  pybootd-<pid>-<time>.folded   collapsed stacks, one 'frame;frame count'
+                                line per stack, as read by flamegraph.pl
+  pybootd-<pid>-<time>.txt      samples per thread, and per function
+                                (self and total)
+
+Stacks are rooted at the name of their thread. Nothing runs while no
+session is active: the sampler is a thread of its own, started on demand.
+"""
+
+import os
+import sys
+import thread
+import threading
+import time
+
+__all__ = ['Profiler']
+
+
+class Profiler(object):
+    """Sampling profiler, toggled on and off"""
+
+    def __init__(self, logger, config):
+        self.log = logger
+        self.config = config
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop = False
+
+    def active(self):
+        return self._sampler is not None
+
+    def toggle(self):
+        """Start a session, or end the running one early"""
+        with self._lock:
+            if self._sampler:
+                self._stop = True
+                return False
+            self._stop = False
+            self._sampler = threading.Thread(target=self._run,
+                                             name='Profiler')
+            self._sampler.daemon = True
+            self._sampler.start()
+            return True
+
+    def stop(self):
+        """End the running session, if any, and wait for its report"""
+        with self._lock:
+            sampler = self._sampler
+            self._stop = True
+        if sampler:
+            sampler.join()
+
+    def _run(self):
+        config = self.config.snapshot()
+        duration = float(config.get_profiling_duration())
+        interval = float(config.get_profiling_interval())
+        directory = config.get_profiling_directory()
+        self.log.warn('Profiling for %.0f seconds' % duration)
+        try:
+            start = time.time()
+            stacks, samples = self._sample(start+duration, interval)
+            self._dump(directory, stacks, samples, time.time()-start,
+                       interval)
+        except Exception, e:
+            self.log.error('Profiling failed: %s' % e)
+        finally:
+            with self._lock:
+                self._sampler = None
+
+    def _sample(self, deadline, interval):
+        stacks = {} # key (thread, frame, ...), value sample count
+        labels = {} # key code object, value frame label
+        me = thread.get_ident()
+        samples = 0
+        while not self._stop and time.time() < deadline:
+            names = dict([(t.ident, t.name) for t in threading.enumerate()])
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        module = os.path.splitext(
+                                    os.path.basename(code.co_filename))[0]
+                        label = labels[code] = '%s:%s' % (module,
+                                                          code.co_name)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.reverse()
+                # threads started with the thread module have no name
+                stack.insert(0, names.get(ident) or stack[0])
+                stack = tuple(stack)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            samples += 1
+            time.sleep(interval)
+        return stacks, samples
+
+    def _dump(self, directory, stacks, samples, elapsed, interval):
+        base = os.path.join(directory, 'pybootd-%d-%s' % \
+                            (os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        with open(base + '.folded', 'w') as out:
+            for stack, count in sorted(stacks.iteritems()):
+                out.write('%s %d\n' % (';'.join(stack), count))
+        threads = {}
+        selfs = {}
+        totals = {}
+        for stack, count in stacks.iteritems():
+            threads[stack[0]] = threads.get(stack[0], 0) + count
+            selfs[stack[-1]] = selfs.get(stack[-1], 0) + count
+            # recursive functions count once per stack
+            for label in set(stack[1:]):
+                totals[label] = totals.get(label, 0) + count
+        with open(base + '.txt', 'w') as out:
+            out.write('# pid %d, %.1f s, %d samples every %.1f ms\n\n' % \
+                      (os.getpid(), elapsed, samples, interval*1e3))
+            out.write('%10s  %s\n' % ('samples', 'thread'))
+            for name, count in sorted(threads.iteritems(),
+                                      key=lambda item: -item[1]):
+                out.write('%10d  %s\n' % (count, name))
+            out.write('\n%10s %10s  %s\n' % ('self', 'total', 'function'))
+            for label, count in sorted(totals.iteritems(),
+                                       key=lambda item: (-selfs.get(item[0],
+                                                         0), -item[1])):
+                out.write('%10d %10d  %s\n' % (selfs.get(label, 0), count,
+                                               label))
+        self.log.warn('Profile written to %s.folded and %s.txt' % \
+                      (base, base))
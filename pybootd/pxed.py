@@ -18,146 +18,45 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import logging
 import re
 import select
 import socket
 import string
 import struct
 import sys
+import threading
 import time
 import pybootdconfig
-from binascii import hexlify
+from binascii import hexlify, unhexlify
+from clientclasses import ClientClass, ClientClassIndex, ClientClassError
+from dhcpcodec import BootpCodecError, BootpEncoder, decode_packet, \
+     BOOTREQUEST, BOOTP_FLAGS_NONE, BOOTP_MAX_SIZE, BOOTP_FILE_SIZE, \
+     DHCP_OPTIONS, DHCP_MESSAGES, DHCP_DISCOVER, DHCP_OFFER, DHCP_REQUEST, DHCP_DECLINE, \
+     DHCP_ACK, DHCP_RELEASE, DHCP_INFORM, DHCP_IP_MASK, DHCP_IP_GATEWAY, \
+     DHCP_IP_DNS, DHCP_HOSTNAME, DHCP_LEASE_TIME, DHCP_MSG, DHCP_SERVER, \
+     DHCP_CLASS_ID, DHCP_VENDOR, DHCP_UUID, DHCP_USER_CLASS, \
+     DHCP_CLIENT_ARCH, PXE_DISCOVERY_CONTROL, \
+     PXE_BOOT_SERVERS, PXE_BOOT_MENU, PXE_MENU_PROMPT, \
+     HTTP_BOOT_ARCHITECTURES
+from floodguard import RateLimiter, ReplyCache
+from httpacl import HttpAccessControl, HttpAclError
+from inventory import InventoryError
+from networks import NetworkIndex, NetworkError
 from pybootd import PRODUCT_NAME
-from util import hexline, to_bool, iptoint, inttoip, get_iface_config
+from replication import Replicator, ReplicationError
+from sockfilter import SocketFilterError, bootp_filter, attach_filter, \
+     detach_filter, BPF_MAXINSNS
+from stats import REGISTRY
+from util import hexline, to_bool, to_list, iptoint, inttoip, \
+                 get_iface_configs
 
 BOOTP_PORT_REQUEST = pybootdconfig.BOOTP_PORT
 BOOTP_PORT_REPLY = 68
 
-BOOTREQUEST = 1
-BOOTREPLY = 2
-
-BOOTPFormat = '!4bIHH4s4s4s4s16s64s128s64s'
-BOOTPFormatSize = struct.calcsize(BOOTPFormat)
-DHCPFormat = '!4bIHH4s4s4s4s16s64s128s4s'
-DHCPFormatSize = struct.calcsize(DHCPFormat)
-
-(BOOTP_OP,BOOTP_HTYPE,BOOTP_HLEN,BOOTP_HOPS,BOOTP_XID,BOOTP_SECS,
- BOOTP_FLAGS,BOOTP_CIADDR,BOOTP_YIADDR,BOOTP_SIADDR,BOOTP_GIADDR,
- BOOTP_CHADDR,BOOTP_SNAME,BOOTP_FILE,BOOTP_VEND) = range(15)
-
-BOOTP_FLAGS_NONE = 0
-BOOTP_FLAGS_BROADCAST = 1<<15
-
-COOKIE='\0x63\0x82\0x53\0x63'
-
-DHCP_OPTIONS = {  0: 'Byte padding',
-                  1: 'Subnet mask',
-                  2: 'Time offset',
-                  3: 'Routers',
-                  4: 'Time servers',
-                  5: 'Name servers',
-                  6: 'Domain name servers',
-                  7: 'Log servers',
-                  8: 'Cookie servers',
-                  9: 'Line printer servers',
-                 10: 'Impress servers',
-                 11: 'Resource location servers',
-                 12: 'Host Name', # + PXE extensions
-                 13: 'Boot file size',
-                 14: 'Dump file',
-                 15: 'Domain name',
-                 16: 'Swap server',
-                 17: 'Root path',
-                 18: 'Extensions path',
-                 # --- IP layer / host ---
-                 19: 'IP forwarding',
-                 20: 'Source routing',
-                 21: 'Policy filter',
-                 22: 'Maximum datagram reassembly size',
-                 23: 'Default IP TTL',
-                 24: 'Path MTU aging timeout',
-                 25: 'Path MTU plateau table',
-                 # --- IP Layer / interface ---
-                 26: 'Interface MTU',
-                 27: 'All subnets local',
-                 28: 'Broadcast address',
-                 29: 'Perform mask discovery',
-                 30: 'Mask supplier',
-                 31: 'Perform router discovery',
-                 32: 'Router solicitation address',
-                 33: 'Static route',
-                 # --- Link layer ---
-                 34: 'Trailer encapsulation',
-                 35: 'ARP cache timeout',
-                 36: 'Ethernet encaspulation',
-                 # --- TCP ---
-                 37: 'TCP default TTL',
-                 38: 'TCP keepalive interval',
-                 39: 'TCP keepalive garbage',
-                 # --- Application & Services ---
-                 40: 'Network Information Service domain',
-                 41: 'Network Information servers',
-                 42: 'Network Time Protocol servers',
-                 43: 'Vendor specific',
-                 44: 'NetBIOS over TCP/IP name server',
-                 45: 'NetBIOS over TCP/IP datagram server',
-                 46: 'NetBIOS over TCP/IP node type',
-                 47: 'NetBIOS over TCP/IP scope',
-                 48: 'X Window system font server',
-                 49: 'X Window system display manager',
-                 50: 'Requested IP address',
-                 51: 'IP address lease time',
-                 52: 'Option overload',
-                 53: 'DHCP message',
-                 54: 'Server ID',
-                 55: 'Param request list',
-                 56: 'Error message',
-                 57: 'Message length',
-                 58: 'Renewal time',
-                 59: 'Rebinding time',
-                 60: 'Class ID',
-                 61: 'GUID',
-                 64: 'Network Information Service+ domain',
-                 65: 'Network Information Service+ servers',
-                 66: 'TFTP server name',
-                 67: 'Bootfile name',
-                 68: 'Mobile IP home agent',
-                 69: 'Simple Mail Transport Protocol servers',
-                 70: 'Post Office Protocol servers',
-                 71: 'Network News Transport Protocol servers',
-                 72: 'World Wide Web servers',
-                 73: 'Finger servers',
-                 74: 'Internet Relay Chat server',
-                 77: 'User Class',
-                 93: 'System architecture',
-                 94: 'Network type',
-                 97: 'UUID',
-                 175: 'iPXE encap opts',
-                 255: 'End of DHCP options' }
-
-DHCP_DISCOVER = 1
-DHCP_OFFER = 2
-DHCP_REQUEST = 3
-DHCP_DECLINE = 4
-DHCP_ACK = 5
-DHCP_NAK = 6
-DHCP_RELEASE = 7
-DHCP_INFORM = 8
-DHCP_RENEWING = 100
-
-DHCP_IP_MASK = 1
-DHCP_IP_GATEWAY = 3
-DHCP_IP_DNS = 6
-DHCP_LEASE_TIME = 51
-DHCP_MSG = 53
-DHCP_SERVER = 54
-DHCP_END = 255
-
-PXE_DISCOVERY_CONTROL = 6
-DISCOVERY_MCAST_ADDR = 7
-PXE_BOOT_SERVERS = 8
-PXE_BOOT_MENU = 9
-PXE_MENU_PROMPT = 10
+_PXE_BOOT_SERVER_ENTRY = struct.Struct('!HB4s')
+_PXE_MENU_ENTRY = struct.Struct('!HB')
+_NO_ADDRESS = '\x00\x00\x00\x00'
 
 
 class BootpError(Exception):
@@ -172,155 +71,434 @@ class BootpServer:
     ACCESS_LOCAL = ['uuid', 'mac'] # Access modes, defined locally
     ACCESS_REMOTE = ['http']       # Access modes, remotely retrieved
     (ST_IDLE, ST_PXE, ST_DHCP) = range(3) # Current state
+    STATE_NAMES = ('idle', 'pxe', 'dhcp')
 
-    def __init__(self, logger, config):
+    def __init__(self, logger, config, recorder=None, handoff=None):
         self.sock = []
         self.log = logger
         self.config = config
+        self.recorder = recorder # capture of the BOOTP traffic, if any
+        self.handoff = handoff # sockets and state of the previous process
         self.uuidpool = {} # key MAC address value, value UUID value
         self.ippool = {} # key MAC address string, value assigned IP string
+        self.ipleases = {} # key assigned IP string, value MAC address string
         self.filepool = {} # key IP string, value pathname
         self.states = {} # key MAC address string, value client state
+        self.dynleases = {} # key MAC address string, value (IP, expiry, pool)
+        self.encoder = BootpEncoder()
+        self.init_stats()
         name_ = PRODUCT_NAME.split('-')
         name_[0] = 'bootp'
-        self.netconfig = get_iface_config(self.config.get_bootp_bind_interface())
-        if not self.netconfig:
+        self.netconfigs = get_iface_configs(
+                            self.config.get_bootp_bind_interfaces())
+        if not self.netconfigs:
             raise BootpError('Unable to detect network configuration')
-        keys = sorted(self.netconfig.keys())
-        self.log.info('Using %s' % ', '.join(map(':'.join,
-                                zip(keys, [self.netconfig[k] for k in keys]))))
-        access = self.config.get_bootp_acl_type()
+        for netconfig in self.netconfigs:
+            keys = sorted(netconfig.keys())
+            self.log.info('Using %s' % ', '.join(map(':'.join,
+                                zip(keys, [netconfig[k] for k in keys]))))
+        self.netconfig = self.netconfigs[0]
+        self.socknets = {} # key socket, value netconfig of its address
+        self.access = None
+        self.acl = None
+        self.networks = None
+        self.classes = None
+        self.replies = None
+        self.limiter = None
+        self.reloaded = None
+        self.replicator = None
+        self.sockfilter = False # unknown, inherited sockets may have one
+        self.prefetch_listeners = []
+        self.paused = False
+        self._stopped = threading.Event()
+        self.serving = threading.Lock() # held while handling requests
+        self.load_config(self.config.snapshot())
+        if self.config.has_section('replication'):
+            try:
+                self.replicator = Replicator(self.log,
+                                    self.config.get_section('replication'))
+            except ReplicationError, e:
+                raise BootpError(str(e))
+        if handoff:
+            self.import_state(handoff.state.get('bootp'))
+            handoff.add_server('bootp', self)
+        self.config.add_reload_listener(self.schedule_reload)
+
+    def load_config(self, config, diff=None):
+        """Apply the settings of a configuration snapshot
+
+           diff tells which sections changed since the previous snapshot,
+           unchanged settings are left untouched.
+        """
+        changed = set(diff and diff['sections'] or [])
+        access = config.get_bootp_acl_type()
+        access = access and access.lower()
+        if not diff or access != self.access or (access in changed):
+            self.acl, previous = self.build_acl(config, access), self.acl
+            self.access = access
+            if isinstance(previous, HttpAccessControl):
+                previous.close()
+        if not diff or 'networks' in changed:
+            networks = self.build_networks(config)
+            if self.networks is not None:
+                self.migrate_leases(networks)
+            self.networks = networks
+        if not diff or 'client_classes' in changed:
+            self.classes = self.build_classes(config)
+        if not diff or 'bootp' in changed:
+            ttl = float(config.get_bootp_reply_cache_ttl() or 0)
+            self.replies = None
+            if ttl > 0:
+                self.replies = ReplyCache(ttl)
+            self.limiter = RateLimiter(config.get_bootp_rate_limit(),
+                                       config.get_bootp_rate_burst(),
+                                       config.get_bootp_global_rate_limit(),
+                                       config.get_bootp_global_rate_burst())
+            dns = config.get_bootp_default_dns()
+            if dns and dns.lower() == 'auto':
+                # None stands for the server itself
+                dns = self.get_dns_server()
+                self.default_dns = dns and socket.inet_aton(dns)
+            else:
+                self.default_dns = dns and socket.inet_aton(dns) or ''
+
+    def build_acl(self, config, access):
         if not access:
-            self.acl = None
-        else:
-            access = access.lower()
-            if access not in self.ACCESS_LOCAL + self.ACCESS_REMOTE:
-                raise BootpError('Invalid access mode: %s' % access)
-            if not self.config.has_section(access):
-                raise BootpError("Missing access section '%s'" % access)
-            self.acl = {}
-            if access in self.ACCESS_LOCAL:
-                for entry in self.config.options(access):
-                    self.acl[entry.upper()] = \
-                        to_bool(self.config.get(access, entry))
-        self.access = access
+            return None
+        if access not in self.ACCESS_LOCAL + self.ACCESS_REMOTE:
+            raise BootpError('Invalid access mode: %s' % access)
+        if not config.has_section(access):
+            raise BootpError("Missing access section '%s'" % access)
+        settings = config.get_section(access)
+        if access in self.ACCESS_LOCAL:
+            acl = {}
+            if isinstance(settings, list):
+                settings = dict([(entry, True) for entry in settings])
+            for entry, value in settings.iteritems():
+                acl[str(entry).upper()] = to_bool(value)
+            return acl
+        try:
+            return HttpAccessControl(self.log, settings)
+        except HttpAclError, e:
+            raise BootpError(str(e))
+
+    def init_stats(self):
+        self.received = REGISTRY.counter('pybootd_dhcp_received_total',
+            'DHCP requests received, by message type', ('type',))
+        self.sent = REGISTRY.counter('pybootd_dhcp_sent_total',
+            'DHCP replies sent, by message type', ('type',))
+        self.dropped = REGISTRY.counter('pybootd_dhcp_dropped_total',
+            'DHCP requests left unanswered, by reason', ('reason',))
+        self.transitions = REGISTRY.counter('pybootd_dhcp_transitions_total',
+            'Client state transitions', ('from', 'to'))
+        self.cached = REGISTRY.counter('pybootd_dhcp_cached_replies_total',
+            'Retransmitted requests answered from the reply cache')
+        self.class_matches = REGISTRY.counter(
+            'pybootd_client_class_matches_total',
+            'Requests answered, by client class', ('class',))
+        self.handle_time = REGISTRY.histogram('pybootd_dhcp_handle_seconds',
+            'Processing time of DHCP requests')
+        REGISTRY.gauge('pybootd_dhcp_pool_addresses',
+            'Addresses of the dynamic pools', ('network', 'state'),
+            self.collect_pool_stats)
+        REGISTRY.gauge('pybootd_acl_events_total',
+            'Remote access control events', ('event',),
+            self.collect_acl_stats, 'counter')
+        REGISTRY.gauge('pybootd_replication_records_total',
+            'Replicated client records, by event', ('event',),
+            self.collect_replication_stats, 'counter')
+        REGISTRY.gauge('pybootd_replication_nodes_alive',
+            'Replication nodes alive, this one included', (),
+            lambda: self.replicator and
+                    [((), len(self.replicator.alive_nodes()))] or [])
+
+    def collect_pool_stats(self):
+        samples = []
+        for network in self.networks or []:
+            if network.pool:
+                samples.append(((network.name, 'used'), network.pool.used))
+                samples.append(((network.name, 'free'), network.pool.free))
+        return samples
+
+    def collect_acl_stats(self):
+        if not isinstance(self.acl, HttpAccessControl):
+            return []
+        return [((event,), count) for event, count in
+                sorted(self.acl.stats.items())]
+
+    def collect_replication_stats(self):
+        if not self.replicator:
+            return []
+        return [((event,), count) for event, count in
+                sorted(self.replicator.stats.items())]
+
+    def schedule_reload(self, config, diff):
+        """Reload listener, the new settings are applied between requests"""
+        self.reloaded = (config, diff)
+
+    def apply_reload(self):
+        config, diff = self.reloaded
+        self.reloaded = None
+        try:
+            self.load_config(config, diff)
+        except BootpError, e:
+            self.log.error('Cannot apply new configuration: %s' % e)
+            return
+        self.apply_filter(config)
+        if self.replies is not None:
+            # cached replies may not match the new settings
+            self.replies.clear()
+        if get_iface_configs(config.get_bootp_bind_interfaces()) != \
+           self.netconfigs:
+            self.log.warn('Changing the bootp interfaces requires a restart')
+        if 'replication' in diff['sections']:
+            self.log.warn('Changing the replication requires a restart')
+        self.log.info('New configuration applied')
 
     # Public
     def get_netconfig(self):
         return self.netconfig
 
     def bind(self):
-        host = self.netconfig['address']
         port = self.config.get_bootp_port()
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                             socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.append(sock)
-        self.log.info('Listening to %s:%s' % (host, port))
-        sock.bind((host, int(port)))
+        for netconfig in self.netconfigs:
+            address = (netconfig['address'], int(port))
+            sock = self.handoff and self.handoff.take('bootp', address)
+            if not sock:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                     socket.IPPROTO_UDP)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(address)
+            self.sock.append(sock)
+            self.socknets[sock] = netconfig
+            self.log.info('Listening to %s:%s' % address)
+            if self.handoff:
+                self.handoff.register('bootp', address, sock)
+        self.apply_filter(self.config.snapshot())
+        if self.replicator:
+            address = self.replicator.address
+            listener = self.handoff and \
+                       self.handoff.take('replication', address)
+            self.replicator.start(listener)
+            if self.handoff:
+                self.handoff.register('replication', address,
+                                      self.replicator.listener)
+
+    def build_filter(self, config):
+        """Return the kernel filter program of the settings, or None"""
+        if not to_bool(config.get_bootp_socket_filter()):
+            return None
+        if self.access != 'mac':
+            # other access modes need more than the MAC address
+            return bootp_filter()
+        try:
+            program = bootp_filter([mac for mac, allowed in
+                                    self.acl.iteritems() if allowed])
+        except SocketFilterError, e:
+            self.log.warn('%s, filtering BOOTREQUESTs only' % e)
+            return bootp_filter()
+        if len(program) > BPF_MAXINSNS:
+            self.log.warn('Too many MAC addresses to filter, '
+                          'filtering BOOTREQUESTs only')
+            return bootp_filter()
+        return program
+
+    def apply_filter(self, config):
+        """Attach the kernel filter to the sockets, or remove it"""
+        program = self.build_filter(config)
+        if program == self.sockfilter:
+            return
+        try:
+            for sock in self.sock:
+                if program:
+                    attach_filter(sock, program)
+                else:
+                    detach_filter(sock)
+        except SocketFilterError, e:
+            self.log.warn('Requests are not filtered: %s' % e)
+            for sock in self.sock:
+                detach_filter(sock)
+            program = None
+        if program:
+            self.log.info('Filtering requests in the kernel, %d '
+                          'instructions' % len(program))
+        self.sockfilter = program
+
+    def pause(self, paused=True):
+        """Stop reading requests, or resume, once the current ones are
+           handled"""
+        with self.serving:
+            self.paused = paused
+        if self.replicator:
+            self.replicator.pause(paused)
+
+    def stop(self):
+        """Stop serving requests and replicating"""
+        self._stopped.set()
+        if self.replicator:
+            self.replicator.stop()
 
     def forever(self):
-        while True:
+        sources = self.sock + (self.replicator and [self.replicator] or [])
+        while not self._stopped.isSet():
             try:
-                r,w,e = select.select(self.sock, [], self.sock)
-                for sock in r:
-                    data, addr = sock.recvfrom(556)
-                    self.handle(sock, addr, data)
+                if self.reloaded:
+                    self.apply_reload()
+                if self.paused:
+                    # the sockets are handed over to another process
+                    time.sleep(0.1)
+                    continue
+                r,w,e = select.select(sources, [], self.sock, 1.0)
+                with self.serving:
+                    if not self.paused:
+                        self.serve(r)
             except Exception, e:
                 import traceback
                 self.log.critical('%s\n%s' % (str(e), traceback.format_exc()))
                 time.sleep(1)
 
-    def parse_options(self, tail):
-        self.log.debug('Parsing DHCP options')
-        dhcp_tags = {}
-        while tail:
-            tag = ord(tail[0])
-            # padding
-            if tag == 0:
+    def serve(self, readable):
+        for sock in readable:
+            if sock is self.replicator:
+                self.apply_replicated()
                 continue
-            if tag == 0xff:
-                return dhcp_tags
-            length = ord(tail[1])
-            (value, ) = struct.unpack('!%ss' % length, tail[2:2+length])
-            tail = tail[2+length:]
-            try:
-                option = DHCP_OPTIONS[tag]
-                self.log.debug(" option %d: '%s', size:%d %s" % \
-                               (tag, option, length, hexline(value)))
-            except KeyError:
-                self.log.error('  unknown option %d, size:%d %s:' % \
-                                (tag, length, hexline(value)))
-                return None
-            dhcp_tags[tag] = value
+            data, addr = sock.recvfrom(BOOTP_MAX_SIZE)
+            start = time.time()
+            if self.recorder:
+                self.recorder.write(addr, sock.getsockname(), data, start)
+            self.handle(sock, addr, data)
+            self.handle_time.observe(time.time()-start)
 
-    def build_pxe_options(self, options, server):
+    def send(self, sock, data, addr):
+        sock.sendto(data, addr)
+        if self.recorder:
+            self.recorder.write(sock.getsockname(), addr, data)
+
+    def parse_options(self, data):
+        """Decode a request, returning None if it is malformed"""
+        self.log.debug('Parsing DHCP options')
         try:
-            buf = ''
-            uuid = options[97]
-            buf += struct.pack('!BB%ds' % len(uuid),
-                               97, len(uuid), uuid)
-            clientclass = options[60]
-            clientclass = clientclass[:clientclass.find(':')]
-            buf += struct.pack('!BB%ds' % len(clientclass),
-                               60, len(clientclass), clientclass)
-            vendor = ''
-            vendor += struct.pack('!BBB', PXE_DISCOVERY_CONTROL, 1, 0x0A)
-            vendor += struct.pack('!BBHB4s', PXE_BOOT_SERVERS, 2+1+4,
-                                  0, 1, server)
-            srvstr = 'Python'
-            vendor += struct.pack('!BBHB%ds' % len(srvstr), PXE_BOOT_MENU,
-                                  2+1+len(srvstr), 0, len(srvstr), srvstr)
-            prompt = 'Stupid PXE'
-            vendor += struct.pack('!BBB%ds' % len(prompt), PXE_MENU_PROMPT,
-                                  1+len(prompt), len(prompt), prompt)
-            buf += struct.pack('!BB%ds' % len(vendor), 43,
-                               len(vendor), vendor)
-            buf += struct.pack('!BBB', 255, 0, 0)
-            return buf
-        except KeyError, e:
-            self.log.error('Missing options, cancelling: ' + str(e))
+            packet = decode_packet(data)
+        except BootpCodecError, e:
+            self.log.error('Invalid request: %s' % e)
+            return None
+        if self.log.isEnabledFor(logging.DEBUG):
+            for tag, value in packet.options.iteritems():
+                self.log.debug(" option %d: '%s', size:%d %s" % \
+                               (tag, DHCP_OPTIONS.get(tag, 'Unknown'),
+                                len(value), hexline(value)))
+        return packet
+
+    def build_pxe_options(self, options, server, encoder, vendor=True):
+        if DHCP_UUID not in options or DHCP_CLASS_ID not in options:
+            self.log.error('Missing options, cancelling: %s' % \
+                           (DHCP_UUID not in options and DHCP_UUID or \
+                            DHCP_CLASS_ID))
+            return False
+        encoder.add_option(DHCP_UUID, options[DHCP_UUID])
+        clientclass = options[DHCP_CLASS_ID]
+        clientclass = clientclass[:clientclass.find(':')]
+        encoder.add_option(DHCP_CLASS_ID, clientclass)
+        if not vendor:
+            # HTTP boot clients only expect their class to be echoed
+            return True
+        encoder.begin_option(DHCP_VENDOR)
+        encoder.add_byte(PXE_DISCOVERY_CONTROL, 0x0A)
+        encoder.add_option(PXE_BOOT_SERVERS,
+                           _PXE_BOOT_SERVER_ENTRY.pack(0, 1, server))
+        srvstr = 'Python'
+        encoder.add_option(PXE_BOOT_MENU,
+                           _PXE_MENU_ENTRY.pack(0, len(srvstr)) + srvstr)
+        prompt = 'Stupid PXE'
+        encoder.add_option(PXE_MENU_PROMPT, chr(len(prompt)) + prompt)
+        encoder.end_option()
+        return True
+
+    def get_http_client(self, options):
+        """Tell how a client boots over HTTP: 'uefi', 'ipxe' or None"""
+        if options.get(DHCP_CLASS_ID, '').startswith('HTTPClient'):
+            return 'uefi'
+        if 'iPXE' in options.get(DHCP_USER_CLASS, ''):
+            return 'ipxe'
+        arch = options.get(DHCP_CLIENT_ARCH, '')
+        if len(arch) >= 2 and struct.unpack('!H', arch[:2])[0] in \
+           HTTP_BOOT_ARCHITECTURES:
+            return 'uefi'
+        return None
+
+    def get_http_boot_url(self, bootfile, server_addr, config):
+        """Return the URL of a boot file, or None if it does not fit"""
+        bootfile = config.get_httpboot_boot_file() or bootfile.strip('\x00')
+        if not bootfile:
+            return None
+        if '://' not in bootfile:
+            base_url = config.get_httpboot_base_url() or \
+                'http://%s:%d/' % (server_addr, config.get_httpboot_port())
+            bootfile = '%s/%s' % (base_url.rstrip('/'), bootfile.lstrip('/'))
+        if len(bootfile) >= BOOTP_FILE_SIZE:
+            self.log.error('Boot URL too long: %s' % bootfile)
             return None
+        return bootfile
 
-    def build_dhcp_options(self, clientname):
-        buf = ''
-        if not clientname:
-            return buf
-        buf += struct.pack('!BB%ds' % len(clientname),
-                           12, len(clientname), clientname)
-        return buf
+    def build_dhcp_options(self, clientname, encoder):
+        if clientname:
+            encoder.add_option(DHCP_HOSTNAME, clientname)
 
     def handle(self, sock, addr, data):
         sender = addr
         self.log.info('Sender: %s on socket %s' % (addr, sock.getsockname()))
-        if len(data) < DHCPFormatSize:
-            self.log.error('Cannot be a DHCP or BOOTP request - too small!')
-        tail = data[DHCPFormatSize:]
-        buf = list(struct.unpack(DHCPFormat, data[:DHCPFormatSize]))
-        if buf[BOOTP_OP] != BOOTREQUEST:
-            self.log.warn('Not a BOOTREQUEST')
-            return
-        options = self.parse_options(tail)
-        if options is None:
+        # stick to the same configuration for the whole request
+        config = self.config.snapshot()
+        packet = self.parse_options(data)
+        if packet is None:
             self.log.warn('Error in option parsing, ignore request')
+            self.dropped.inc('parse_error')
             return
+        if packet.op != BOOTREQUEST:
+            self.log.warn('Not a BOOTREQUEST')
+            self.dropped.inc('not_bootrequest')
+            return
+        options = packet.options
 
         # Extras (DHCP options)
-        try:
-            dhcp_msg_type = ord(options[53][0])
-        except KeyError:
-            dhcp_msg_type = None
+        dhcp_msg_type = options.get_byte(DHCP_MSG)
+        self.received.inc(dhcp_msg_type and \
+            DHCP_MESSAGES.get(dhcp_msg_type, str(dhcp_msg_type)) or 'BOOTP')
 
-        server_addr = self.netconfig['address']
-        mac_addr = buf[BOOTP_CHADDR][:6]
-        gi_addr = buf[BOOTP_GIADDR][:4]
+        mac_addr = packet.chaddr[:6]
+        now = time.time()
+        if self.limiter and not self.limiter.allow(mac_addr, now):
+            self.log.debug('Rate limit exceeded, discarding request')
+            self.dropped.inc('rate_limited')
+            return
+        # retransmissions are answered with the reply to the first request,
+        # relays and listening addresses of a same client have their own
+        cache_key = (mac_addr, packet.xid, dhcp_msg_type, packet.giaddr, sock)
+        if self.replies is not None:
+            cached = self.replies.get(cache_key, now)
+            if cached:
+                self.log.debug('Retransmission, resending cached reply')
+                self.send(sock, *cached)
+                self.cached.inc()
+                self.sent.inc(dhcp_msg_type == DHCP_DISCOVER and 'OFFER' or
+                              'ACK')
+                return
+
+        # every address is served, with the settings of its own segment
+        netconfig = self.socknets.get(sock, self.netconfig)
+        server_addr = netconfig['address']
+        gi_addr = packet.giaddr
         mac_str = ':'.join(['%02X' % ord(x) for x in mac_addr])
-        gi_str = '.'.join(['%d' % ord(x) for x in gi_addr])
+        gi_str = socket.inet_ntoa(gi_addr)
         self.log.debug("Gateway address: %s" % gi_str)
+        if self.replicator and not self.replicator.is_responsible(mac_str):
+            self.log.debug('MAC %s is served by another node' % mac_str)
+            self.dropped.inc('not_responsible')
+            return
         # is the UUID received (PXE mode)
-        if 97 in options and len(options[97]) == 17:
-            uuid = options[97][1:]
+        if DHCP_UUID in options and options.length(DHCP_UUID) == 17:
+            uuid = options[DHCP_UUID][1:]
             pxe = True
             self.log.info('PXE UUID has been received')
         # or retrieved from the cache (DHCP mode)
@@ -334,6 +512,9 @@ class BootpServer:
         if uuid_str:
             self.log.info('UUID is %s for MAC %s' % (uuid_str, mac_str))
 
+        if not self.is_allowed(mac_str, uuid_str):
+            return
+
         hostname = ''
         filename = ''
 
@@ -357,137 +538,208 @@ class BootpServer:
         # if the state has not evolved from idle, there is nothing to do
         if newstate == self.ST_IDLE:
             self.log.info('Request from %s ignored (idle state)' % mac_str)
-            sdhcp = self.config.get_bootp_allow_simple_dhcp()
+            sdhcp = config.get_bootp_allow_simple_dhcp()
             simple_dhcp = sdhcp and to_bool(sdhcp)
             if not simple_dhcp:
+               self.dropped.inc('idle_state')
                return
 
+        if not dhcp_msg_type:
+            self.log.warn('No DHCP message type found, discarding request')
+            self.dropped.inc('no_message_type')
+            return
+        if dhcp_msg_type == DHCP_DISCOVER:
+            self.log.debug('DHCP DISCOVER')
+            dhcp_reply = DHCP_OFFER
+        elif dhcp_msg_type == DHCP_REQUEST:
+            self.log.debug('DHCP REQUEST')
+            dhcp_reply = DHCP_ACK
+        elif dhcp_msg_type == DHCP_RELEASE:
+            self.log.info('DHCP RELEASE')
+            self.release_address(mac_str)
+            if self.replies is not None:
+                self.replies.discard(mac_addr)
+            return
+        elif dhcp_msg_type == DHCP_INFORM:
+            self.log.info('DHCP INFORM')
+            return
+        elif dhcp_msg_type == DHCP_DECLINE:
+            self.log.debug('DHCP DECLINE')
+            return
+        else:
+            self.log.error('Unmanaged DHCP message: %d' % dhcp_msg_type)
+            self.dropped.inc('unmanaged_message')
+            return
+
         # construct reply
-        buf[BOOTP_OP] = BOOTREPLY
-        self.log.info('Client IP: %s' % socket.inet_ntoa(buf[7]))
-        if buf[BOOTP_CIADDR] == '\x00\x00\x00\x00':
+        self.log.info('Client IP: %s' % socket.inet_ntoa(packet.ciaddr))
+        # the client subnet is the one of the relay agent, if any, or the
+        # one of the receiving interface
+        relayed = gi_addr != _NO_ADDRESS
+        siaddr = socket.inet_aton(server_addr)
+        network = self.networks.lookup_packed(relayed and gi_addr or siaddr)
+        if network:
+            self.log.debug('Client network: %r' % network)
+        host_data = self.get_host_data_for_mac(mac_str, config)
+        if not host_data and network and network.pool:
+            host_data = self.get_dynamic_host_data(mac_str, network, config)
+        if not host_data:
+            self.log.error("Can not find host data for mac: %s" % mac_str)
+            self.dropped.inc(self.get_host_data_failure(mac_str, network,
+                                                        config))
+            return
+        flags = packet.flags
+        if packet.ciaddr == _NO_ADDRESS:
             self.log.debug('Client needs its address')
-            host_data = self.get_host_data_for_mac(mac_str)
             ipaddr = host_data['address']
 
             self.log.debug("IPADDR: {0}".format(ipaddr))
             if not ipaddr:
                 self.log.error("Can't get IP address!")
+                self.dropped.inc('no_address')
                 return
             ip = None
-            if mac_str in self.ippool:
-                ip = self.ippool[mac_str]
+            cached = self.ippool.get(mac_str)
+            # segments share the cache, a client may have moved
+            if cached and (not network or iptoint(cached) in network):
+                ip = cached
                 self.log.info('Lease for MAC %s already defined as IP %s' % \
                                 (mac_str, ip))
             else:
-                self.ippool[mac_str] = ipaddr
+                self.assign_address(mac_str, ipaddr)
                 ip = ipaddr
 
             if not ip:
                 #raise BootpError('No more IP available in definined pool')
                 self.log.error("Can not find IP assigned to mac: %s" % mac_str)
+                self.dropped.inc('no_address')
                 return
 
-            mask = iptoint(self.netconfig['mask'])
+            mask = network and network.mask or iptoint(netconfig['mask'])
             reply_broadcast = iptoint(ip) & mask
             reply_broadcast |= (~mask)&((1<<32)-1)
-            buf[BOOTP_YIADDR] = socket.inet_aton(ip)
-            buf[BOOTP_SECS] = 0
-            buf[BOOTP_FLAGS] = BOOTP_FLAGS_NONE
+            yiaddr = socket.inet_aton(ip)
+            flags = BOOTP_FLAGS_NONE
             addr = (inttoip(reply_broadcast), addr[1])
             self.log.debug('Reply to: %s:%s' % addr)
         else:
-            buf[BOOTP_YIADDR] = buf[BOOTP_CIADDR]
-            ip = socket.inet_ntoa(buf[BOOTP_YIADDR])
-        buf[BOOTP_SIADDR] = socket.inet_aton(server_addr)
-        if gi_addr:
-            self.log.debug('Reply via gateway: %s' % gi_str)
-            buf[BOOTP_GIADDR] = socket.inet_aton(gi_str)
-        # sname
-        buf[BOOTP_SNAME] = \
-            '.'.join([host_data['hostname'], host_data['domain']])
-        # file
-        buf[BOOTP_FILE] = 'boot_file' in host_data and host_data['boot_file'] or self.config.get_bootp_default_boot_file()
-
-        if not dhcp_msg_type:
-            self.log.warn('No DHCP message type found, discarding request')
-            return
-        if dhcp_msg_type == DHCP_DISCOVER:
-            self.log.debug('DHCP DISCOVER')
-            dhcp_reply = DHCP_OFFER
+            yiaddr = packet.ciaddr
+            ip = socket.inet_ntoa(yiaddr)
+        if dhcp_reply == DHCP_OFFER:
             self.log.info('Offering lease for MAC %s: IP %s' % \
                           (mac_str, ip))
-        elif dhcp_msg_type == DHCP_REQUEST:
-            self.log.debug('DHCP REQUEST')
-            dhcp_reply = DHCP_ACK
+        else:
             self.log.info('New lease for MAC %s: IP %s' % \
                           (mac_str, ip))
-        elif dhcp_msg_type == DHCP_RELEASE:
-            self.log.info('DHCP RELEASE')
-            if not self.notify:
-                return
-        elif dhcp_msg_type == DHCP_INFORM:
-            self.log.info('DHCP INFORM')
-            return
-        elif dhcp_msg_type == DHCP_DECLINE:
-            self.log.debug('DHCP DECLINE')
-            return
-        else:
-            self.log.error('Unmanaged DHCP message: %d' % dhcp_msg_type)
-            return
-
-        pkt = struct.pack(DHCPFormat, *buf)
-        pkt += struct.pack('!BBB', DHCP_MSG, 1, dhcp_reply)
-        #server = socket.inet_aton(server_addr)
-        # FIXME: Hardcoded relay and netmask
-        # Add something in lines of:
-        # networks:
-        #     10.40.13.160:
-        #         netmask: 255.255.255.224
-        #         gateway: 10.40.13.160
-        #         dns: 10.40.1.80, 10.40.1.81
-        server = socket.inet_aton('10.40.13.161')
-        pkt += struct.pack('!BB4s', DHCP_SERVER, 4, server)
-        #mask = socket.inet_aton(self.netconfig['mask'])
-        mask = socket.inet_aton('255.255.255.224')
-        pkt += struct.pack('!BB4s', DHCP_IP_MASK, 4, mask)
-        pkt += struct.pack('!BB4s', DHCP_IP_GATEWAY, 4, server)
-        # FIXME: Serving only default DNS for now
-        dns = self.config.get_bootp_default_dns()
+        if relayed:
+            self.log.debug('Reply via gateway: %s' % gi_str)
+        # sname
+        sname = host_data['hostname'] and \
+            '.'.join([host_data['hostname'], host_data['domain']]) or ''
+        # file
+        client_class = self.classes and self.classes.match(options)
+        self.class_matches.inc(client_class and client_class.name or 'none')
+        bootfile = host_data.get('boot_file') or \
+                   (client_class and client_class.boot_file) or \
+                   (network and network.boot_file) or \
+                   config.get_bootp_default_boot_file()
+        prefetch = [bootfile] + to_list(host_data.get('prefetch'))
+        httpclient = config.enable_httpboot and self.get_http_client(options)
+        if httpclient:
+            url = self.get_http_boot_url(bootfile, server_addr, config)
+            if url:
+                self.log.info('HTTP boot (%s) from %s' % (httpclient, url))
+                bootfile = url
+            else:
+                httpclient = None
 
+        server = network and network.server_id or siaddr
+        if network:
+            mask = network.packed_mask
+            routers = network.routers
+            dns = network.dns or self.default_dns
+            lease_time = network.lease_time
+        else:
+            mask = socket.inet_aton(netconfig['mask'])
+            routers = relayed and gi_addr or ''
+            dns = self.default_dns
+            lease_time = None
+        encoder = self.encoder
+        encoder.begin(packet, yiaddr, siaddr, gi_addr, flags, sname=sname,
+                      bootfile=bootfile)
+        encoder.add_byte(DHCP_MSG, dhcp_reply)
+        encoder.add_ip(DHCP_SERVER, server)
+        encoder.add_ip(DHCP_IP_MASK, mask)
+        if routers:
+            encoder.add_option(DHCP_IP_GATEWAY, routers)
+        if dns is None:
+            dns = server
         if dns:
-            if dns.lower() == 'auto':
-                dns = self.get_dns_server() or socket.inet_ntoa(server)
-            dns = socket.inet_aton(dns)
-            pkt += struct.pack('!BB4s', DHCP_IP_DNS, 4, dns)
-        pkt += struct.pack('!BBI', DHCP_LEASE_TIME, 4,
-                           int(self.config.get_bootp_default_lease_time()))
-        pkt += struct.pack('!BB', DHCP_END, 0)
+            encoder.add_option(DHCP_IP_DNS, dns)
+        encoder.add_int(DHCP_LEASE_TIME, lease_time or \
+                        int(config.get_bootp_default_lease_time()))
 
         # do not attempt to produce a PXE-augmented response for
         # regular DHCP requests
         if pxe:
-            extra_buf = self.build_pxe_options(options, server)
-            if not extra_buf:
+            if not self.build_pxe_options(options, siaddr, encoder,
+                                          httpclient != 'uefi'):
+                self.dropped.inc('missing_pxe_options')
                 return
         else:
-            extra_buf = self.build_dhcp_options(hostname)
+            if httpclient == 'uefi':
+                encoder.add_option(DHCP_CLASS_ID, 'HTTPClient')
+            self.build_dhcp_options(hostname, encoder)
+        if client_class:
+            for tag, value in client_class.options:
+                encoder.add_option(tag, value)
+        pkt = encoder.end()
 
         # update the UUID cache
         if pxe:
             self.uuidpool[mac_addr] = uuid
 
         # send the response
-        if gi_addr:
-            sock.sendto(pkt + extra_buf, (gi_str, 67))
-        else:
-            sock.sendto(pkt + extra_buf, addr)
+        if relayed:
+            addr = (gi_str, 67)
+        self.send(sock, pkt, addr)
+        self.sent.inc(DHCP_MESSAGES[dhcp_reply])
+        if not httpclient:
+            # the TFTP request of the client is due shortly
+            self.notify_prefetch(prefetch)
+        if dhcp_reply == DHCP_ACK:
+            # the TFTP server resolves the client file from its address
+            self.filepool[ip] = bootfile.strip('\x00')
+        if self.replies is not None:
+            self.replies.put(cache_key, pkt.tobytes(), addr, now)
 
         # update the current state
         if currentstate != newstate:
             self.log.info('Moving from state %d to state %d' % \
                             (currentstate, newstate))
+            self.transitions.inc(self.STATE_NAMES[currentstate],
+                                 self.STATE_NAMES[newstate])
             self.states[mac_str] = newstate
+        self.publish_client(mac_str, mac_addr)
+
+    def is_allowed(self, mac_str, uuid_str):
+        """Tell whether a client may be served, according to the ACL"""
+        if not self.access:
+            return True
+        if self.access == 'mac':
+            allowed = self.acl.get(mac_str, False)
+        elif self.access == 'uuid':
+            allowed = uuid_str and self.acl.get(uuid_str, False)
+        else:
+            allowed = self.acl.check(mac_str, uuid_str)
+            if allowed is None:
+                self.log.info('Access for %s is pending' % mac_str)
+                self.dropped.inc('access_pending')
+                return False
+        if not allowed:
+            self.log.info('Access denied for %s' % mac_str)
+            self.dropped.inc('access_denied')
+        return allowed
 
     def get_dns_server(self):
         nscre = re.compile('nameserver\s+(\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})\s')
@@ -504,16 +756,267 @@ class BootpServer:
         self.log.info('No nameserver found')
         return None
 
+    def add_prefetch_listener(self, listener):
+        """Register a callable, invoked with the files a client is about
+           to request, when it is offered or acknowledged a lease"""
+        self.prefetch_listeners.append(listener)
+
+    def notify_prefetch(self, names):
+        for listener in self.prefetch_listeners:
+            try:
+                listener(names)
+            except Exception, e:
+                self.log.error('Prefetch failed: %s' % e)
+
     def get_filename(self, ip):
         """Returns the filename defined for a host"""
         filename = self.filepool.get(ip, '')
         self.log.info("Filename for IP %s is '%s'" % (ip, filename))
         return filename
 
-    def get_host_data_for_mac(self, mac_str):
+    def get_lease(self, ip):
+        """Returns the MAC address leased an IP address, if any"""
+        return self.ipleases.get(ip)
+
+    def assign_address(self, mac_str, ip):
+        self.unassign_address(mac_str)
+        self.ippool[mac_str] = ip
+        self.ipleases[ip] = mac_str
+
+    def unassign_address(self, mac_str):
+        ip = self.ippool.pop(mac_str, None)
+        if ip and self.ipleases.get(ip) == mac_str:
+            del self.ipleases[ip]
+
+    def build_networks(self, config):
+        """Index the served subnets defined in the configuration"""
+        try:
+            networks = NetworkIndex.from_config(config.get_networks(),
+                                                self.get_dns_server)
+        except NetworkError, e:
+            raise BootpError(str(e))
+        for network in networks:
+            pool = network.pool
+            self.log.info('Serving network %r%s' % (network, pool and \
+                ', dynamic pool %s-%s (%d addresses)' % \
+                (inttoip(pool.first), inttoip(pool.last), pool.free) or ''))
+        return networks
+
+    def build_classes(self, config):
+        """Compile the client class rules defined in the configuration"""
+        try:
+            classes = ClientClassIndex([ClientClass(rule) for rule in
+                                        config.get_client_classes()])
+        except ClientClassError, e:
+            raise BootpError(str(e))
+        if not classes:
+            return None
+        self.log.info('Client classes: %d rules' % len(classes))
+        return classes
+
+    def migrate_leases(self, networks):
+        """Move the dynamic leases into the pools of new networks"""
+        for mac_str, (ip, expiry, pool) in self.dynleases.items():
+            network = networks.lookup(ip)
+            pool = network and network.pool
+            if pool and ip in pool and pool.reserve(ip):
+                self.dynleases[mac_str] = (ip, expiry, pool)
+            else:
+                self.log.info('Dropping lease %s of MAC %s, out of the new '
+                              'pools' % (inttoip(ip), mac_str))
+                del self.dynleases[mac_str]
+                self.unassign_address(mac_str)
+
+    def allocate_address(self, mac_str, network, config):
+        """Return the dynamic address leased to a client, if any"""
+        now = time.time()
+        lease_time = network.lease_time or \
+                     int(config.get_bootp_default_lease_time())
+        lease = self.dynleases.get(mac_str)
+        if lease and lease[0] in network:
+            ip, _, pool = lease
+        else:
+            # the client moved to another subnet
+            if lease:
+                self.release_address(mac_str)
+            pool = network.pool
+            ip = pool.allocate()
+            if ip is None:
+                self.reclaim_expired(now)
+                ip = pool.allocate()
+            if ip is None:
+                self.log.error('No more IP available in pool %s-%s' % \
+                               (inttoip(pool.first), inttoip(pool.last)))
+                return None
+        self.dynleases[mac_str] = (ip, now+lease_time, pool)
+        return inttoip(ip)
+
+    def release_address(self, mac_str, publish=True):
+        lease = self.dynleases.pop(mac_str, None)
+        if not lease:
+            return
+        ip, _, pool = lease
+        pool.release(ip)
+        self.unassign_address(mac_str)
+        self.filepool.pop(inttoip(ip), None)
+        self.log.info('Released IP %s for MAC %s' % (inttoip(ip), mac_str))
+        if publish:
+            self.publish_client(mac_str)
+
+    def get_client_fields(self, mac_str, mac_addr=None):
+        """Return the state of a client, as replicated"""
+        mac_addr = mac_addr or unhexlify(mac_str.replace(':', ''))
+        ip = self.ippool.get(mac_str)
+        lease = self.dynleases.get(mac_str)
+        uuid = self.uuidpool.get(mac_addr)
+        return {'ip': ip,
+                'expiry': lease and lease[1],
+                'state': self.states.get(mac_str, self.ST_IDLE),
+                'uuid': uuid and hexlify(uuid),
+                'file': ip and self.filepool.get(ip)}
+
+    def publish_client(self, mac_str, mac_addr=None):
+        """Replicate the state of a client to the other nodes"""
+        if not self.replicator:
+            return
+        self.replicator.publish(mac_str,
+                                self.get_client_fields(mac_str, mac_addr))
+
+    def apply_client(self, mac_str, fields):
+        """Apply the state of a client, from another node or process"""
+        mac_str = str(mac_str)
+        mac_addr = unhexlify(mac_str.replace(':', ''))
+        ip = fields.get('ip') and str(fields['ip'])
+        lease = self.dynleases.get(mac_str)
+        if lease and (not ip or lease[0] != iptoint(ip)):
+            self.release_address(mac_str, False)
+        if ip and fields.get('expiry') and \
+           not self.reserve_replicated(mac_str, iptoint(ip),
+                                       fields['expiry']):
+            ip = None
+        if ip:
+            self.assign_address(mac_str, ip)
+            if fields.get('file'):
+                self.filepool[ip] = str(fields['file'])
+        else:
+            self.unassign_address(mac_str)
+        if fields.get('state'):
+            self.states[mac_str] = fields['state']
+        else:
+            self.states.pop(mac_str, None)
+        if fields.get('uuid'):
+            self.uuidpool[mac_addr] = unhexlify(fields['uuid'])
+        else:
+            self.uuidpool.pop(mac_addr, None)
+
+    def apply_replicated(self):
+        """Apply the client changes received from the other nodes"""
+        for mac_str, fields in self.replicator.drain():
+            self.apply_client(mac_str, fields)
+
+    def export_state(self):
+        """Return the state of the clients, for a new server process"""
+        clients = set(self.ippool) | set(self.states) | set(self.dynleases)
+        return {'clients': dict([(mac_str, self.get_client_fields(mac_str))
+                                 for mac_str in clients])}
+
+    def describe_clients(self, mac=None):
+        """Return the state of the clients, or of a single one, as shown by
+           the admin endpoint"""
+        if mac:
+            macs = [mac.upper()]
+        else:
+            # key lists are copied at once, the pools change meanwhile
+            macs = set(self.ippool.keys()) | set(self.states.keys()) | \
+                   set(self.dynleases.keys())
+        now = time.time()
+        clients = []
+        for mac_str in sorted(macs):
+            fields = self.get_client_fields(mac_str)
+            if not fields['ip'] and mac_str not in self.states:
+                continue
+            state = fields['state']
+            clients.append({'mac': mac_str,
+                            'ip': fields['ip'],
+                            'state': self.STATE_NAMES[state],
+                            'dynamic': fields['expiry'] is not None,
+                            'expires_in': fields['expiry'] and
+                                          int(fields['expiry']-now),
+                            'uuid': fields['uuid'],
+                            'file': fields['file']})
+        return clients
+
+    def import_state(self, state):
+        """Take the clients of the previous server process over"""
+        clients = (state or {}).get('clients') or {}
+        for mac_str, fields in clients.iteritems():
+            self.apply_client(mac_str, fields)
+            # the records of this node run start from the inherited ones
+            self.publish_client(str(mac_str))
+        if clients:
+            self.log.info('Took %d clients over' % len(clients))
+
+    def reserve_replicated(self, mac_str, ip, expiry):
+        """Take the dynamic lease of a client from another node
+
+           Returns False if the address is leased here to a client whose
+           lease is more recent.
+        """
+        network = self.networks.lookup(ip)
+        pool = network and network.pool
+        if not pool or ip not in pool:
+            return True
+        lease = self.dynleases.get(mac_str)
+        if not (lease and lease[0] == ip) and not pool.reserve(ip):
+            holder = self.get_lease(inttoip(ip))
+            if not holder or not self.replicator or \
+               self.replicator.stamp(holder) > self.replicator.stamp(mac_str):
+                self.log.warn('Replication conflict on IP %s: kept for %s, '
+                              'not leased to %s' % (inttoip(ip), holder,
+                                                    mac_str))
+                return False
+            self.log.warn('Replication conflict on IP %s: leased to %s '
+                          'instead of %s' % (inttoip(ip), mac_str, holder))
+            self.release_address(holder, False)
+            pool.reserve(ip)
+        self.dynleases[mac_str] = (ip, expiry, pool)
+        return True
+
+    def reclaim_expired(self, now):
+        """Return every expired dynamic lease to its pool"""
+        expired = [mac for mac, (_, expiry, _) in self.dynleases.iteritems()
+                   if expiry < now]
+        for mac_str in expired:
+            self.release_address(mac_str)
+        self.log.info('Reclaimed %d expired leases' % len(expired))
+
+    def get_dynamic_host_data(self, mac_str, network, config):
+        ipaddr = self.allocate_address(mac_str, network, config)
+        if not ipaddr:
+            return None
+        return {'address': ipaddr, 'hostname': '', 'domain': '',
+                'boot_file': None}
+
+    def get_host_data_failure(self, mac_str, network, config):
+        """Tell why no host data is available for a client"""
+        try:
+            lease = config.get_lease_for_mac(mac_str)
+        except InventoryError:
+            return 'inventory_error'
+        if not lease:
+            return network and network.pool and 'pool_exhausted' or \
+                'unknown_mac'
+        if not lease.get('hostname'):
+            return 'no_hostname'
+        return 'dns_failure'
+
+    def get_host_data_for_mac(self, mac_str, config=None):
         self.log.debug("Host data requested for MAC: %s" % mac_str)
         try:
-            host_lease_data = self.config.get_lease_for_mac(mac_str)
+            host_lease_data = (config or self.config).get_lease_for_mac(mac_str)
+            if not host_lease_data:
+                self.log.debug("No static lease for mac: %s" % mac_str)
+                return
             hostname = 'hostname' in host_lease_data and host_lease_data['hostname']
             if not hostname:
                 self.log.error("No hostname defined for mac: {mac}".format(mac=mac_str))
@@ -529,10 +1032,13 @@ class BootpServer:
             hostdata = {}
             hostdata['address'] = ipaddr
             hostdata['hostname'] = hostname
-            hostdata['domain'] = ".".join(hostname.strip().split(".")[1:])
-            hostdata['boot_file'] = host_lease_data['boot_file']
-            print hostdata
+            hostdata['domain'] = host_lease_data.get('domain') or ''
+            hostdata['boot_file'] = host_lease_data.get('boot_file')
+            hostdata['prefetch'] = host_lease_data.get('prefetch')
+            self.log.debug("Host data: %s" % hostdata)
             return hostdata
+        except InventoryError, e:
+            self.log.error("Cannot read lease inventory: %s" % e)
         except IOError, e:
             self.log.error("No file {dhcp_home}/{mac_str} found!".format(dhcp_home=self.dhcp_home, mac_str=mac_str))
 
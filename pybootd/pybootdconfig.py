@@ -17,14 +17,13 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import marshal
 import sys
 import os
-
-try:
-    import yaml
-except:
-    print "Please install yaml module"
-    sys.exit(1)
+import tempfile
+import threading
+import time
+from inventory import InventoryError, YamlInventory, open_inventory
 
 LOGGER_TYPE = 'stderr'
 LOGGER_LEVEL = 'info'
@@ -33,23 +32,72 @@ BOOTP_PORT = 67
 BOOTP_DEFAULT_BOOT_FILE = '\x00'
 BOOTP_DEFAULT_LEASE_TIME = 7200
 BOOTP_DEFAULT_DNS = 'auto'
+BOOTP_REPLY_CACHE_TTL = 10
+BOOTP_RATE_LIMIT = 10
+BOOTP_RATE_BURST = 20
+BOOTP_GLOBAL_RATE_LIMIT = 0
+BOOTP_GLOBAL_RATE_BURST = 0
 
 TFTP_BLOCKSIZE = 512
 TFTP_TIMEOUT = 2.0
 TFTP_PORT = 69
+TFTP_WORKERS = 64
+TFTP_QUEUE_SIZE = 128
+TFTP_STALL_TIMEOUT = 30.0
+TFTP_INDEX_INTERVAL = 5.0
 
-class PyBootdConfig(object):
+HTTPBOOT_PORT = 8080
+
+PREFETCH_TTL = 300
+PREFETCH_WORKERS = 2
+PREFETCH_CACHE_SIZE = '64M'
+
+REMOTE_CHUNK_SIZE = '1M'
+REMOTE_READ_AHEAD = 4
+REMOTE_CACHE_SIZE = '256M'
+REMOTE_WORKERS = 4
+REMOTE_TIMEOUT = 10.0
+REMOTE_TTL = 60
+
+PROFILING_DURATION = 30
+PROFILING_INTERVAL = 0.005
+
+# bumped whenever the layout of the compiled configuration changes
+CONFIG_CACHE_VERSION = 1
+
+
+def load_yaml(stream):
+    """Parse a YAML document, with the C parser if available"""
+    # only needed when the compiled configuration is out of date
+    try:
+        import yaml
+    except ImportError:
+        print "Please install yaml module"
+        sys.exit(1)
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader',
+                                            yaml.SafeLoader))
+
+
+class ConfigError(Exception):
+    """Invalid configuration"""
+    pass
 
-    def __init__(self, config_file):
-        try:
-            self.enable_bootp = True
-            self.enable_tftp = True
-            self.__config = yaml.load(open(config_file, 'r').read())
-            print("Configuration loaded from {config}.".format(config=config_file))
-            self.__validate_config()
-        except Exception, err:
-            print("Failed to parse or validate configuration file!\n{err}".format(err=err))
-            sys.exit(1)
+
+class ConfigSnapshot(object):
+    """Validated configuration, as loaded from a configuration file
+
+       A snapshot is never modified once built: a reload creates a new one.
+    """
+
+    def __init__(self, config, previous=None, compiled=None):
+        self.enable_bootp = True
+        self.enable_tftp = True
+        self.enable_httpboot = False
+        if not isinstance(config, dict):
+            raise ConfigError('Configuration is not a mapping')
+        self.__config = config
+        self.__validate_config()
+        self.__inventory = self.__open_inventory(previous, compiled)
 
     def __section_exists(self, section):
         if not section in self.__config.keys():
@@ -85,16 +133,78 @@ class PyBootdConfig(object):
             self.enable_bootp = False
         else:
             if not self.__key_exists('bootp', 'bind_interface'):
-                print("ERROR: 'bootp' parameter 'bind_interface' is not defined, can't start bootp!")
-                sys.exit(1)
+                raise ConfigError("'bootp' parameter 'bind_interface' is not defined, can't start bootp!")
 
         if not self.__section_exists("tftp"):
             print("WARNING: no tftp configuration found, tftp listener won't be started!")
             self.enable_tftp = False
         else:
             if not self.__key_exists('tftp', 'bind_interface'):
-                print("ERROR: 'tftp' parameter 'bind_interface' is not defined, can't start tftp!")
-                sys.exit(1)
+                raise ConfigError("'tftp' parameter 'bind_interface' is not defined, can't start tftp!")
+
+        if self.__section_exists("httpboot"):
+            if not self.__key_exists('httpboot', 'bind_interface') and \
+               not self.__key_exists('tftp', 'bind_interface'):
+                raise ConfigError("'httpboot' parameter 'bind_interface' is not defined, can't start http boot!")
+            self.enable_httpboot = True
+
+    def __open_inventory(self, previous, compiled=None):
+        """Open the static lease inventory
+
+           The inventory of a previous snapshot is reused if unmodified,
+           the compiled 'bootp_leases' table restored if provided.
+        """
+        leases = self.__config.get('bootp_leases') or {}
+        if not isinstance(leases, dict):
+            raise ConfigError("'bootp_leases' is not a mapping")
+        try:
+            inventory = open_inventory(self.get_section('inventory'), leases,
+                                       previous and previous.__inventory)
+            if compiled is not None and isinstance(inventory, YamlInventory):
+                inventory.restore(compiled)
+            elif not self.__section_exists('inventory'):
+                # leases are in memory already, report errors right away
+                inventory.load()
+        except InventoryError, e:
+            raise ConfigError(str(e))
+        return inventory
+
+    def compile(self):
+        """Return the validated configuration and the compiled lease
+           table, which rebuild the snapshot when given back to the
+           constructor. Both are plain marshallable values.
+        """
+        config = dict(self.__config)
+        compiled = None
+        if isinstance(self.__inventory, YamlInventory):
+            # leases are kept as a sorted table, no need for them twice
+            config.pop('bootp_leases', None)
+            compiled = self.__inventory.export()
+        return config, compiled
+
+    def diff(self, other):
+        """Report what changed from this snapshot to another one"""
+        sections = set(self.__config.keys()) | set(other.__config.keys())
+        sections.discard('bootp_leases')
+        if self.__inventory is other.__inventory:
+            added, removed, changed = [], [], []
+        else:
+            added, removed, changed = \
+                self.__inventory.diff(other.__inventory)
+        return {'sections': sorted([s for s in sections if \
+                    self.__config.get(s) != other.__config.get(s)]),
+                'leases_added': added,
+                'leases_removed': removed,
+                'leases_changed': changed}
+
+    def has_section(self, section):
+        return self.__section_exists(section)
+
+    def get_section(self, section):
+        if not self.__section_exists(section):
+            return {}
+        else:
+            return self.__config[section] or {}
 
     def get_logger_type(self):
         return self.__config['logger']['type']
@@ -111,6 +221,12 @@ class PyBootdConfig(object):
     def get_bootp_bind_interface(self):
         return self.__config['bootp']['bind_interface']
 
+    def get_bootp_bind_interfaces(self):
+        interfaces = self.__config['bootp']['bind_interface']
+        if not isinstance(interfaces, list):
+            interfaces = [interfaces]
+        return interfaces
+
     def get_bootp_port(self):
         if self.__key_exists('bootp', 'port'):
             return self.__config['bootp']['port']
@@ -147,10 +263,52 @@ class PyBootdConfig(object):
         else:
             return None
 
+    def get_bootp_reply_cache_ttl(self):
+        if self.__key_exists('bootp', 'reply_cache_ttl'):
+            return self.__config['bootp']['reply_cache_ttl']
+        else:
+            return BOOTP_REPLY_CACHE_TTL
+
+    def get_bootp_rate_limit(self):
+        if self.__key_exists('bootp', 'rate_limit'):
+            return self.__config['bootp']['rate_limit']
+        else:
+            return BOOTP_RATE_LIMIT
+
+    def get_bootp_rate_burst(self):
+        if self.__key_exists('bootp', 'rate_burst'):
+            return self.__config['bootp']['rate_burst']
+        else:
+            return BOOTP_RATE_BURST
+
+    def get_bootp_global_rate_limit(self):
+        if self.__key_exists('bootp', 'global_rate_limit'):
+            return self.__config['bootp']['global_rate_limit']
+        else:
+            return BOOTP_GLOBAL_RATE_LIMIT
+
+    def get_bootp_global_rate_burst(self):
+        if self.__key_exists('bootp', 'global_rate_burst'):
+            return self.__config['bootp']['global_rate_burst']
+        else:
+            return BOOTP_GLOBAL_RATE_BURST
+
+    def get_bootp_socket_filter(self):
+        if self.__key_exists('bootp', 'socket_filter'):
+            return self.__config['bootp']['socket_filter']
+        else:
+            return False
+
 
     def get_tftp_bind_interface(self):
         return self.__config['tftp']['bind_interface']
 
+    def get_tftp_bind_interfaces(self):
+        interfaces = self.__config['tftp']['bind_interface']
+        if not isinstance(interfaces, list):
+            interfaces = [interfaces]
+        return interfaces
+
     def get_tftp_blocksize(self):
         if self.__key_exists('tftp', 'blocksize'):
             return self.__config['tftp']['blocksize']
@@ -169,21 +327,345 @@ class PyBootdConfig(object):
         else:
             return TFTP_PORT
 
+    def get_tftp_workers(self):
+        if self.__key_exists('tftp', 'workers'):
+            return self.__config['tftp']['workers']
+        else:
+            return TFTP_WORKERS
+
+    def get_tftp_queue_size(self):
+        if self.__key_exists('tftp', 'queue_size'):
+            return self.__config['tftp']['queue_size']
+        else:
+            return TFTP_QUEUE_SIZE
+
+    def get_tftp_stall_timeout(self):
+        if self.__key_exists('tftp', 'stall_timeout'):
+            return self.__config['tftp']['stall_timeout']
+        else:
+            return TFTP_STALL_TIMEOUT
+
+    def get_tftp_index(self):
+        if self.__key_exists('tftp', 'index'):
+            return self.__config['tftp']['index']
+        else:
+            # enabled if the root can be watched
+            return None
+
+    def get_tftp_index_interval(self):
+        if self.__key_exists('tftp', 'index_interval'):
+            return self.__config['tftp']['index_interval']
+        else:
+            return TFTP_INDEX_INTERVAL
+
+    def get_tftp_socket_filter(self):
+        if self.__key_exists('tftp', 'socket_filter'):
+            return self.__config['tftp']['socket_filter']
+        else:
+            return False
+
     def get_tftp_root(self):
         if self.__key_exists('tftp', 'root'):
             return self.__config['tftp']['root']
         else:
             return os.getcwd()
 
-    def get_leases(self):
-        if not self.__section_exists('bootp_leases'):
+    def get_httpboot_bind_interfaces(self):
+        if self.__key_exists('httpboot', 'bind_interface'):
+            interfaces = self.__config['httpboot']['bind_interface']
+            if not isinstance(interfaces, list):
+                interfaces = [interfaces]
+            return interfaces
+        else:
+            return self.get_tftp_bind_interfaces()
+
+    def get_httpboot_port(self):
+        if self.__key_exists('httpboot', 'port'):
+            return self.__config['httpboot']['port']
+        else:
+            return HTTPBOOT_PORT
+
+    def get_httpboot_root(self):
+        if self.__key_exists('httpboot', 'root'):
+            return self.__config['httpboot']['root']
+        else:
+            return self.get_tftp_root()
+
+    def get_httpboot_base_url(self):
+        if self.__key_exists('httpboot', 'base_url'):
+            return self.__config['httpboot']['base_url']
+        else:
+            return None
+
+    def get_httpboot_boot_file(self):
+        if self.__key_exists('httpboot', 'boot_file'):
+            return self.__config['httpboot']['boot_file']
+        else:
+            return None
+
+    def get_prefetch_enabled(self):
+        if self.__key_exists('prefetch', 'enabled'):
+            return self.__config['prefetch']['enabled']
+        else:
+            return True
+
+    def get_prefetch_chain(self):
+        if self.__key_exists('prefetch', 'chain'):
+            return self.__config['prefetch']['chain'] or {}
+        else:
             return {}
+
+    def get_prefetch_ttl(self):
+        if self.__key_exists('prefetch', 'ttl'):
+            return self.__config['prefetch']['ttl']
+        else:
+            return PREFETCH_TTL
+
+    def get_prefetch_workers(self):
+        if self.__key_exists('prefetch', 'workers'):
+            return self.__config['prefetch']['workers']
+        else:
+            return PREFETCH_WORKERS
+
+    def get_prefetch_cache_size(self):
+        if self.__key_exists('prefetch', 'cache_size'):
+            return self.__config['prefetch']['cache_size']
+        else:
+            return PREFETCH_CACHE_SIZE
+
+    def get_remote_enabled(self):
+        if self.__key_exists('remote', 'enabled'):
+            return self.__config['remote']['enabled']
         else:
-            return self.__config['bootp_leases']
+            return True
+
+    def get_remote_shared(self):
+        if self.__key_exists('remote', 'shared'):
+            return self.__config['remote']['shared']
+        else:
+            return True
+
+    def get_remote_chunk_size(self):
+        if self.__key_exists('remote', 'chunk_size'):
+            return self.__config['remote']['chunk_size']
+        else:
+            return REMOTE_CHUNK_SIZE
+
+    def get_remote_read_ahead(self):
+        if self.__key_exists('remote', 'read_ahead'):
+            return self.__config['remote']['read_ahead']
+        else:
+            return REMOTE_READ_AHEAD
+
+    def get_remote_cache_size(self):
+        if self.__key_exists('remote', 'cache_size'):
+            return self.__config['remote']['cache_size']
+        else:
+            return REMOTE_CACHE_SIZE
+
+    def get_remote_workers(self):
+        if self.__key_exists('remote', 'workers'):
+            return self.__config['remote']['workers']
+        else:
+            return REMOTE_WORKERS
+
+    def get_remote_timeout(self):
+        if self.__key_exists('remote', 'timeout'):
+            return self.__config['remote']['timeout']
+        else:
+            return REMOTE_TIMEOUT
+
+    def get_remote_ttl(self):
+        if self.__key_exists('remote', 'ttl'):
+            return self.__config['remote']['ttl']
+        else:
+            return REMOTE_TTL
+
+    def get_profiling_directory(self):
+        if self.__key_exists('profiling', 'directory'):
+            return self.__config['profiling']['directory']
+        else:
+            return tempfile.gettempdir()
+
+    def get_profiling_duration(self):
+        if self.__key_exists('profiling', 'duration'):
+            return self.__config['profiling']['duration']
+        else:
+            return PROFILING_DURATION
+
+    def get_profiling_interval(self):
+        if self.__key_exists('profiling', 'interval'):
+            return self.__config['profiling']['interval']
+        else:
+            return PROFILING_INTERVAL
+
+    def get_networks(self):
+        if not self.__section_exists('networks'):
+            return {}
+        else:
+            return self.__config['networks']
+
+    def get_client_classes(self):
+        if not self.__section_exists('client_classes'):
+            return []
+        else:
+            return self.__config['client_classes'] or []
+
+    def get_filters(self):
+        if not self.__section_exists('filters'):
+            return []
+        else:
+            return self.__config['filters'] or []
+
+    def get_inventory(self):
+        return self.__inventory
 
     def get_lease_for_mac(self, mac):
-        if not mac or not mac in self.get_leases().keys():
+        if not mac:
             return None
+        return self.__inventory.get(mac)
 
-        return self.get_leases()[mac]
+
+def format_diff(diff):
+    """Summarize a configuration diff on a single line"""
+    summary = 'leases: +%d -%d ~%d' % (len(diff['leases_added']),
+                                       len(diff['leases_removed']),
+                                       len(diff['leases_changed']))
+    if diff['sections']:
+        summary += ', sections changed: %s' % ', '.join(diff['sections'])
+    return summary
+
+
+class PyBootdConfig(object):
+    """Configuration file, which may be reloaded while running
+
+       Settings are read from the current snapshot. Code which needs a
+       consistent view across several settings, such as a request
+       handler, should fetch the snapshot once and use it throughout:
+       a reload swaps in a new snapshot, and leaves existing ones intact.
+    """
+
+    def __init__(self, config_file, cache_file=None):
+        self.config_file = config_file
+        # the compiled configuration, reused while the file is unchanged
+        self.cache_file = cache_file or '%s.cache' % config_file
+        self.__lock = threading.Lock()
+        self.__listeners = []
+        self.__stamp = None
+        self.__snapshot = None
+        self.__unwatched = threading.Event()
+        self.__watcher = None
+        try:
+            self.__snapshot = self.__load()
+            print("Configuration loaded from {config}.".format(config=config_file))
+        except Exception, err:
+            print("Failed to parse or validate configuration file!\n{err}".format(err=err))
+            sys.exit(1)
+
+    def __getattr__(self, name):
+        # getters are served by the current snapshot
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.__snapshot, name)
+
+    def __file_stamp(self):
+        stat = os.stat(self.config_file)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def __load(self):
+        stamp = self.__file_stamp()
+        # recorded even if the file fails to load: the watcher tries it
+        # again once it changes, not at every interval
+        self.__stamp = stamp
+        snapshot = self.__load_compiled(stamp)
+        if snapshot is None:
+            with open(self.config_file, 'r') as config:
+                snapshot = ConfigSnapshot(load_yaml(config), self.__snapshot)
+            self.__save_compiled(stamp, snapshot)
+        return snapshot
+
+    def __cache_key(self, stamp):
+        return (CONFIG_CACHE_VERSION, marshal.version, stamp)
+
+    def __load_compiled(self, stamp):
+        """Rebuild a snapshot from the compiled configuration, if current"""
+        try:
+            with open(self.cache_file, 'rb') as cache:
+                key, config, compiled = marshal.load(cache)
+            if key != self.__cache_key(stamp):
+                return None
+            return ConfigSnapshot(config, self.__snapshot, compiled)
+        except (IOError, EOFError, ValueError, TypeError, ConfigError):
+            return None
+
+    def __save_compiled(self, stamp, snapshot):
+        config, compiled = snapshot.compile()
+        try:
+            data = marshal.dumps((self.__cache_key(stamp), config, compiled))
+            # replace the file at once, another process may be reading it
+            tmpname = '%s.%d.tmp' % (self.cache_file, os.getpid())
+            with open(tmpname, 'wb') as cache:
+                cache.write(data)
+            os.rename(tmpname, self.cache_file)
+        except (IOError, OSError, ValueError):
+            # not cacheable (e.g. YAML dates) or not writable: parse it
+            # again next time
+            pass
+
+    def snapshot(self):
+        return self.__snapshot
+
+    def add_reload_listener(self, listener):
+        """Register a callable, invoked with (snapshot, diff) on reload"""
+        self.__listeners.append(listener)
+
+    def reload(self):
+        """Load the configuration file again and swap it in
+
+           The current snapshot is kept if the new one fails to load.
+           Returns the diff between both snapshots.
+        """
+        with self.__lock:
+            snapshot = self.__load()
+            diff = self.__snapshot.diff(snapshot)
+            self.__snapshot = snapshot
+        for listener in self.__listeners:
+            listener(snapshot, diff)
+        return diff
+
+    def reload_async(self, logger):
+        """Reload the configuration from a background thread"""
+        def _reload():
+            try:
+                diff = self.reload()
+                logger.warn('Configuration reloaded from %s (%s)' % \
+                            (self.config_file, format_diff(diff)))
+            except Exception, e:
+                logger.error('Configuration reload failed, keeping the '
+                             'current one: %s' % e)
+        reloader = threading.Thread(target=_reload, name='ConfigReload')
+        reloader.daemon = True
+        reloader.start()
+        return reloader
+
+    def watch(self, logger, interval=5.0):
+        """Reload the configuration whenever the file is modified"""
+        def _watch():
+            while not self.__unwatched.wait(interval):
+                try:
+                    changed = self.__file_stamp() != self.__stamp
+                except OSError:
+                    continue
+                if changed:
+                    self.reload_async(logger).join()
+        self.__watcher = threading.Thread(target=_watch, name='ConfigWatch')
+        self.__watcher.daemon = True
+        self.__watcher.start()
+
+    def unwatch(self):
+        """Stop watching the configuration file"""
+        self.__unwatched.set()
+        if self.__watcher:
+            self.__watcher.join()
+            self.__watcher = None
 
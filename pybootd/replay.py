@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Replay of captured boot traffic
+
+Feeds the client requests of a capture, as recorded with 'pybootd -r' or
+tcpdump, to a running server, at the original pace or faster, and
+compares the replies and their timing with the captured ones:
+
+   python -m pybootd.replay -s 127.0.0.1 -p 6767 -x 10 storm.pcap
+
+BOOTP requests are sent as is, except for the relay address (giaddr):
+it is cleared, so that the server replies to the replay tool directly,
+or set to the address given with -g. TFTP read requests are replayed as
+complete transfers, acknowledging every received block.
+
+The exit status is 1 if any reply is missing or differs from the
+captured one.
+"""
+
+from optparse import OptionParser
+from benchmarks import percentile
+from dhcpcodec import BootpCodecError, decode_packet, BOOTREPLY, \
+     BOOTREQUEST, BOOTP_GIADDR_OFFSET, BOOTP_MAX_SIZE, DHCP_ACK, \
+     DHCP_DISCOVER, DHCP_MSG, DHCP_NAK, DHCP_OFFER, DHCP_REQUEST, \
+     DHCP_SERVER
+from pcap import PcapReader
+from pybootd import __version__ as VERSION
+import json
+import select
+import socket
+import struct
+import sys
+import time
+
+# TFTP opcodes
+(TFTP_RRQ, TFTP_WRQ, TFTP_DATA, TFTP_ACK, TFTP_ERR, TFTP_OACK) = range(1, 7)
+TFTP_BLOCKSIZE = 512
+
+# replies expected for each request type, plain BOOTP has no type
+_EXPECTED = {DHCP_DISCOVER: (DHCP_OFFER,),
+             DHCP_REQUEST: (DHCP_ACK, DHCP_NAK),
+             None: (None,)}
+# options whose value depends on the server instance
+_VOLATILE_OPTIONS = (DHCP_SERVER,)
+_ZERO_ADDRESS = '\x00\x00\x00\x00'
+_MAX_REPORTED_MISMATCHES = 20
+
+
+class BootpExchange(object):
+    """A captured request, with its captured and replayed replies"""
+
+    __slots__ = ('timestamp', 'data', 'key', 'expected', 'reply',
+                 'reply_latency', 'sent', 'replayed', 'replay_latency')
+
+    def __init__(self, timestamp, data, packet):
+        self.timestamp = timestamp
+        self.data = data
+        self.key = (packet.chaddr[:6], packet.xid)
+        msgtype = packet.options.get_byte(DHCP_MSG)
+        self.expected = _EXPECTED.get(msgtype, ())
+        self.reply = None
+        self.reply_latency = None
+        self.sent = None
+        self.replayed = None
+        self.replay_latency = None
+
+
+class TftpSession(object):
+    """A captured read request, replayed as a complete transfer"""
+
+    __slots__ = ('timestamp', 'client', 'data', 'blocksize', 'captured_bytes',
+                 'captured_end', 'captured_error', 'sock', 'peer', 'block',
+                 'last', 'sent', 'started', 'retries', 'bytes', 'ended',
+                 'error')
+
+    def __init__(self, timestamp, client, data):
+        self.timestamp = timestamp
+        self.client = client
+        self.data = data
+        self.blocksize = TFTP_BLOCKSIZE
+        self.captured_bytes = 0
+        self.captured_end = timestamp
+        self.captured_error = None
+        self.sock = None
+        self.peer = None
+        self.block = 0
+        self.last = None
+        self.sent = 0.0
+        self.started = 0.0
+        self.retries = 0
+        self.bytes = 0
+        self.ended = None
+        self.error = None
+
+    @property
+    def filename(self):
+        return self.data[2:].split('\x00', 1)[0]
+
+
+def _parse_tftp_options(data):
+    fields = data.split('\x00')
+    return dict(zip([f.lower() for f in fields[0::2]], fields[1::2]))
+
+
+def load_capture(path, bootp_port=67, tftp_port=69):
+    """Extract the BOOTP exchanges and TFTP transfers of a capture"""
+    exchanges = []
+    pending = {}  # key (chaddr, xid), value exchanges awaiting a reply
+    sessions = []
+    transfers = {} # key client (address, port), value TftpSession
+    for timestamp, src, dst, data in PcapReader(path):
+        if bootp_port in (src[1], dst[1]):
+            try:
+                packet = decode_packet(data)
+            except BootpCodecError:
+                continue
+            if dst[1] == bootp_port and packet.op == BOOTREQUEST:
+                exchange = BootpExchange(timestamp, data, packet)
+                exchanges.append(exchange)
+                pending.setdefault(exchange.key, []).append(exchange)
+            elif src[1] == bootp_port and packet.op == BOOTREPLY:
+                msgtype = packet.options.get_byte(DHCP_MSG)
+                for exchange in pending.get((packet.chaddr[:6],
+                                             packet.xid), []):
+                    if exchange.reply is None and \
+                       msgtype in exchange.expected:
+                        exchange.reply = data
+                        exchange.reply_latency = \
+                            timestamp-exchange.timestamp
+                        break
+        elif dst[1] == tftp_port and data[:2] == struct.pack('!H', TFTP_RRQ):
+            session = TftpSession(timestamp, src, data)
+            sessions.append(session)
+            transfers[src] = session
+        elif dst in transfers and len(data) >= 4:
+            session = transfers[dst]
+            opcode = struct.unpack('!H', data[:2])[0]
+            if opcode == TFTP_DATA:
+                session.captured_bytes += len(data)-4
+                session.captured_end = timestamp
+            elif opcode == TFTP_ERR:
+                session.captured_error = data[4:].rstrip('\x00')
+                session.captured_end = timestamp
+    return exchanges, sessions
+
+
+def compare_replies(captured, replayed, strict=False):
+    """Return the differences between two replies, as a list of strings
+
+       Addresses and option values are only compared in strict mode,
+       as they depend on the state of the server.
+    """
+    old, new = decode_packet(captured), decode_packet(replayed)
+    diffs = []
+    oldtype = old.options.get_byte(DHCP_MSG)
+    newtype = new.options.get_byte(DHCP_MSG)
+    if oldtype != newtype:
+        diffs.append('message type %s != %s' % (oldtype, newtype))
+    if old.file != new.file:
+        diffs.append('boot file %r != %r' % (old.file, new.file))
+    oldtags, newtags = set(old.options.keys()), set(new.options.keys())
+    if oldtags != newtags:
+        diffs.append('options -%s +%s' % (sorted(oldtags-newtags),
+                                          sorted(newtags-oldtags)))
+    if strict:
+        if old.yiaddr != new.yiaddr:
+            diffs.append('address %s != %s' % (socket.inet_ntoa(old.yiaddr),
+                                               socket.inet_ntoa(new.yiaddr)))
+        for tag in sorted(oldtags & newtags):
+            if tag not in _VOLATILE_OPTIONS and \
+               old.options[tag] != new.options[tag]:
+                diffs.append('option %d value differs' % tag)
+    return diffs
+
+
+def _latency_ms(samples):
+    samples = sorted(samples)
+    count = len(samples)
+    return {'count': count,
+            'mean': count and sum(samples)*1e3/count or 0.0,
+            'p50': percentile(samples, 0.50)*1e3,
+            'p90': percentile(samples, 0.90)*1e3,
+            'p99': percentile(samples, 0.99)*1e3,
+            'max': count and samples[-1]*1e3 or 0.0}
+
+
+class Replayer(object):
+    """Replay captured requests against a server"""
+
+    def __init__(self, server, bootp_port=67, tftp_port=69, speed=1.0,
+                 timeout=2.0, retries=3, giaddr=None, strict=False):
+        self.server = server
+        self.bootp_port = bootp_port
+        self.tftp_port = tftp_port
+        self.speed = speed
+        self.timeout = timeout
+        self.retries = retries
+        self.giaddr = giaddr and socket.inet_aton(giaddr) or _ZERO_ADDRESS
+        self.strict = strict
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1<<22)
+        if giaddr:
+            # replies to relay agents are sent to the BOOTP server port
+            self.sock.bind((giaddr, 67))
+        else:
+            self.sock.bind(('', 0))
+        self.sock.setblocking(0)
+        self.counters = {'requests': 0, 'replies': 0, 'missing': 0,
+                         'mismatched': 0, 'unexpected': 0,
+                         'tftp_sessions': 0, 'tftp_completed': 0,
+                         'tftp_errors': 0, 'tftp_mismatched': 0}
+        self.mismatches = []
+
+    def _rewrite(self, data):
+        offset = BOOTP_GIADDR_OFFSET
+        return ''.join((data[:offset], self.giaddr, data[offset+4:]))
+
+    def send_bootp(self, exchange, pending, now):
+        exchange.sent = now
+        self.counters['requests'] += 1
+        pending.setdefault(exchange.key, []).append(exchange)
+        self.sock.sendto(self._rewrite(exchange.data),
+                         (self.server, self.bootp_port))
+
+    def receive_bootp(self, pending, now):
+        """Handle a reply, return False once no reply is left"""
+        try:
+            data, addr = self.sock.recvfrom(BOOTP_MAX_SIZE)
+        except socket.error:
+            return False
+        try:
+            packet = decode_packet(data)
+        except BootpCodecError:
+            self.counters['unexpected'] += 1
+            return True
+        msgtype = packet.options.get_byte(DHCP_MSG)
+        waiting = pending.get((packet.chaddr[:6], packet.xid), [])
+        for exchange in waiting:
+            if packet.op == BOOTREPLY and msgtype in exchange.expected:
+                break
+        else:
+            self.counters['unexpected'] += 1
+            return True
+        waiting.remove(exchange)
+        exchange.replayed = data
+        exchange.replay_latency = now-exchange.sent
+        self.counters['replies'] += 1
+        if exchange.reply:
+            diffs = compare_replies(exchange.reply, data, self.strict)
+            if diffs:
+                self.counters['mismatched'] += 1
+                if len(self.mismatches) < _MAX_REPORTED_MISMATCHES:
+                    self.mismatches.append({
+                        'mac': ':'.join(['%02X' % ord(x) for x in
+                                         exchange.key[0]]),
+                        'xid': exchange.key[1], 'differences': diffs})
+        return True
+
+    def start_tftp(self, session, now):
+        self.counters['tftp_sessions'] += 1
+        options = _parse_tftp_options(session.data[2:])
+        try:
+            session.blocksize = int(options.get('blksize', TFTP_BLOCKSIZE))
+        except ValueError:
+            pass
+        session.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        session.sock.bind(('', 0))
+        session.started = now
+        self._send_tftp(session, session.data, (self.server, self.tftp_port),
+                        now)
+
+    def _send_tftp(self, session, data, addr, now):
+        session.last = (data, addr)
+        session.sent = now
+        session.sock.sendto(data, addr)
+
+    def receive_tftp(self, session, now):
+        try:
+            data, addr = session.sock.recvfrom(65536)
+        except socket.error:
+            return
+        if len(data) < 4 or (session.peer and addr != session.peer):
+            return
+        session.peer = addr
+        session.retries = 0
+        opcode, block = struct.unpack('!HH', data[:4])
+        if opcode == TFTP_OACK:
+            options = _parse_tftp_options(data[2:])
+            if 'blksize' in options:
+                session.blocksize = int(options['blksize'])
+            self._send_tftp(session, struct.pack('!HH', TFTP_ACK, 0), addr,
+                            now)
+        elif opcode == TFTP_DATA:
+            if block == (session.block+1) & 0xffff:
+                session.block = block
+                session.bytes += len(data)-4
+            self._send_tftp(session, struct.pack('!HH', TFTP_ACK, block),
+                            addr, now)
+            if len(data)-4 < session.blocksize:
+                self._end_tftp(session, now)
+        elif opcode == TFTP_ERR:
+            self._end_tftp(session, now, data[4:].rstrip('\x00') or 'error')
+
+    def _end_tftp(self, session, now, error=None):
+        session.ended = now
+        session.error = error
+        session.sock.close()
+        session.sock = None
+        if error:
+            self.counters['tftp_errors'] += 1
+        else:
+            self.counters['tftp_completed'] += 1
+        if session.bytes != session.captured_bytes or \
+           bool(error) != bool(session.captured_error):
+            self.counters['tftp_mismatched'] += 1
+            if len(self.mismatches) < _MAX_REPORTED_MISMATCHES:
+                self.mismatches.append({
+                    'file': session.filename,
+                    'differences': ['%d bytes, %d captured%s' % \
+                        (session.bytes, session.captured_bytes,
+                         error and (', error: %s' % error) or '')]})
+
+    def run(self, exchanges, sessions):
+        events = [(e.timestamp, 0, e) for e in exchanges] + \
+                 [(s.timestamp, 1, s) for s in sessions]
+        events.sort(key=lambda event: event[:2])
+        events.reverse()
+        origin = events and events[-1][0] or 0.0
+        pending = {}
+        active = []
+        timer = time.time
+        start = timer()
+        while events or active or any(pending.itervalues()):
+            now = timer()
+            while events:
+                timestamp, kind, item = events[-1]
+                due = self.speed and start+(timestamp-origin)/self.speed \
+                      or start
+                if due > now:
+                    break
+                events.pop()
+                if kind:
+                    self.start_tftp(item, now)
+                    active.append(item)
+                else:
+                    self.send_bootp(item, pending, now)
+            wait = events and min(0.05, max(0.0, due-now)) or 0.05
+            socks = [self.sock] + [s.sock for s in active]
+            r, w, e = select.select(socks, [], [], wait)
+            now = timer()
+            for sock in r:
+                if sock is self.sock:
+                    # drain every queued reply
+                    while self.receive_bootp(pending, now):
+                        pass
+                else:
+                    for session in active:
+                        if session.sock is sock:
+                            self.receive_tftp(session, now)
+            active = [s for s in active if s.sock]
+            deadline = now-self.timeout
+            for session in active:
+                if session.sent < deadline:
+                    if session.retries < self.retries:
+                        session.retries += 1
+                        session.sock.sendto(*session.last)
+                        session.sent = now
+                    else:
+                        self._end_tftp(session, now, 'timeout')
+            active = [s for s in active if s.sock]
+            for key, waiting in pending.items():
+                expired = [x for x in waiting if x.sent < deadline]
+                for exchange in expired:
+                    waiting.remove(exchange)
+                    if exchange.reply:
+                        self.counters['missing'] += 1
+                if not waiting:
+                    del pending[key]
+        return self.report(exchanges, sessions, timer()-start)
+
+    def report(self, exchanges, sessions, duration):
+        timestamps = [e.timestamp for e in exchanges] + \
+                     [s.timestamp for s in sessions]
+        result = {'version': VERSION,
+                  'server': self.server,
+                  'speed': self.speed,
+                  'capture_duration_s': timestamps and \
+                      max(timestamps)-min(timestamps) or 0.0,
+                  'duration_s': duration,
+                  'captured_replies': len([e for e in exchanges if e.reply])}
+        result.update(self.counters)
+        result['capture_latency_ms'] = _latency_ms(
+            [e.reply_latency for e in exchanges if e.reply_latency is not None])
+        result['replay_latency_ms'] = _latency_ms(
+            [e.replay_latency for e in exchanges
+             if e.replay_latency is not None])
+        result['capture_transfer_ms'] = _latency_ms(
+            [s.captured_end-s.timestamp for s in sessions])
+        result['replay_transfer_ms'] = _latency_ms(
+            [s.ended-s.started for s in sessions if s.ended is not None])
+        result['mismatches'] = self.mismatches
+        return result
+
+
+def main():
+    usage = 'Usage: %prog [options] capture.pcap\n' \
+            '   Replay captured boot traffic against a server'
+    optparser = OptionParser(usage=usage)
+    optparser.add_option('-s', '--server', dest='server',
+                         default='127.0.0.1',
+                         help='address of the server')
+    optparser.add_option('-p', '--port', dest='port', type='int',
+                         default=67,
+                         help='BOOTP port of the server')
+    optparser.add_option('-t', '--tftp-port', dest='tftp_port', type='int',
+                         default=69,
+                         help='TFTP port of the server')
+    optparser.add_option('-c', '--capture-ports', dest='capture_ports',
+                         default='67,69',
+                         help='BOOTP and TFTP server ports in the capture')
+    optparser.add_option('-x', '--speed', dest='speed', type='float',
+                         default=1.0,
+                         help='replay speed factor, 0 for as fast as possible')
+    optparser.add_option('-w', '--timeout', dest='timeout', type='float',
+                         default=2.0,
+                         help='reply timeout, in seconds')
+    optparser.add_option('-g', '--giaddr', dest='giaddr',
+                         help='act as a relay agent with this local address')
+    optparser.add_option('-S', '--strict', dest='strict',
+                         action='store_true',
+                         help='also compare addresses and option values')
+    optparser.add_option('-o', '--output', dest='output', default='-',
+                         help='JSON result file (default: stdout)')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    if len(args) != 1:
+        optparser.error('A capture file is required')
+
+    bootp_port, tftp_port = [int(p) for p in
+                             options.capture_ports.split(',')]
+    exchanges, sessions = load_capture(args[0], bootp_port, tftp_port)
+    replayer = Replayer(options.server, options.port, options.tftp_port,
+                        speed=options.speed, timeout=options.timeout,
+                        giaddr=options.giaddr, strict=options.strict)
+    result = replayer.run(exchanges, sessions)
+    if options.output == '-':
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(options.output, 'w') as out:
+            json.dump(result, out, indent=2, sort_keys=True)
+    if result['missing'] or result['mismatched'] or \
+       result['tftp_mismatched']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
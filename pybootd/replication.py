@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Lease and client state replication between BOOTP servers
+
+Nodes are configured in the 'replication' section, the same on every
+node but for the 'node' key:
+
+    replication:
+        node: a
+        nodes:
+            a: 10.40.13.2:6700
+            b: 10.40.13.3:6700
+
+Every change to the state of a client (address, lease expiry, PXE state,
+UUID, boot file) is recorded as a whole client record, stamped with the
+time and name of the node it comes from, and numbered in a per-node
+change log. Each node streams its own changes to every peer over TCP, in
+batches of newline-delimited JSON messages. On reconnection, the peer
+tells the last change it received, and the stream resumes from there, or
+starts over with a snapshot of every record if the log no longer holds
+it, or if the node restarted in between.
+
+Conflicts are settled by the record stamps: the last writer wins.
+
+With 'split' enabled, each client is served by a single node, chosen
+from a hash of its MAC address among the nodes alive: a node whose
+stream is silent for 'dead_after' seconds no longer takes its share,
+which the others then serve, with the state it replicated.
+
+Peers are trusted: replication belongs to a private network.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import select
+import socket
+import threading
+import time
+import zlib
+
+__all__ = ['Replicator', 'ReplicationError']
+
+REPLICATION_BATCH_SIZE = 256
+REPLICATION_BATCH_INTERVAL = 0.05
+REPLICATION_HEARTBEAT = 1.0
+REPLICATION_DEAD_AFTER = 3.0
+REPLICATION_RETRY = 2.0
+REPLICATION_LOG_SIZE = 65536
+
+
+class ReplicationError(Exception):
+    """Replication error"""
+    pass
+
+
+def _parse_address(address):
+    host, sep, port = str(address).rpartition(':')
+    if not sep or not port.isdigit():
+        raise ReplicationError('Invalid node address: %s' % address)
+    return (host or '0.0.0.0', int(port))
+
+
+class Replicator(object):
+    """Replicated client records of one node
+
+       Local changes are published from the BOOTP serving thread. Changes
+       received from peers are queued, and applied from that same thread
+       by drain(), when fileno() becomes readable.
+    """
+
+    def __init__(self, logger, settings):
+        self.log = logger
+        settings = settings or {}
+        self.node = str(settings.get('node', ''))
+        nodes = settings.get('nodes') or {}
+        if not isinstance(nodes, dict) or self.node not in nodes:
+            raise ReplicationError("'node' should name one of the 'nodes'")
+        self.address = _parse_address(settings.get('listen',
+                                                   nodes[self.node]))
+        self.peers = dict([(str(name), _parse_address(address)) for
+                           name, address in nodes.iteritems()
+                           if str(name) != self.node])
+        self.split = settings.get('split', True)
+        self.batch_size = int(settings.get('batch_size',
+                                           REPLICATION_BATCH_SIZE))
+        self.batch_interval = float(settings.get('batch_interval',
+                                                 REPLICATION_BATCH_INTERVAL))
+        self.dead_after = float(settings.get('dead_after',
+                                             REPLICATION_DEAD_AFTER))
+        self.log_size = int(settings.get('log_size', REPLICATION_LOG_SIZE))
+        # node runs are told apart, as sequence numbers restart from 0
+        self.epoch = '%s-%.6f' % (self.node, time.time())
+        self._lock = threading.Condition(threading.Lock())
+        self._records = {} # key MAC string, value (stamp, fields)
+        self._log = [] # (seq, MAC string, stamp, fields), oldest first
+        self._seq = 0
+        self._last_stamp = 0.0
+        self._received = {} # key node, value (epoch, last seq)
+        self._alive = {} # key node, value time of its last message
+        self._incoming = []
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.listener = None
+        self._paused = False
+        self._stopped = threading.Event()
+        self._threads = []
+        self._conns = set() # replication connections, either way
+        self.stats = {'sent': 0, 'received': 0, 'applied': 0, 'stale': 0,
+                      'snapshots': 0}
+
+    def start(self, listener=None):
+        """Start replicating, on a listening socket of a previous process
+           if given"""
+        self.listener = listener
+        if not listener:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                     1)
+            self.listener.bind(self.address)
+            self.listener.listen(16)
+        self.log.info('Replicating on %s:%d to %s' % \
+                      (self.address + (', '.join(sorted(self.peers)),)))
+        self._spawn(self._accept, 'ReplicationListener')
+        for name in sorted(self.peers):
+            self._spawn(self._stream, 'Replication-%s' % name, name)
+
+    def stop(self):
+        """Close the replication connections and wait for their threads"""
+        if self._stopped.isSet():
+            return
+        self._stopped.set()
+        with self._lock:
+            self._lock.notify_all()
+            conns = list(self._conns)
+        for sock in conns:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for worker in self._threads:
+            worker.join()
+
+    def _spawn(self, target, name, *args):
+        worker = threading.Thread(target=target, name=name, args=args)
+        worker.daemon = True
+        worker.start()
+        self._threads.append(worker)
+
+    # BOOTP side
+
+    def fileno(self):
+        return self._wake_r
+
+    def publish(self, mac, fields):
+        """Record a local change of a client, if any"""
+        with self._lock:
+            current = self._records.get(mac)
+            if current and current[1] == fields:
+                return
+            now = max(time.time(), self._last_stamp+1e-6)
+            self._last_stamp = now
+            stamp = (now, self.node)
+            self._records[mac] = (stamp, fields)
+            self._seq += 1
+            self._log.append((self._seq, mac, stamp, fields))
+            if len(self._log) > 2*self.log_size:
+                self._log = self._log[-self.log_size:]
+            self._lock.notify_all()
+
+    def drain(self):
+        """Return the (MAC, fields) changes won by the peer records"""
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+            changes = []
+            for mac, stamp, fields in incoming:
+                current = self._records.get(mac)
+                if current and current[0] >= stamp:
+                    self.stats['stale'] += 1
+                    continue
+                self._records[mac] = (stamp, fields)
+                changes.append((mac, fields))
+        self.stats['applied'] += len(changes)
+        return changes
+
+    def stamp(self, mac):
+        record = self._records.get(mac)
+        return record and record[0]
+
+    def alive_nodes(self):
+        now = time.time()
+        return sorted([self.node] + [name for name, last in
+                                     self._alive.items()
+                                     if now-last < self.dead_after])
+
+    def is_responsible(self, mac):
+        """Tell whether this node serves a client"""
+        if not self.split or not self.peers:
+            return True
+        nodes = self.alive_nodes()
+        return nodes[(zlib.crc32(mac) & 0xffffffff) % len(nodes)] == \
+            self.node
+
+    # Sending side: one stream per peer, carrying the local changes
+
+    def _stream(self, name):
+        address = self.peers[name]
+        while not self._stopped.isSet():
+            sock = None
+            try:
+                sock = socket.create_connection(address, REPLICATION_RETRY)
+                with self._lock:
+                    self._conns.add(sock)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                reader = sock.makefile('r')
+                self._send(sock, {'type': 'hello', 'node': self.node,
+                                  'epoch': self.epoch})
+                reply = reader.readline()
+                if not reply:
+                    raise socket.error(errno.ECONNRESET, 'Connection closed')
+                sock.settimeout(None)
+                self.log.info('Replicating to %s' % name)
+                self._feed(sock, int(json.loads(reply)['last']))
+            except (socket.error, ValueError, KeyError), e:
+                self.log.debug('Replication to %s: %s' % (name, e))
+            finally:
+                if sock:
+                    with self._lock:
+                        self._conns.discard(sock)
+                    sock.close()
+            self._stopped.wait(REPLICATION_RETRY)
+
+    def _feed(self, sock, cursor):
+        # a peer which knows nothing of this node run may have lost the
+        # records this node learned from others as well
+        fresh = not cursor and self._records
+        while not self._stopped.isSet():
+            with self._lock:
+                first = self._log and self._log[0][0] or self._seq+1
+                if fresh or cursor > self._seq or cursor+1 < first:
+                    # the peer missed changes no longer logged
+                    fresh = False
+                    records = [[mac, stamp, fields] for mac, (stamp, fields)
+                               in self._records.iteritems()]
+                    cursor = self._seq
+                    message = {'type': 'snapshot', 'seq': cursor,
+                               'records': records}
+                    self.stats['snapshots'] += 1
+                elif cursor == self._seq:
+                    self._lock.wait(REPLICATION_HEARTBEAT)
+                    message = None
+                else:
+                    start = cursor+1-first
+                    entries = self._log[start:start+self.batch_size]
+                    message = {'type': 'batch', 'first': cursor+1,
+                               'seq': entries[-1][0],
+                               'records': [[mac, stamp, fields] for
+                                           _, mac, stamp, fields in entries]}
+                    cursor = entries[-1][0]
+            if message is None:
+                if cursor == self._seq:
+                    self._send(sock, {'type': 'ping'})
+                else:
+                    # let the changes of a burst pile up into a batch
+                    self._stopped.wait(self.batch_interval)
+                continue
+            self._send(sock, message)
+            self.stats['sent'] += len(message['records'])
+
+    def _send(self, sock, message):
+        sock.sendall(json.dumps(message) + '\n')
+
+    # Receiving side: one connection per peer, carrying its changes
+
+    def pause(self, paused=True):
+        """Stop accepting peers, while another process takes the listening
+           socket over, or resume"""
+        self._paused = paused
+
+    def _accept(self):
+        while not self._stopped.isSet():
+            if self._paused:
+                time.sleep(0.1)
+                continue
+            try:
+                # the listener may be handed over to a new process
+                r, w, e = select.select([self.listener], [], [], 1.0)
+                if not r or self._paused:
+                    continue
+                sock, peer = self.listener.accept()
+            except (socket.error, select.error), e:
+                if e[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            self._spawn(self._receive, 'ReplicationPeer', sock)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError, e:
+            # a full pipe already wakes the BOOTP thread up
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _receive(self, sock):
+        name = None
+        with self._lock:
+            self._conns.add(sock)
+        try:
+            reader = sock.makefile('r')
+            hello = json.loads(reader.readline())
+            name, epoch = hello['node'], hello['epoch']
+            if name not in self.peers:
+                raise ValueError('Unknown node %s' % name)
+            known = self._received.get(name)
+            last = known and known[0] == epoch and known[1] or 0
+            self._send(sock, {'last': last})
+            self._alive[name] = time.time()
+            self.log.info('Replicating from %s' % name)
+            for line in reader:
+                message = json.loads(line)
+                kind = message['type']
+                self._alive[name] = time.time()
+                if kind == 'ping':
+                    continue
+                if kind == 'batch' and message['first'] != last+1:
+                    raise ValueError('Missing changes %d-%d' % \
+                                     (last+1, message['first']-1))
+                records = [(mac, tuple(stamp), fields) for
+                           mac, stamp, fields in message['records']]
+                with self._lock:
+                    self._incoming.extend(records)
+                self._wake()
+                last = message['seq']
+                self._received[name] = (epoch, last)
+                self.stats['received'] += len(records)
+        except (socket.error, ValueError, KeyError, TypeError), e:
+            self.log.warn('Replication from %s: %s' % (name or 'peer', e))
+        finally:
+            with self._lock:
+                self._conns.discard(sock)
+            sock.close()
+            if name:
+                self.log.warn('Replication from %s interrupted' % name)
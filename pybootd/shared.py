@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""State shared between the BOOTP and TFTP processes
+
+When the servers run in separate processes, the TFTP server reaches the
+BOOTP state (client boot files and leases) through a BootpProxy, which
+queries a BootpExporter running in the BOOTP process. The exporter also
+notifies the proxy of the boot files to prefetch.
+
+Both ends are connected by a pair of local datagram sockets, created by
+the supervisor before the processes are forked: as the supervisor keeps
+them open, a restarted process reuses the same pair.
+"""
+
+import errno
+import json
+import socket
+import threading
+
+__all__ = ['BootpProxy', 'BootpExporter', 'shared_socketpair']
+
+SHARED_TIMEOUT = 1.0
+SHARED_MAX_SIZE = 65536
+
+
+def shared_socketpair():
+    """Create the sockets connecting a proxy to an exporter"""
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+
+class BootpProxy(object):
+    """Stand-in for a BOOTP server running in another process
+
+       Queries of several threads may be in flight at once: replies are
+       matched to their query by sequence number, and queries are answered
+       with None once timed out. Replies and notifications are read by a
+       thread of the proxy.
+    """
+
+    def __init__(self, sock, logger, timeout=SHARED_TIMEOUT):
+        self.sock = sock
+        self.log = logger
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._pending = {} # key sequence number, value [event, result]
+        self._prefetch_listeners = []
+        reader = threading.Thread(target=self._read, name='BootpProxy')
+        reader.daemon = True
+        reader.start()
+
+    def get_filename(self, ip):
+        return self._query('get_filename', ip) or ''
+
+    def get_lease(self, ip):
+        return self._query('get_lease', ip)
+
+    def add_prefetch_listener(self, listener):
+        self._prefetch_listeners.append(listener)
+
+    def _query(self, method, arg):
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._pending[seq] = waiter
+        try:
+            self.sock.send(json.dumps([seq, method, arg]))
+            if not waiter[0].wait(self.timeout):
+                self.log.error('No answer from the BOOTP process to %s' % \
+                               method)
+                return None
+            return waiter[1]
+        finally:
+            with self._lock:
+                del self._pending[seq]
+
+    def _read(self):
+        while True:
+            try:
+                seq, result = json.loads(self.sock.recv(SHARED_MAX_SIZE))
+            except socket.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            except ValueError, e:
+                self.log.error('Invalid message from the BOOTP process: %s' %
+                               e)
+                continue
+            if not seq:
+                # notification, rather than a reply
+                method, arg = result
+                if method == 'prefetch':
+                    for listener in self._prefetch_listeners:
+                        listener(arg)
+                continue
+            with self._lock:
+                # replies to queries which timed out are discarded
+                waiter = self._pending.get(seq)
+            if waiter:
+                waiter[1] = result
+                waiter[0].set()
+
+
+class BootpExporter(threading.Thread):
+    """Answer the queries of a BootpProxy, from the BOOTP process"""
+
+    METHODS = ('get_filename', 'get_lease')
+
+    def __init__(self, sock, bootpd, logger):
+        threading.Thread.__init__(self, name='BootpExporter')
+        self.daemon = True
+        self.sock = sock
+        self.bootpd = bootpd
+        self.log = logger
+        bootpd.add_prefetch_listener(self.prefetch)
+
+    def prefetch(self, names):
+        """Forward the boot files to prefetch to the TFTP process"""
+        try:
+            # from the BOOTP thread, which may not wait for a TFTP process
+            self.sock.send(json.dumps([0, ['prefetch', names]]),
+                           socket.MSG_DONTWAIT)
+        except socket.error, e:
+            if e[0] not in (errno.EAGAIN, errno.ENOBUFS):
+                raise
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(SHARED_MAX_SIZE)
+            except socket.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            try:
+                seq, method, arg = json.loads(data)
+                if method not in self.METHODS:
+                    raise ValueError('Unknown method %s' % method)
+                result = getattr(self.bootpd, method)(arg)
+            except Exception, e:
+                self.log.error('Invalid query from the TFTP process: %s' % e)
+                continue
+            self.sock.send(json.dumps([seq, result]))
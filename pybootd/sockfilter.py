@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Kernel filters of the listening sockets (Linux socket filters)
+
+On a shared segment, the BOOTP sockets receive every broadcast request
+and reply, most of which the server would discard. Classic BPF programs
+attached to the listening sockets drop them in the kernel instead:
+
+  - BOOTP: anything but a BOOTREQUEST, and with the 'mac' access mode,
+    requests from the MAC addresses not allowed,
+  - TFTP: anything but a read or write request.
+
+The filters are enabled with the 'socket_filter' key of the 'bootp' and
+'tftp' sections, and rebuilt whenever these settings, or the access
+list, change:
+
+    bootp:
+        acl: mac
+        socket_filter: true
+
+A UDP socket filter sees the datagram from its UDP header on: the BOOTP
+message starts at offset 8.
+"""
+
+import array
+import socket
+import struct
+import sys
+
+__all__ = ['SocketFilterError', 'bootp_filter', 'tftp_filter',
+           'attach_filter', 'detach_filter']
+
+# <linux/filter.h>, <asm-generic/socket.h>
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+BPF_MAXINSNS = 4096
+
+BPF_LD_W_ABS = 0x20  # A <- P[k:4]
+BPF_LD_H_ABS = 0x28  # A <- P[k:2]
+BPF_LD_B_ABS = 0x30  # A <- P[k:1]
+BPF_LD_MEM = 0x60    # A <- M[k]
+BPF_ST = 0x02        # M[k] <- A
+BPF_JA = 0x05        # pc += k
+BPF_JEQ_K = 0x15     # pc += (A == k) ? jt : jf
+BPF_RET_K = 0x06     # return k
+
+ACCEPT = 0xffffffff
+DROP = 0
+
+UDP_HEADER_SIZE = 8
+BOOTP_OP = UDP_HEADER_SIZE
+BOOTP_CHADDR = UDP_HEADER_SIZE + 28
+TFTP_OPCODE = UDP_HEADER_SIZE
+
+_INSN = struct.Struct('HBBI')
+
+
+class SocketFilterError(Exception):
+    """Socket filter error"""
+    pass
+
+
+def _insn(code, k=0, jt=0, jf=0):
+    return (code, jt, jf, k)
+
+
+def bootp_filter(macs=None):
+    """Return the program accepting BOOTREQUESTs, from the given MAC
+       addresses only if any
+
+       MAC addresses are strings of colon-separated hexadecimal bytes.
+       They are compared as a 32-bit word, then a 16-bit half word: MAC
+       addresses sharing their first four bytes are grouped.
+    """
+    program = [_insn(BPF_LD_B_ABS, BOOTP_OP),
+               _insn(BPF_JEQ_K, 1, 1, 0),
+               _insn(BPF_RET_K, DROP)]
+    if macs is None:
+        program.append(_insn(BPF_RET_K, ACCEPT))
+        return program
+    groups = {}
+    for mac in macs:
+        try:
+            raw = ''.join([chr(int(byte, 16)) for byte in mac.split(':')])
+        except ValueError:
+            raise SocketFilterError('Invalid MAC address: %s' % mac)
+        if len(raw) != 6:
+            raise SocketFilterError('Invalid MAC address: %s' % mac)
+        high, low = struct.unpack('!IH', raw)
+        groups.setdefault(high, set()).add(low)
+    program.extend([_insn(BPF_LD_H_ABS, BOOTP_CHADDR+4),
+                    _insn(BPF_ST, 0),
+                    _insn(BPF_LD_W_ABS, BOOTP_CHADDR)])
+    for high in sorted(groups):
+        lows = sorted(groups[high])
+        # skip the group when the first four bytes differ: the group
+        # may be too long for a conditional jump
+        program.extend([_insn(BPF_JEQ_K, high, 1, 0),
+                        _insn(BPF_JA, 2*len(lows)+2),
+                        _insn(BPF_LD_MEM, 0)])
+        for low in lows:
+            program.extend([_insn(BPF_JEQ_K, low, 0, 1),
+                            _insn(BPF_RET_K, ACCEPT)])
+        # a single group may match the first four bytes
+        program.append(_insn(BPF_RET_K, DROP))
+    program.append(_insn(BPF_RET_K, DROP))
+    return program
+
+
+def tftp_filter():
+    """Return the program accepting TFTP read and write requests"""
+    return [_insn(BPF_LD_H_ABS, TFTP_OPCODE),
+            _insn(BPF_JEQ_K, 1, 1, 0),
+            _insn(BPF_JEQ_K, 2, 0, 1),
+            _insn(BPF_RET_K, ACCEPT),
+            _insn(BPF_RET_K, DROP)]
+
+
+def attach_filter(sock, program):
+    """Attach a program to a socket, replacing its current one"""
+    if not sys.platform.startswith('linux'):
+        raise SocketFilterError('Socket filters require Linux')
+    if len(program) > BPF_MAXINSNS:
+        raise SocketFilterError('Filter too long: %d instructions' % \
+                                len(program))
+    code = array.array('c', ''.join([_INSN.pack(*insn) for insn in
+                                     program]))
+    # struct sock_fprog: length and address of the instructions
+    fprog = struct.pack('HP', len(program), code.buffer_info()[0])
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    except socket.error, e:
+        raise SocketFilterError('Cannot attach filter: %s' % e)
+
+
+def detach_filter(sock):
+    """Remove the filter of a socket, if any"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except socket.error:
+        # no filter attached
+        pass
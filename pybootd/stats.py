@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Daemon statistics
+
+Counters and histograms are registered once, and updated from any
+thread: TFTP workers, prefetch and chunk fetchers share them, so each
+update holds the short lock of its metric. Statistics kept elsewhere,
+such as in a plain dictionary, are exported through collectors:
+callables invoked at rendering time, which return (labels, value)
+samples.
+
+Every metric is rendered in the Prometheus text exposition format:
+
+    # HELP pybootd_dhcp_received_total DHCP requests received
+    # TYPE pybootd_dhcp_received_total counter
+    pybootd_dhcp_received_total{type="DISCOVER"} 12
+"""
+
+import threading
+from bisect import bisect_left
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'REGISTRY']
+
+# processing time buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"'). \
+        replace('\n', r'\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, _escape(value))
+                              for name, value in zip(names, values)])
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """Base class of the metrics"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        """Return the (suffix, label names, label values, value) samples"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(names, values),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonic counter, with optional labels
+
+       counter.inc('DISCOVER') counts one for the first label value.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def add(self, amount, *labels):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self.values.items())
+        return [('', self.labelnames, labels, value) for labels, value in
+                values]
+
+
+class Gauge(Metric):
+    """Value sampled when rendered, from a collector callable
+
+       The collector returns a list of (label values, value) samples.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), collector=None,
+                 kind=None):
+        Metric.__init__(self, name, help, labelnames)
+        self.collector = collector
+        if kind:
+            self.kind = kind
+
+    def samples(self):
+        if not self.collector:
+            return []
+        return [('', self.labelnames, tuple(labels), value) for labels, value
+                in self.collector()]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets))
+        # the last counter is the +Inf bucket
+        self.counts = [0] * (len(self.buckets)+1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        with self._lock:
+            counts = list(self.counts)
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            samples.append(('_bucket', ('le',), (_format_value(bound),),
+                            total))
+        samples.append(('_sum', (), (), self.sum))
+        samples.append(('_count', (), (), self.count))
+        return samples
+
+
+class Registry(object):
+    """Set of the metrics exported by the daemon"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """Register a metric, or return the one registered with its name"""
+        return self.metrics.setdefault(metric.name, metric)
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, labelnames, collector, kind=None):
+        """Register a collector, replacing any previous one"""
+        gauge = Gauge(name, help, labelnames, collector, kind)
+        self.metrics[name] = gauge
+        return gauge
+
+    def render(self):
+        """Return every metric, in text exposition format"""
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+# the daemon registry
+REGISTRY = Registry()
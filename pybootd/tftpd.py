@@ -18,6 +18,7 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import Queue
 import os
 import re
 import select
@@ -25,17 +26,22 @@ import socket
 import string
 import struct
 import sys
+import threading
 import time
-import thread
 import urllib2
 import urlparse
-from ConfigParser import NoSectionError
 from cStringIO import StringIO
 from pybootd import pybootd_path
-from util import hexline, get_iface_config
+from chunkstore import ChunkStore, ChunkError
+from prefetch import BootFileCache
+from sockfilter import SocketFilterError, tftp_filter, attach_filter, \
+     detach_filter
+from stats import REGISTRY
+from tftproot import RootIndex
+from util import hexline, get_iface_configs, to_bool
 import logging
 
-__all__ = ['TftpServer']
+__all__ = ['TftpServer', 'FileFilters']
 
 TFTP_PORT = 69
 
@@ -45,6 +51,79 @@ class TftpError(AssertionError):
     pass
 
 
+class FileFilters(object):
+    """Map requested file names to the files of the requesting client
+
+       The 'filters' section lists glob patterns of requested names, tried
+       in order, with the name each one is replaced with:
+
+           filters:
+               - pxelinux.0: '{filename}'
+               - pxelinux.cfg/*: 'pxelinux.cfg/{mac}'
+
+       Replacements may use the keywords:
+
+         filename  the boot file given to the client
+         mac       the MAC address of the client, as aa-bb-cc-dd-ee-ff
+
+       both resolved from the client address by the BOOTP server. A name
+       whose keywords cannot be resolved is left unchanged.
+    """
+
+    KEYWORD = re.compile(r'\{(\w+)\}')
+
+    def __init__(self, logger, filters, bootpd=None):
+        self.log = logger
+        self.bootpd = bootpd
+        if isinstance(filters, dict):
+            filters = [dict([item]) for item in sorted(filters.items())]
+        patterns = []
+        self.replacements = []
+        for entry in filters or []:
+            if not isinstance(entry, dict) or len(entry) != 1:
+                raise TftpError('Filters should be single-entry mappings')
+            pattern, replacement = entry.items()[0]
+            pattern = re.escape(str(pattern).strip()). \
+                replace(r'\*', '.*').replace(r'\?', '.')
+            patterns.append('(%s)' % pattern)
+            self.replacements.append(str(replacement))
+        self.cre = patterns and \
+            re.compile('^(?:\./)?(?:%s)$' % '|'.join(patterns))
+
+    def __nonzero__(self):
+        return bool(self.cre)
+
+    def apply(self, name, client_ip):
+        """Return the name of the file to serve for a requested one"""
+        mo = self.cre and self.cre.match(name)
+        if not mo:
+            return name
+        replacement = self.replacements[mo.lastindex-1]
+        values = {}
+        for keyword in set(self.KEYWORD.findall(replacement)):
+            value = self.resolve(keyword, client_ip)
+            if not value:
+                self.log.warn('No %s for client %s, serving %s' % \
+                              (keyword, client_ip, name))
+                return name
+            values[keyword] = value
+        filtered = self.KEYWORD.sub(lambda mo: values[mo.group(1)],
+                                    replacement)
+        self.log.info('Client %s requested %s, serving %s' % \
+                      (client_ip, name, filtered))
+        return filtered
+
+    def resolve(self, keyword, client_ip):
+        if not self.bootpd:
+            return None
+        if keyword == 'filename':
+            return self.bootpd.get_filename(client_ip)
+        if keyword == 'mac':
+            mac = self.bootpd.get_lease(client_ip)
+            return mac and mac.lower().replace(':', '-')
+        return None
+
+
 class TftpConnection(object):
     RRQ = 1
     WRQ = 2
@@ -60,13 +139,22 @@ class TftpConnection(object):
         self.server = server
         self.client_addr = None
         self.sock = None
+        self.address = None # server address the request was sent to
         self.active = 0 # 0: inactive, 1: active
         self.blockNumber = 0
         self.lastpkt = ''
         self.mode = ''
         self.filename = ''
         self.file = None
+        self.uploading = False # the file is written by the client
         self.time = 0
+        self.started = time.time()
+        self.progress = self.started # time the transfer last moved forward
+        self.sent = 0 # bytes sent
+        self.retransmits = 0
+        self.size = None # size of the file, when known
+        self.id = 0 # transfer number, for the admin endpoint
+        self.reaped = None # reason the transfer was aborted for, if any
         self.blocksize = self.server.blocksize
         self.timeout = self.server.timeout
         self._bind('', port)
@@ -79,9 +167,14 @@ class TftpConnection(object):
 
     def send(self, pkt=''):
         self.log.debug('send')
-        self.sock.sendto(pkt, self.client_addr)
+        self.sendto(pkt)
         self.lastpkt = pkt
 
+    def sendto(self, pkt):
+        self.sock.sendto(pkt, self.client_addr)
+        self.server.record(self.sock, self.client_addr, pkt, False,
+                           self.address)
+
     def recv(self):
         self.log.debug('recv')
         fno = self.sock.fileno()
@@ -90,6 +183,8 @@ class TftpConnection(object):
         retry = self.server.retry
         while retry:
             r,w,e = select.select([fno], [], [fno], timeout)
+            if self.reaped:
+                raise TftpError(0, self.reaped)
             if not r:
                 # We timed out -- retransmit
                 retry = retry - 1
@@ -99,31 +194,14 @@ class TftpConnection(object):
                 pktsize = self.blocksize + self.HDRSIZE
                 data, addr = self.sock.recvfrom(pktsize)
                 if addr == client_addr:
+                    self.server.record(self.sock, addr, data, True,
+                                       self.address)
                     break
         else:
             raise TftpError(4, 'Transfer timed out')
         # end while
         return self.parse(data)
 
-    def _filter_file(self, mo):
-        self.log.debug('_filter_file')
-        return self.server.filter_file(self, mo)
-
-    def _dynreplace(self, matchobj):
-        """Dispatch a dynamic replacement function"""
-        self.log.debug('_dynreplace')
-        func = getattr(self, '_dynreplace_%s' % matchobj.group(1))
-        return func(matchobj)
-
-    def _dynreplace_filename(self, matchobj):
-        """Replace the 'filename' keyword with the client related filename"""
-        self.log.debug('_dynreplace_filename')
-        if not self.server.bootpd:
-            return matchobj.string
-        client_ip = self.client_addr[0]
-        path = self.server.bootpd.get_filename(client_ip)
-        return path
-
     def parse(self, data, unpack=struct.unpack):
         self.log.debug('parse')
         buf = buffer(data)
@@ -131,8 +209,11 @@ class TftpConnection(object):
         opcode = pkt['opcode'] = unpack('!h', buf[:2])[0]
         if ( opcode == self.RRQ ) or ( opcode == self.WRQ ):
             resource, mode, options = string.split(data[2:], '\000', 2)
-            #resource = self.server.fcre.sub(self._filter_file, resource)
+            filters = self.server.filters
+            if filters and opcode == self.RRQ:
+                resource = filters.apply(resource, self.client_addr[0])
             self.log.debug("Resource: %s" % resource)
+            pkt['name'] = resource
             if self.server.root:
                 resource = '%s/%s' % (self.server.root, resource)
             self.log.info("Resource '%s'" % resource)
@@ -160,7 +241,8 @@ class TftpConnection(object):
     def retransmit(self):
         if self.lastpkt:
             self.log.debug('Retransmit')
-            self.sock.sendto(self.lastpkt, self.client_addr)
+            self.retransmits += 1
+            self.sendto(self.lastpkt)
 
     def connect(self, addr, data):
         self.log.debug('connect new connection %s:%d' % addr)
@@ -203,11 +285,51 @@ class TftpConnection(object):
         except:
             import traceback
             self.log.error(traceback.format_exc())
+        finally:
+            self.close()
         self.log.debug('Ending connection %s:%s' % addr)
 
+    def close(self):
+        """Release the file and the socket of the transfer"""
+        if self.file:
+            try:
+                self.file.close()
+            except Exception, e:
+                self.log.warn('Cannot close %s: %s' % (self.filename, e))
+            self.file = None
+            if self.uploading and self.server.index:
+                # served at once, without waiting for the next scan
+                self.server.index.update(os.path.realpath(self.filename))
+        self.sock.close()
+
+    def describe(self, now):
+        """Return the state of the transfer, as shown by the admin
+           endpoint"""
+        elapsed = now - self.started
+        return {'id': self.id,
+                'client': '%s:%d' % self.client_addr,
+                'file': self.filename,
+                'size': self.size,
+                'sent': self.sent,
+                'block': self.blockNumber,
+                'blocksize': self.blocksize,
+                'elapsed': round(elapsed, 3),
+                'idle': round(now - self.progress, 3),
+                'rate': elapsed > 0 and int(self.sent / elapsed) or 0,
+                'retransmits': self.retransmits}
+
+    def reap(self, reason='Transfer stalled'):
+        """Abort a stalled transfer, from another thread"""
+        self.reaped = reason
+        try:
+            # wakes the transfer up, which may still send its error
+            self.sock.shutdown(socket.SHUT_RD)
+        except socket.error:
+            pass
+
     def recv_ack(self, pkt):
         self.log.debug('recv_ack')
-        self.log.debug('Received ack for block: {block}'.format(block=pkt['block]))
+        self.log.debug('Received ack for block: {block}'.format(block=pkt['block']))
         if pkt['block'] == self.blockNumber:
             # We received the correct ACK
             self.handle_ack(pkt)
@@ -225,7 +347,8 @@ class TftpConnection(object):
     def recv_err(self, pkt):
         self.log.debug('recv_err')
         self.handle_err(pkt)
-        self.retransmit()
+        # the client gave up, e.g. after probing the size of the file
+        self.active = False
 
     def send_data(self, data, pack=struct.pack):
         self.log.debug('send_data')
@@ -241,6 +364,8 @@ class TftpConnection(object):
         format = '!hH%ds' % lendata
         pkt = pack(format, self.DATA, block, data)
         self.send(pkt)
+        self.sent += lendata
+        self.progress = time.time()
         self.active = (len(data) == blocksize)
         if not self.active and self.time:
             total = time.time()-self.time
@@ -271,33 +396,50 @@ class TftpConnection(object):
         format = '!hH'
         pkt = pack(format, self.ACK, block)
         self.send(pkt)
+        self.progress = time.time()
 
     def send_error(self, errnum, errtext, pack=struct.pack):
         self.log.debug('send_error')
         errtext = errtext + '\000'
         format = '!hh%ds' % len(errtext)
         outdata = pack(format, self.ERR, errnum, errtext)
-        self.sock.sendto(outdata, self.client_addr)
+        self.sendto(outdata)
 
     def send_oack(self, options, pack=struct.pack):
         self.log.debug('send_oack')
         pkt = pack('!h', self.OACK)
         for k, v in options:
             pkt += k + '\x00' + v + '\x00'
+        # kept as the last packet: a lost OACK is sent again until block 0
+        # is acknowledged (RFC 2347)
         self.send(pkt)
-        # clear out the last packet buffer to prevent from retransmitting it
-        self.lastpkt = ''
 
     def handle_rrq(self, pkt):
         self.log.debug('handle_rrq')
-        resource = pkt['filename']
+        resource = self.filename = pkt['filename']
         mode = pkt['mode']
         # FIXME: Decide whether we need that or not
         genfile = None
         #genfile = self.server.genfilecre.match(resource)
+        # local roots are indexed, missing files are told at once
+        index = self.server.index
+        if index and not genfile:
+            self.handle_indexed_rrq(pkt, index)
+            return
+        # remote files may have been fetched when the client got its lease
+        content = None
+        remote = None
+        if self.is_url(resource):
+            content = self.server.cache.get(resource)
+            if content is None:
+                remote = self.server.open_remote(resource)
         if 'tsize' in pkt and int(pkt['tsize']) == 0:
             if genfile:
                 filesize = len(genfile.group('name'))
+            elif content is not None:
+                filesize = len(content)
+            elif remote:
+                filesize = remote.size
             else:
                 try:
                     if self.is_url(resource):
@@ -311,6 +453,7 @@ class TftpConnection(object):
                     self.send_error(1, 'Cannot access resource')
                     self.log.warn('Cannot stat resource %s' % resource)
                     return
+            self.size = filesize
             self.log.info('Send size request file %s size: %d' % \
                           (resource, filesize))
             options = [('tsize', str(filesize))]
@@ -322,6 +465,12 @@ class TftpConnection(object):
         if genfile:
             self.log.info('Generating file content: %s', genfile.group('name'))
             self.file = StringIO(resource[1:-1])
+        elif content is not None:
+            self.log.info("Sending resource '%s' from memory" % resource)
+            self.file = StringIO(content)
+        elif remote:
+            self.log.info("Sending resource '%s' in chunks" % resource)
+            self.file = remote
         else:
             try:
                 if self.is_url(resource):
@@ -339,9 +488,29 @@ class TftpConnection(object):
         if not 'tsize' in pkt:
             self.send_data(self.file.read(self.blocksize))
 
+    def handle_indexed_rrq(self, pkt, index):
+        opened = index.open(pkt['name'])
+        if not opened:
+            self.active = False
+            self.send_error(1, 'File not found')
+            self.log.info("No file '%s'" % pkt['filename'])
+            return
+        self.file, filesize = opened
+        self.size = filesize
+        self.log.info("Sending file '%s'" % self.file.name)
+        if 'tsize' in pkt and int(pkt['tsize']) == 0:
+            self.log.info('Send size request file %s size: %d' % \
+                          (self.file.name, filesize))
+            options = [('tsize', str(filesize))]
+            if 'blksize' in pkt:
+                options.append(('blksize', pkt['blksize']))
+            self.send_oack(options)
+        else:
+            self.send_data(self.file.read(self.blocksize))
+
     def handle_wrq(self, pkt):
         self.log.debug('handle_wrq')
-        resource = pkt['filename']
+        resource = self.filename = pkt['filename']
         mode = pkt['mode']
         if self.is_url(resource):
             self.log.error('Writing to URL is not yet supported')
@@ -349,6 +518,7 @@ class TftpConnection(object):
         try:
             self.log.info('Receiving file: %s' % resource)
             self.file = open(resource, 'wb')
+            self.uploading = True
         except:
             self.send_error(1, 'Cannot open file')
             self.log.error('Cannot open file for writing %s: %s' % \
@@ -379,66 +549,273 @@ class TftpConnection(object):
 class TftpServer:
     """TFTP Server
     Implements a threaded TFTP Server.
-    Each request is handled in its own thread
+    Requests are handled by a fixed pool of worker threads, and refused
+    with a 'server busy' error when too many of them are waiting.
     """
 
-    def __init__(self, logger, config, bootpd=None):
+    def __init__(self, logger, config, bootpd=None, recorder=None,
+                 handoff=None):
         self.log = logger
         self.config = config
         self.sock = []
         self.bootpd = bootpd
+        self.recorder = recorder # capture of the TFTP traffic, if any
+        self.handoff = handoff # sockets of the previous process, if any
+        self.paused = False
+        self.addresses = {} # key socket, value bound address
         self.blocksize = int(self.config.get_tftp_blocksize())
         self.timeout = float(self.config.get_tftp_timeout())
         self.root = self.config.get_tftp_root()
         self.retry = 5
-
-        # Nice idea, not needed for us for now, disabled
-        #self.fcre, self.filepatterns = self.get_file_filters()
-        #self.genfilecre = re.compile(r'\[(?P<name>[\w\.\-]+)\]')
+        # pool settings apply after a restart
+        self.workers = int(self.config.get_tftp_workers())
+        self.pending = Queue.Queue(int(self.config.get_tftp_queue_size()))
+        self.connections = set() # transfers in progress
+        self.busy = 0
+        self.count = 0 # transfers started
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = [] # worker pool and reaper
+        self.requests = REGISTRY.counter('pybootd_tftp_requests_total',
+            'TFTP requests, by outcome', ('outcome',))
+        self.reaped = REGISTRY.counter('pybootd_tftp_reaped_total',
+            'TFTP transfers aborted for making no progress')
+        REGISTRY.gauge('pybootd_tftp_workers',
+            'TFTP worker threads, by state', ('state',),
+            lambda: [(('busy',), self.busy),
+                     (('idle',), self.workers-self.busy)])
+        REGISTRY.gauge('pybootd_tftp_queued_requests',
+            'TFTP requests waiting for a worker', (),
+            lambda: [((), self.pending.qsize())])
+        self.chunks = ChunkStore(logger, config)
+        self.cache = BootFileCache(logger, config, self.chunks)
+        self.index = self.build_index(config)
+        self.filters = self.build_filters(config)
+        if bootpd:
+            bootpd.add_prefetch_listener(self.cache.prefetch)
+        if handoff:
+            handoff.add_server('tftp', self)
+        self.config.add_reload_listener(self.reload)
+
+    def reload(self, config, diff):
+        """Apply new settings, in-flight transfers keep their own"""
+        if 'remote' in diff['sections']:
+            self.log.warn('Remote file settings apply after a restart')
+        if 'filters' in diff['sections']:
+            try:
+                self.filters = self.build_filters(config)
+            except TftpError, e:
+                self.log.error('Cannot apply the new filters: %s' % e)
+        if 'tftp' not in diff['sections']:
+            return
+        if int(config.get_tftp_workers()) != self.workers or \
+           int(config.get_tftp_queue_size()) != self.pending.maxsize:
+            self.log.warn('TFTP pool settings apply after a restart')
+        self.blocksize = int(config.get_tftp_blocksize())
+        self.timeout = float(config.get_tftp_timeout())
+        index, previous = self.build_index(config), self.index
+        self.root, self.index = config.get_tftp_root(), index
+        if previous:
+            previous.stop()
+        self.apply_filter(config)
+
+    def build_filters(self, config):
+        return FileFilters(self.log, config.get_filters(), self.bootpd)
+
+    def build_index(self, config):
+        """Index a local TFTP root, if enabled"""
+        root = config.get_tftp_root()
+        enabled = config.get_tftp_index()
+        if enabled is None:
+            # without inotify, the whole root is scanned periodically
+            enabled = RootIndex.watching
+        if not root or urlparse.urlsplit(root).scheme or \
+           not to_bool(enabled):
+            return None
+        index = RootIndex(self.log, root,
+                          float(config.get_tftp_index_interval()))
+        index.start()
+        return index
 
     def bind(self):
-        netconfig = get_iface_config(self.config.get_tftp_bind_interface())
-        host = netconfig and netconfig['address']
-        if not host:
+        netconfigs = get_iface_configs(
+                        self.config.get_tftp_bind_interfaces())
+        if not netconfigs:
             raise TftpError('TFTP address not defined')
         port = int(self.config.get_tftp_port())
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.append(sock)
-        sock.bind((host, port))
+        for netconfig in netconfigs:
+            address = (netconfig['address'], port)
+            sock = self.handoff and self.handoff.take('tftp', address)
+            if not sock:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind(address)
+            self.sock.append(sock)
+            self.addresses[sock] = address[0]
+            self.log.info('Listening to %s:%s' % address)
+            if self.handoff:
+                self.handoff.register('tftp', address, sock)
+        self.apply_filter(self.config)
+
+    def apply_filter(self, config):
+        """Attach the kernel filter to the sockets, or remove it"""
+        enabled = to_bool(config.get_tftp_socket_filter())
+        for sock in self.sock:
+            try:
+                if enabled:
+                    attach_filter(sock, tftp_filter())
+                else:
+                    # inherited sockets may have one
+                    detach_filter(sock)
+            except SocketFilterError, e:
+                self.log.warn('Requests are not filtered: %s' % e)
+                return
+        if enabled:
+            self.log.info('Filtering requests in the kernel')
 
-    def forever(self):
+    def pause(self, paused=True):
+        """Stop reading requests, or resume; transfers in progress go on"""
+        self.paused = paused
+
+    def active(self):
+        """Return the number of requests queued or being served"""
+        return self.pending.qsize() + self.busy
+
+    def stop(self):
+        """Stop the server threads, abandoning the transfers still in
+           progress"""
+        if self._stopped.isSet():
+            return
+        self._stopped.set()
+        with self._lock:
+            connections = list(self.connections)
+        for t in connections:
+            t.reap('Transfer abandoned')
         while True:
-            r,w,e = select.select(self.sock, [], self.sock)
+            try:
+                self.pending.get_nowait()
+            except Queue.Empty:
+                break
+        for worker in self._threads:
+            # wakes an idle worker up
+            self.pending.put(None)
+        for worker in self._threads:
+            worker.join()
+        if self.index:
+            self.index.stop()
+
+    def forever(self):
+        for pos in xrange(self.workers):
+            self._spawn(self._work, 'TftpWorker-%d' % pos)
+        self._spawn(self._reap, 'TftpReaper')
+        while not self._stopped.isSet():
+            if self.paused:
+                # the sockets are handed over to another process
+                time.sleep(0.1)
+                continue
+            r,w,e = select.select(self.sock, [], self.sock, 1.0)
+            if self.paused:
+                continue
             for sock in r:
                 data, addr = sock.recvfrom(516)
-                t = TftpConnection(self, logger=self.log)
-                thread.start_new_thread(t.connect, (addr, data))
-
-    def filter_file(self, connexion, mo):
-        # extract the position of the matching pattern, then extract the
-        # conversion string from the file convertion sequence
-        groupdict = mo.groupdict()
-        for group in groupdict:
-            filename = groupdict[group]
-            if not filename:
-                continue
-            filepattern = self.filepatterns[group]
-            return re.sub(r'\{(\w+)\}', connexion._dynreplace, filepattern)
-        raise TftpError('Internal error, file matching pattern issue')
-
-    def get_file_filters(self):
-        patterns = []
-        replacements = {}
+                self.record(sock, addr, data, True)
+                try:
+                    self.pending.put_nowait((sock, addr, data))
+                except Queue.Full:
+                    self.refuse(sock, addr)
+                    continue
+                self.requests.inc('accepted')
+
+    def refuse(self, sock, addr, pack=struct.pack):
+        """Tell a client the server is too busy to serve its request"""
+        self.log.warn('Server busy, refusing request from %s:%d' % addr)
+        self.requests.inc('busy')
+        errtext = 'Server busy\000'
+        pkt = pack('!hh%ds' % len(errtext), TftpConnection.ERR, 0, errtext)
+        sock.sendto(pkt, addr)
+        self.record(sock, addr, pkt, False)
+
+    def transfers(self):
+        """Return the state of the transfers in progress"""
+        now = time.time()
+        with self._lock:
+            connections = list(self.connections)
+        return sorted([t.describe(now) for t in connections],
+                      key=lambda transfer: transfer['id'])
+
+    def cancel(self, tid):
+        """Abort a transfer in progress, returning False if not found"""
+        with self._lock:
+            connections = [t for t in self.connections if t.id == tid]
+        for t in connections:
+            self.log.warn('Cancelling transfer of %s to %s:%d' % \
+                          ((t.filename or 'request',) + t.client_addr))
+            t.reap('Transfer cancelled')
+        return bool(connections)
+
+    def _spawn(self, target, name):
+        worker = threading.Thread(target=target, name=name)
+        worker.daemon = True
+        worker.start()
+        self._threads.append(worker)
+
+    def _work(self):
+        while True:
+            request = self.pending.get()
+            if request is None:
+                break
+            sock, addr, data = request
+            t = TftpConnection(self, logger=self.log)
+            t.address = self.addresses.get(sock)
+            t.client_addr = addr
+            with self._lock:
+                self.count += 1
+                t.id = self.count
+                self.connections.add(t)
+                self.busy += 1
+            try:
+                t.connect(addr, data)
+            finally:
+                with self._lock:
+                    self.connections.discard(t)
+                    self.busy -= 1
+
+    def _reap(self):
+        while not self._stopped.wait(1.0):
+            stall = float(self.config.get_tftp_stall_timeout())
+            now = time.time()
+            with self._lock:
+                connections = list(self.connections)
+            for t in connections:
+                if t.reaped or now - t.progress < stall:
+                    continue
+                self.log.warn('Aborting stalled transfer of %s to %s:%d' % \
+                              ((t.filename or 'request',) + t.client_addr))
+                self.reaped.inc()
+                t.reap()
+
+    def record(self, sock, peer, data, incoming, address=None):
+        """Record a datagram exchanged with a client, if capturing"""
+        if not self.recorder:
+            return
+        # transfer sockets are bound to any address
+        address = address or self.addresses.get(sock, '0.0.0.0')
+        local = (address, sock.getsockname()[1])
+        if incoming:
+            self.recorder.write(peer, local, data)
+        else:
+            self.recorder.write(local, peer, data)
+
+    def open_remote(self, url):
+        """Return a file object reading a remote file in chunks, or None
+           to stream it"""
+        config = self.config.snapshot()
+        if not config.get_remote_enabled():
+            return None
+        store = self.chunks
+        if not config.get_remote_shared():
+            store = store.private()
         try:
-            for pos, pattern in enumerate(self.config.options('filters'), 1):
-                value = self.config.get('filters', pattern).strip()
-                pattern = pattern.strip('\r\n \t')
-                pattern = pattern.replace('.', '\.')
-                pattern = pattern.replace('*', '.*').replace('?', '.')
-                pname = 'p%d' % pos
-                replacements[pname] = value
-                patterns.append('(?P<%s>%s)' % (pname, pattern))
-            xre = '^(?:\./)?(?:%s)$' % '|'.join(patterns)
-        except NoSectionError:
-            xre = '^$'
-        return (re.compile(xre), replacements)
+            return store.open(url)
+        except ChunkError, e:
+            self.log.warn('Cannot read %s in chunks: %s' % (url, e))
+            return None
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2013 Vladimir Lazarenko <favoretti@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""In-memory index of a local TFTP root
+
+PXE loaders probe long sequences of files, most of which do not exist
+(pxelinux.cfg/01-<mac>, then the address of the client in hexadecimal,
+one digit less at a time, ...). The files of the root are indexed in
+memory, so that requests for missing files are answered without any
+file system access, and existing files are opened without resolving
+their path again.
+
+The index follows the changes of the root with inotify, when the
+'pyinotify' module is installed, and is then enabled by default.
+Otherwise, the root is scanned again every 'index_interval' seconds of
+the 'tftp' section. A file missing from the index is then looked for on
+the file system, and remembered as missing until the next scan:
+
+    tftp:
+        root: /srv/tftp
+        index: true
+        index_interval: 5.0
+"""
+
+import os
+import posixpath
+import stat
+import threading
+from stats import REGISTRY
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+__all__ = ['RootIndex']
+
+
+class RootIndex(object):
+    """Index of the files below a directory
+
+       Files are named by their path relative to the root, with '/'
+       separators. Symbolic links are followed, as when the files are
+       opened by name, except those leading back to a parent directory.
+       Each directory lists its entries, so that a change is applied to
+       the files of the changed directory only.
+    """
+
+    watching = pyinotify is not None # changes are followed as they occur
+
+    def __init__(self, logger, root, interval):
+        self.log = logger
+        self.root = os.path.realpath(root)
+        self.interval = interval
+        self.files = {} # key relative path, value (path, size, mtime)
+        self._children = {} # key directory relative path, value entry names
+        self._missing = set() # names not found since the last scan
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = None
+        self._notifier = None
+        self.lookups = REGISTRY.counter('pybootd_tftp_index_lookups_total',
+            'TFTP root index lookups, by result', ('result',))
+        REGISTRY.gauge('pybootd_tftp_index_files',
+            'Files of the TFTP root index', (),
+            lambda: [((), len(self.files))])
+
+    def start(self):
+        self._reset(self.scan(self.root))
+        self.log.info('Indexed %d files of %s' % (len(self.files),
+                                                  self.root))
+        if pyinotify:
+            self._watch()
+            return
+        self._worker = threading.Thread(target=self._poll,
+                                        name='TftpRootIndex')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._worker:
+            self._worker.join()
+            self._worker = None
+        if self._notifier:
+            self._notifier.stop()
+            self._notifier = None
+
+    def scan(self, top):
+        """Return the entries of the files below a directory"""
+        files = {}
+        base = len(self.root.rstrip(os.sep)) + 1
+        ancestry = {} # key directory, value (st_dev, st_ino) up to the top
+        for dirpath, dirnames, filenames in os.walk(top, followlinks=True):
+            try:
+                info = os.stat(dirpath)
+            except OSError:
+                dirnames[:] = []
+                continue
+            parents = ancestry.get(os.path.dirname(dirpath), frozenset())
+            identity = (info.st_dev, info.st_ino)
+            if identity in parents:
+                self.log.warn('Not indexing %s, a link to a parent '
+                              'directory' % dirpath)
+                dirnames[:] = []
+                continue
+            ancestry[dirpath] = parents | frozenset([identity])
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                entry = self._stat(path)
+                if entry:
+                    name = path[base:].replace(os.sep, '/')
+                    files[name] = entry
+        return files
+
+    def normalize(self, name):
+        """Return the index key of a requested name, or None if it may not
+           be below the root"""
+        name = posixpath.normpath('/' + name).lstrip('/')
+        if not name or name == '.':
+            return None
+        return name
+
+    def lookup(self, name):
+        """Return the entry of a requested file, or None"""
+        key = self.normalize(name)
+        entry = key and self.files.get(key)
+        if key and not entry and not self._notifier:
+            entry = self._find(key)
+        self.lookups.inc(entry and 'hit' or 'miss')
+        return entry
+
+    def open(self, name):
+        """Open a requested file, returning the file and its size, or None
+           if the file does not exist"""
+        entry = self.lookup(name)
+        if not entry:
+            return None
+        try:
+            fobj = open(entry[0], 'rb')
+        except IOError:
+            # removed since the last scan
+            self.update(entry[0])
+            return None
+        info = os.fstat(fobj.fileno())
+        if (info.st_size, info.st_mtime) != entry[1:]:
+            with self._lock:
+                self.files[self.normalize(name)] = (entry[0], info.st_size,
+                                                    info.st_mtime)
+        return fobj, info.st_size
+
+    def _find(self, key):
+        """Look for a file added since the last scan"""
+        if key in self._missing:
+            return None
+        path = os.path.join(self.root, *key.split('/'))
+        entry = self._stat(path)
+        with self._lock:
+            if entry:
+                self.files[key] = entry
+                self._link(self._children, key)
+            else:
+                self._missing.add(key)
+        return entry
+
+    def _stat(self, path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        return (path, info.st_size, info.st_mtime)
+
+    def _reset(self, files):
+        children = {}
+        for name in files:
+            self._link(children, name)
+        with self._lock:
+            self.files, self._children = files, children
+            self._missing = set()
+
+    def _link(self, children, name):
+        """Record a name in the entries of its parent directories"""
+        while name:
+            parent = posixpath.dirname(name)
+            siblings = children.setdefault(parent, set())
+            if name in siblings:
+                break
+            siblings.add(name)
+            name = parent
+
+    def _remove(self, name):
+        """Remove a file, or a directory and the files below it"""
+        pending = [name]
+        while pending:
+            key = pending.pop()
+            self.files.pop(key, None)
+            pending.extend(self._children.pop(key, ()))
+        siblings = self._children.get(posixpath.dirname(name))
+        if siblings:
+            siblings.discard(name)
+
+    def update(self, path):
+        """Update the entries of a changed path, file or directory"""
+        if not path.startswith(self.root.rstrip(os.sep) + os.sep):
+            return
+        name = path[len(self.root.rstrip(os.sep))+1:].replace(os.sep, '/')
+        if os.path.isdir(path):
+            entries = self.scan(path)
+        else:
+            entry = self._stat(path)
+            entries = entry and {name: entry} or {}
+        with self._lock:
+            self._remove(name)
+            self._missing.clear()
+            for key, entry in entries.iteritems():
+                self.files[key] = entry
+                self._link(self._children, key)
+
+    def _poll(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                files = self.scan(self.root)
+            except Exception, e:
+                self.log.warn('Cannot index %s: %s' % (self.root, e))
+                continue
+            self._reset(files)
+
+    def _watch(self):
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+               pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM | \
+               pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB
+        index = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                index.update(event.pathname)
+
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+        manager.add_watch(self.root, mask, rec=True, auto_add=True)
+        self.log.info('Watching %s for changes' % self.root)
@@ -58,6 +58,24 @@ def to_bool(value, permissive=True):
         return False
     raise AssertionError('"Invalid boolean value: "%s"' % value)
 
+def to_list(value):
+    """Convert a list, or a string of comma or space separated items"""
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return value.replace(',', ' ').split()
+    return list(value)
+
+CANONICAL_MAC = re.compile('^(?:[0-9A-F]{2}:){5}[0-9A-F]{2}$')
+_NON_HEX = re.compile('[^0-9A-Fa-f]')
+
+def normalize_mac(mac):
+    """Convert a MAC address into its canonical XX:XX:XX:XX:XX:XX form"""
+    digits = _NON_HEX.sub('', str(mac)).upper()
+    if len(digits) != 12:
+        raise ValueError('Invalid MAC address: %s' % mac)
+    return ':'.join([digits[pos:pos+2] for pos in xrange(0, 12, 2)])
+
 def hexline(data):
     """Convert a binary buffer into a hexadecimal representation"""
     LOGFILTER=''.join([(len(repr(chr(x)))==3) and chr(x) or \
@@ -147,6 +165,42 @@ def get_iface_config(interface):
         return config
     return None
 
+def get_iface_configs(interfaces):
+    """Return the configuration of several interfaces or addresses
+
+       Each entry is either an interface name, standing for its first IPv4
+       address, or an IPv4 address of one of the host interfaces.
+    """
+    if isinstance(interfaces, basestring):
+        interfaces = [interfaces]
+    configs = []
+    for interface in interfaces or []:
+        interface = str(interface)
+        if not re.match(r'^\d{1,3}(\.\d{1,3}){3}$', interface):
+            config = get_iface_config(interface)
+        else:
+            config = get_addr_config(interface)
+        if config and config not in configs:
+            configs.append(config)
+    return configs
+
+def get_addr_config(address):
+    try:
+        import netifaces
+    except ImportError:
+        raise AssertionError("netifaces module is not installed")
+    for interface in netifaces.interfaces():
+        for inetinfo in netifaces.ifaddresses(interface).get(netifaces.AF_INET,
+                                                             []):
+            if inetinfo.get('addr') != address:
+                continue
+            mask = iptoint(inetinfo['netmask'])
+            return { 'ifname': interface,
+                     'address': address,
+                     'net': inttoip(iptoint(address) & mask),
+                     'mask': inttoip(mask) }
+    raise AssertionError("Address {address} is not configured on any interface, check your configuration!".format(address=address))
+
 class EasyConfigParser(SafeConfigParser):
     "ConfigParser extension to support default config values"
     def get(self, section, option, default=None):